@@ -1,17 +1,54 @@
 import asyncio
+import contextlib
+import contextvars
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import logging
 import sqlite3
 import os
 import json
+import pathlib
 import re
+import shlex
+import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from aiogram import Bot, Dispatcher, types, executor
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-import aiofiles
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import (
+    BadRequest, Unauthorized, TelegramAPIError, RetryAfter, NetworkError, MessageNotModified,
+    BotBlocked, BotKicked, UserDeactivated, CantInitiateConversation, ChatNotFound,
+)
+try:
+    from telethon import TelegramClient
+    from telethon.sessions import MemorySession
+except ImportError:  # Telethon ixtiyoriy: faqat kanal a'zolarini backfill qilish uchun
+    TelegramClient = None
+try:
+    import resource
+except ImportError:  # Windows: rlimit yo'q, botlar cheklovsiz ishlaydi
+    resource = None
+try:
+    import fcntl
+except ImportError:  # Windows: reflink yo'q, oddiy nusxa olinadi
+    fcntl = None
 from aiohttp import web
 import aiohttp
 
@@ -25,12 +62,154 @@ logger = logging.getLogger(__name__)
 # Database sozlash
 DB_NAME = 'maker_bot.db'
 
+# O'qish uchun ochiladigan read-only ulanishlar soni
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", 4))
+
+# Har bir ulanish uchun SQLite PRAGMA lari (journal_mode=WAL yozuvchi ulanishda o'rnatiladi)
+DB_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000,        # ~16 MB
+    'mmap_size': 134217728,      # 128 MB
+    'temp_store': 'MEMORY',
+}
+
+# Group-commit rejimi: yozuvlar DB_GROUP_COMMIT_DELAY soniya yoki DB_GROUP_COMMIT_MAX_BATCH
+# ta yozuv yig'ilgach bitta commit (bitta fsync) bilan diskka yoziladi
+DB_GROUP_COMMIT = os.getenv("DB_GROUP_COMMIT", "0") == "1"
+DB_GROUP_COMMIT_DELAY = float(os.getenv("DB_GROUP_COMMIT_DELAY", 0.005))
+DB_GROUP_COMMIT_MAX_BATCH = int(os.getenv("DB_GROUP_COMMIT_MAX_BATCH", 100))
+
+# Boshqariladigan indekslar: nomi -> (jadval, ustunlar). Ro'yxatda yo'q idx_* indekslar o'chiriladi.
+# O'zgartirilganda MIGRATIONS oxiriga migrate_indexes qadamini qo'shing
+DB_INDEXES = {
+    'idx_users_referred_by': ('users', 'referred_by'),
+    'idx_users_created_at': ('users', 'created_at'),
+    'idx_user_bots_user_id': ('user_bots', 'user_id, created_at'),
+    'idx_user_bots_created_at': ('user_bots', 'created_at'),
+    'idx_user_bots_status_days': ('user_bots', 'status, days_left'),
+    'idx_payments_status_created': ('payments', 'status, created_at'),
+    'idx_channel_members_channel': ('channel_members', 'channel_id'),
+    'idx_broadcasts_status': ('broadcasts', 'status'),
+    'idx_users_referrals_count': ('users', 'referrals_count'),
+    'idx_users_reachable': ('users', 'is_reachable'),
+    'idx_referral_closure_descendant': ('referral_closure', 'descendant_id'),
+    'idx_ledger_user': ('ledger', 'user_id, created_at'),
+    'idx_provision_jobs_status': ('provision_jobs', 'status'),
+}
+
+# To'liq o'qilishi ruxsat etilgan kichik jadvallar (katalog, sozlamalar, FTS5 ning ichki konfiguratsiyasi)
+FULL_SCAN_ALLOWED_TABLES = {'bots', 'mandatory_subscriptions', 'settings', 'users_fts_config'}
+
 # Admin ID (o'zgartiring)
 ADMIN_ID = 7174828209
 
 # Referral summa (default 300)
 DEFAULT_REFERRAL_AMOUNT = 300   # <-- BU QATOR BO‘LISHI SHART!
 
+# referral_closure da saqlanadigan eng chuqur referral darajasi
+REFERRAL_MAX_DEPTH = 5
+
+# Majburiy obuna tekshiruvi keshi (soniyalarda va yozuvlar soni)
+SUBSCRIPTION_CACHE_TTL = int(os.getenv("SUBSCRIPTION_CACHE_TTL", 600))
+SUBSCRIPTION_CACHE_NEGATIVE_TTL = int(os.getenv("SUBSCRIPTION_CACHE_NEGATIVE_TTL", 30))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", 100000))
+# channel_members yozuvi shuncha soniyadan eski bo'lsa ishonilmaydi va Bot API da qayta tekshiriladi:
+# bot o'chiq paytda kelgan chat_member update lari (skip_updates) yo'qoladi
+CHANNEL_MEMBER_MAX_AGE = int(os.getenv("CHANNEL_MEMBER_MAX_AGE", 6 * 3600))
+
+# get_chat_member so'rovlari: bitta so'rov vaqti, parallel so'rovlar soni va
+# natija noma'lum bo'lganda (timeout/API xatosi) siyosat: "deny" yoki "allow"
+SUBSCRIPTION_CHECK_TIMEOUT = float(os.getenv("SUBSCRIPTION_CHECK_TIMEOUT", 3))
+SUBSCRIPTION_CHECK_CONCURRENCY = int(os.getenv("SUBSCRIPTION_CHECK_CONCURRENCY", 20))
+SUBSCRIPTION_UNKNOWN_POLICY = os.getenv("SUBSCRIPTION_UNKNOWN_POLICY", "deny")
+
+# Telethon (kanal a'zolarini bir martalik backfill qilish uchun, ixtiyoriy)
+TELEGRAM_API_ID = int(os.getenv("TELEGRAM_API_ID", 0))
+TELEGRAM_API_HASH = os.getenv("TELEGRAM_API_HASH", "")
+
+# Chiquvchi xabarlar navbati: Telegram botlar uchun umumiy chegara ~30 xabar/soniya, bitta chatga ~1 xabar/soniya
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", 25))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", 3))
+OUTBOUND_CHAT_BUCKETS = int(os.getenv("OUTBOUND_CHAT_BUCKETS", 10000))
+OUTBOUND_MAX_RETRIES = 5
+# Bitta chatdagi 429 faqat shu chatni to'xtatadi. OUTBOUND_FLOOD_WINDOW soniya ichida shuncha
+# turli chat 429 olsa bu umumiy chegara deb hisoblanadi va barcha yuborish to'xtatiladi
+OUTBOUND_FLOOD_CHATS = int(os.getenv("OUTBOUND_FLOOD_CHATS", 3))
+OUTBOUND_FLOOD_WINDOW = float(os.getenv("OUTBOUND_FLOOD_WINDOW", 10))
+
+# Foydalanuvchilar eksporti: nomi -> users ustuni
+USER_EXPORT_COLUMNS = {
+    'id': 'user_id', 'username': 'username', 'name': 'full_name', 'phone': 'phone_number',
+    'balance': 'balance', 'referral_code': 'referral_code', 'referred_by': 'referred_by',
+    'reachable': 'is_reachable', 'created_at': 'created_at',
+}
+USER_EXPORT_DEFAULT_COLUMNS = ['id', 'name', 'username', 'phone', 'balance', 'created_at']
+# Kursordan bir martada o'qiladigan qatorlar soni
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 5000))
+# Admin foydalanuvchilar ro'yxati va qidiruvidagi qatorlar soni
+ADMIN_USERS_PAGE_SIZE = 10
+
+# Foydalanuvchi botlari supervizori: crash bo'lgan bot BASE, 2*BASE, ... (MAX gacha) soniyadan keyin qayta ishga tushadi
+BOT_RESTART_BACKOFF_BASE = float(os.getenv("BOT_RESTART_BACKOFF_BASE", 2))
+BOT_RESTART_BACKOFF_MAX = float(os.getenv("BOT_RESTART_BACKOFF_MAX", 300))
+# BOT_CRASH_LOOP_WINDOW soniya ichida BOT_CRASH_LOOP_LIMIT marta crash bo'lsa bot 'crashed' holatiga o'tadi
+BOT_CRASH_LOOP_LIMIT = int(os.getenv("BOT_CRASH_LOOP_LIMIT", 5))
+BOT_CRASH_LOOP_WINDOW = float(os.getenv("BOT_CRASH_LOOP_WINDOW", 600))
+# Shuncha soniya ishlagan bot barqaror hisoblanadi (backoff va crash hisobi qaytadan boshlanadi)
+BOT_STABLE_AFTER = float(os.getenv("BOT_STABLE_AFTER", 60))
+# SIGTERM dan keyin SIGKILL gacha kutish
+BOT_STOP_TIMEOUT = float(os.getenv("BOT_STOP_TIMEOUT", 10))
+
+# Har bir bot jarayoni uchun resurs cheklovlari (0 - cheklovsiz)
+BOT_MEMORY_LIMIT_MB = int(os.getenv("BOT_MEMORY_LIMIT_MB", 512))
+BOT_MAX_OPEN_FILES = int(os.getenv("BOT_MAX_OPEN_FILES", 256))
+# cgroup bo'lmasa CPU ulushi nice orqali pasaytiriladi
+BOT_NICE = int(os.getenv("BOT_NICE", 10))
+# cgroup v2: maker uchun ajratilgan papka (masalan /sys/fs/cgroup/maker). Bo'sh bo'lsa faqat rlimit ishlatiladi
+BOT_CGROUP_ROOT = os.getenv("BOT_CGROUP_ROOT", "")
+BOT_CPU_QUOTA_PERCENT = int(os.getenv("BOT_CPU_QUOTA_PERCENT", 50))
+BOT_MAX_PIDS = int(os.getenv("BOT_MAX_PIDS", 64))
+# /proc dan RSS, CPU va fd larni o'qish oralig'i
+BOT_USAGE_SAMPLE_INTERVAL = float(os.getenv("BOT_USAGE_SAMPLE_INTERVAL", 30))
+
+# Umumiy runtime: maker_tenant.py li shablonlar alohida jarayon o'rniga umumiy worker larda ishlaydi
+SHARED_RUNTIME_ENABLED = os.getenv("SHARED_RUNTIME_ENABLED", "0") == "1"
+SHARED_RUNTIME_ENTRY = os.getenv("SHARED_RUNTIME_ENTRY", "maker_tenant.py")
+SHARED_RUNTIME_DIR = os.getenv("SHARED_RUNTIME_DIR", "shared_runtime")
+SHARED_RUNTIME_WORKERS = int(os.getenv("SHARED_RUNTIME_WORKERS", 1))
+SHARED_RUNTIME_POLL_INTERVAL = float(os.getenv("SHARED_RUNTIME_POLL_INTERVAL", 2))
+
+# Bot yaratish navbati: bir vaqtda nechta bot ochiladi (worker oqimlar soni) va navbat chegarasi
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", 2))
+PROVISION_MAX_PENDING = int(os.getenv("PROVISION_MAX_PENDING", 50))
+
+# Foydalanuvchi botlari papkasi (bot_<user>_<bot>_<vaqt>) va har bir bot papkasidagi log fayli
+USER_BOTS_DIR = "user_bots"
+BOT_LOG_FILE = "log.txt"
+
+# Shablonlar bir marta ochiladigan kontent-manzilli ombor (fayllar sha256 bo'yicha saqlanadi)
+TEMPLATE_STORE_DIR = os.getenv("TEMPLATE_STORE_DIR", "template_store")
+# Ombordagi faylga hardlink qilinadigan fayllar: bot o'zgartirmaydigan kod va statik resurslar.
+# Qolgan hammasi (ma'lumotlar, sessiyalar, kengaytmasiz fayllar, token yoziladigan .py) alohida nusxa oladi -
+# root bo'lib ishlagan bot hardlink orqali ombordagi faylni va boshqa botlarni buzmasligi uchun
+TEMPLATE_SHARED_EXTENSIONS = {
+    '.py', '.pyi',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp', '.ico', '.svg',
+    '.mp3', '.ogg', '.oga', '.wav', '.m4a', '.mp4', '.webm', '.tgs',
+    '.ttf', '.otf', '.woff', '.woff2',
+}
+
+# Ommaviy xabar (broadcast)
+# Qabul qiluvchilar shu o'lchamdagi bo'laklarda o'qiladi, har bo'lakdan keyin holat saqlanadi
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 200))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+BROADCAST_MAX_RETRIES = 3
+# Broadcast sikli xato bilan uzilsa shuncha marta (kutish har safar ikki barobar) qayta uriniladi
+BROADCAST_LOOP_RETRIES = int(os.getenv("BROADCAST_LOOP_RETRIES", 3))
+BROADCAST_RETRY_DELAY = float(os.getenv("BROADCAST_RETRY_DELAY", 5))
+
 # To'lov karta raqami
 PAYMENT_CARD = "4790920024921400"
 
@@ -45,8 +224,182 @@ else:
     logger.info(f"BOT_TOKEN yuklandi: {BOT_TOKEN[:5]}...{BOT_TOKEN[-5:]}")
 
 
+# ==================== CHIQUVCHI NAVBAT ====================
+class TokenBucket:
+    """Token-bucket cheklagich: soniyasiga rate ta so'rov, ketma-ket ko'pi bilan capacity ta"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """RetryAfter kelganda barcha so'rovlarni to'xtatib turish"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._updated = self._paused_until
+        # Pauza tugagach bitta so'rovga darhol ruxsat beriladi
+        self._tokens = 1
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Navbat ustuvorliklari: kichik qiymat oldin yuboriladi
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTIFICATION = 1
+PRIORITY_BROADCAST = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_NOTIFICATION: 'notification', PRIORITY_BROADCAST: 'broadcast'}
+
+# Joriy kontekstdagi so'rovlar qaysi navbatga tushishi (handler javoblari - interactive)
+send_priority = contextvars.ContextVar('send_priority', default=PRIORITY_INTERACTIVE)
+
+
+@contextlib.contextmanager
+def outbound_lane(priority):
+    """Blok ichidagi yuborishlarni berilgan ustuvorlikdagi navbatga yo'naltirish"""
+    token = send_priority.set(priority)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+# Telegram xabar chegaralariga kiradigan metodlar
+OUTBOUND_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendVideo', 'sendAudio', 'sendVoice', 'sendAnimation',
+    'sendSticker', 'sendMediaGroup', 'sendLocation', 'sendContact', 'copyMessage', 'forwardMessage',
+    'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup', 'editMessageMedia',
+}
+
+
+class OutboundQueue:
+    """Chiquvchi so'rovlar navbati.
+
+    Har bir so'rov avval o'z chatining chegarasini (OUTBOUND_CHAT_RATE), keyin
+    umumiy chegarani kutadi. Umumiy chegarada navbat ustuvorlik bo'yicha beriladi:
+    interactive -> notification -> broadcast. RetryAfter kelsa faqat shu chat
+    to'xtatiladi (chatsiz so'rov yoki qisqa vaqtda bir nechta chat 429 olsa -
+    umumiy cheklagich ham) va so'rov qayta navbatga qo'yiladi.
+    """
+
+    def __init__(self, rate, chat_rate, chat_burst, max_chats):
+        self.global_bucket = TokenBucket(rate, max(1, int(rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self.depth = Counter()
+        self.sent = Counter()
+        self.retry_after = 0
+        self._flooded = deque()  # (monotonic vaqt, chat_id) - oxirgi chat 429 lari
+
+    def _is_global_flood(self, chat_id):
+        """Chat 429 ni qayd qilish. OUTBOUND_FLOOD_WINDOW ichida OUTBOUND_FLOOD_CHATS ta turli chat bo'lsa True"""
+        now = time.monotonic()
+        self._flooded.append((now, chat_id))
+        while self._flooded and now - self._flooded[0][0] > OUTBOUND_FLOOD_WINDOW:
+            self._flooded.popleft()
+        return len({flooded_chat for _, flooded_chat in self._flooded}) >= OUTBOUND_FLOOD_CHATS
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _dispatch(self):
+        """Umumiy cheklagich ruxsat bergan sari eng ustuvor kutayotgan so'rovni o'tkazish"""
+        while self._waiters:
+            await self.global_bucket.acquire()
+            while self._waiters:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
+        self._dispatcher = None
+
+    async def _global_turn(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def call(self, chat_id, priority, request):
+        """request() ni chegaralarga rioya qilib bajarish"""
+        lane = PRIORITY_NAMES[priority]
+        retries = 0
+        while True:
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+            self.depth[lane] += 1
+            try:
+                if bucket is not None:
+                    await bucket.acquire()
+                await self._global_turn(priority)
+            finally:
+                self.depth[lane] -= 1
+            try:
+                result = await request()
+                self.sent[lane] += 1
+                return result
+            except RetryAfter as e:
+                self.retry_after += 1
+                retries += 1
+                logger.warning(f"Outbound: RetryAfter {e.timeout}s (chat {chat_id}, {lane})")
+                if bucket is not None:
+                    bucket.pause(e.timeout)
+                if bucket is None or self._is_global_flood(chat_id):
+                    self.global_bucket.pause(e.timeout)
+                if retries > OUTBOUND_MAX_RETRIES:
+                    raise
+
+    def metrics_text(self):
+        """Prometheus matn formatidagi ko'rsatkichlar"""
+        lines = []
+        for name in PRIORITY_NAMES.values():
+            lines.append(f'outbound_queue_depth{{lane="{name}"}} {self.depth[name]}')
+        for name in PRIORITY_NAMES.values():
+            lines.append(f'outbound_sent_total{{lane="{name}"}} {self.sent[name]}')
+        lines.append(f'outbound_retry_after_total {self.retry_after}')
+        lines.append(f'outbound_tracked_chats {len(self._chats)}')
+        return '\n'.join(lines) + '\n'
+
+
+outbound_queue = OutboundQueue(OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_CHAT_BUCKETS)
+
+
+class QueuedBot(Bot):
+    """Xabar yuborish va tahrirlash so'rovlarini outbound_queue orqali bajaradigan Bot"""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if method not in OUTBOUND_METHODS:
+            return await super().request(method, data, files, **kwargs)
+        request = functools.partial(super().request, method, data, files, **kwargs)
+        return await outbound_queue.call((data or {}).get('chat_id'), send_priority.get(), request)
+
+
 # Bot va Dispatcher yaratish
-bot = Bot(token=BOT_TOKEN)
+bot = QueuedBot(token=BOT_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
@@ -67,6 +420,7 @@ class AdminStates(StatesGroup):
     waiting_topup_amount = State()
     waiting_referral_amount = State()
     waiting_reject_reason = State()
+    waiting_user_search = State()
 
 
 class BotCreationStates(StatesGroup):
@@ -77,121 +431,469 @@ class RegistrationStates(StatesGroup):
     waiting_name = State()
 
 
-class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-        self.init_db()
+# ==================== MIGRATSIYALAR ====================
+def add_missing_columns(cursor, table, columns):
+    """Jadvalda yo'q ustunlarni qo'shish (eski bazalar uchun)"""
+    existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+    for column in columns:
+        if column.split()[0] not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+
+
+def migrate_initial_schema(cursor):
+    # Foydalanuvchilar jadvali
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            phone_number TEXT,
+            balance REAL DEFAULT 0,
+            referral_code TEXT UNIQUE,
+            referred_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            referral_bonus_paid INTEGER DEFAULT 0
+        )
+    ''')
+    add_missing_columns(cursor, 'users', ['full_name TEXT', 'phone_number TEXT', 'referral_bonus_paid INTEGER DEFAULT 0'])
+
+    # Majburiy obunalar
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS mandatory_subscriptions (
+            channel_id TEXT PRIMARY KEY,
+            channel_username TEXT,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Botlar
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bots (
+            bot_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_name TEXT,
+            bot_file_path TEXT,
+            run_command TEXT,
+            price REAL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    add_missing_columns(cursor, 'bots', ['run_command TEXT'])
+
+    # Foydalanuvchi botlari
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_bots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            bot_token TEXT,
+            bot_id INTEGER,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            payment_date TIMESTAMP,
+            days_left INTEGER DEFAULT 30,
+            FOREIGN KEY (bot_id) REFERENCES bots(bot_id)
+        )
+    ''')
+    # Oylik to'lov ustunlari
+    add_missing_columns(cursor, 'user_bots', ['payment_date TIMESTAMP', 'days_left INTEGER DEFAULT 30'])
+
+    # To'lovlar
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount REAL,
+            screenshot_path TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Banned foydalanuvchilar
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS banned_users (
+            user_id INTEGER PRIMARY KEY,
+            banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            reason TEXT
+        )
+    ''')
 
-    def init_db(self):
-        cursor = self.conn.cursor()
+    # Sozlamalar
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+    # Default referral summasi
+    cursor.execute('''
+        INSERT OR IGNORE INTO settings (key, value) VALUES ('referral_amount', ?)
+    ''', (str(DEFAULT_REFERRAL_AMOUNT),))
+
+
+def migrate_indexes(cursor):
+    """DB_INDEXES dagi indekslarni yaratish va eskirganlarini o'chirish"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx\\_%' ESCAPE '\\'")
+    for (name,) in cursor.fetchall():
+        if name not in DB_INDEXES:
+            cursor.execute(f'DROP INDEX IF EXISTS {name}')
+    # Jadvali yoki ustuni keyingi migratsiyada yaratiladigan indekslar o'sha migratsiyada qo'shiladi
+    tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for name, (table, columns) in DB_INDEXES.items():
+        if table not in tables:
+            continue
+        existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+        if all(column.strip() in existing for column in columns.split(',')):
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})')
+
+
+def migrate_channel_members(cursor):
+    # Majburiy kanallar a'zoligi (chat_member update lari va backfill orqali to'ldiriladi)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS channel_members (
+            user_id INTEGER,
+            channel_id TEXT,
+            status TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, channel_id)
+        ) WITHOUT ROWID
+    ''')
+    migrate_indexes(cursor)
+
+
+def migrate_broadcasts(cursor):
+    # Ommaviy xabarlar: qayta ishga tushganda last_user_id dan davom ettiriladi
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id INTEGER,
+            progress_message_id INTEGER,
+            text TEXT,
+            status TEXT DEFAULT 'running',
+            last_user_id INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    migrate_indexes(cursor)
 
-        # Foydalanuvchilar jadvali
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                full_name TEXT,
-                phone_number TEXT,
-                balance REAL DEFAULT 0,
-                referral_code TEXT UNIQUE,
-                referred_by INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
 
-        # Qo'shimcha ustunlar qo'shish
-        for col in ['full_name TEXT', 'phone_number TEXT', 'referral_bonus_paid INTEGER DEFAULT 0']:
-            try:
-                cursor.execute(f'ALTER TABLE users ADD COLUMN {col}')
-            except sqlite3.OperationalError:
-                pass
+def migrate_user_reachability(cursor):
+    # Botni bloklagan / chatni o'chirgan foydalanuvchilarga xabar yuborilmaydi
+    add_missing_columns(cursor, 'users', ['is_reachable INTEGER DEFAULT 1'])
 
-        # Majburiy obunalar
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS mandatory_subscriptions (
-                channel_id TEXT PRIMARY KEY,
-                channel_username TEXT,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
 
-        # Botlar
+def migrate_users_fts(cursor):
+    # Admin qidiruvi uchun FTS5 indeksi; users o'zgarganda triggerlar orqali yangilanadi
+    try:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bots (
-                bot_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                bot_name TEXT,
-                bot_file_path TEXT,
-                run_command TEXT,
-                price REAL,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                full_name, username, phone_number, content='users', content_rowid='user_id'
             )
         ''')
-        try:
-            cursor.execute('ALTER TABLE bots ADD COLUMN run_command TEXT')
-        except sqlite3.OperationalError:
-            pass
+    except sqlite3.OperationalError as e:
+        # FTS5 siz SQLite: search_users LIKE orqali qidiradi
+        logger.warning(f"FTS5 mavjud emas, foydalanuvchilar qidiruvi LIKE bilan ishlaydi: {e}")
+        return
+    # executescript ishlatilmaydi: u COMMIT qiladi va init_db dagi migratsiya tranzaksiyasini bo'lib yuboradi
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, full_name, username, phone_number)
+            VALUES (new.user_id, new.full_name, new.username, new.phone_number);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, full_name, username, phone_number)
+            VALUES ('delete', old.user_id, old.full_name, old.username, old.phone_number);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF full_name, username, phone_number ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, full_name, username, phone_number)
+            VALUES ('delete', old.user_id, old.full_name, old.username, old.phone_number);
+            INSERT INTO users_fts (rowid, full_name, username, phone_number)
+            VALUES (new.user_id, new.full_name, new.username, new.phone_number);
+        END
+    ''')
+    cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+
+def migrate_referral_stats(cursor):
+    # Referallar soni va ishlangan bonuslar users da saqlanadi (create_user / pay_referral_bonus yangilaydi)
+    add_missing_columns(cursor, 'users', ['referrals_count INTEGER DEFAULT 0', 'referral_earned REAL DEFAULT 0'])
+    cursor.execute('''
+        UPDATE users SET referrals_count = (SELECT COUNT(*) FROM users r WHERE r.referred_by = users.user_id)
+    ''')
+    # Oldingi bonuslar summasi saqlanmagan: joriy referral summasi bilan taxminan hisoblanadi
+    cursor.execute("SELECT value FROM settings WHERE key = 'referral_amount'")
+    row = cursor.fetchone()
+    try:
+        amount = float(row[0]) if row and row[0] else DEFAULT_REFERRAL_AMOUNT
+    except ValueError:
+        amount = DEFAULT_REFERRAL_AMOUNT
+    cursor.execute('''
+        UPDATE users SET referral_earned = ? * (
+            SELECT COUNT(*) FROM users r WHERE r.referred_by = users.user_id AND r.referral_bonus_paid = 1
+        )
+    ''', (amount,))
+
+    # Referral daraxti: ancestor_id ning depth-darajali referali descendant_id
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS referral_closure (
+            ancestor_id INTEGER,
+            descendant_id INTEGER,
+            depth INTEGER,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO referral_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE chain(ancestor_id, descendant_id, depth) AS (
+            SELECT referred_by, user_id, 1 FROM users WHERE referred_by IS NOT NULL
+            UNION ALL
+            SELECT u.referred_by, c.descendant_id, c.depth + 1
+            FROM chain c JOIN users u ON u.user_id = c.ancestor_id
+            WHERE u.referred_by IS NOT NULL AND c.depth < ?
+        )
+        SELECT ancestor_id, descendant_id, depth FROM chain
+    ''', (REFERRAL_MAX_DEPTH,))
+    migrate_indexes(cursor)
+
+
+def migrate_ledger(cursor):
+    # Balansning har bir o'zgarishi yoziladigan jurnal. Faqat qo'shiladi: UPDATE/DELETE taqiqlangan
+    # executescript ishlatilmaydi: u COMMIT qiladi va migratsiya tranzaksiyasini bo'lib yuboradi
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount REAL,
+            balance_after REAL,
+            kind TEXT,
+            ref_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON ledger BEGIN
+            SELECT RAISE(ABORT, 'ledger faqat qo''shiladi');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON ledger BEGIN
+            SELECT RAISE(ABORT, 'ledger faqat qo''shiladi');
+        END
+    ''')
+    migrate_indexes(cursor)
+
+
+def migrate_user_bot_processes(cursor):
+    # Supervizor ma'lumotlari: ishlayotgan jarayon PID i va oxirgi chiqish kodi
+    add_missing_columns(cursor, 'user_bots', ['pid INTEGER', 'last_exit_code INTEGER', 'restart_count INTEGER DEFAULT 0'])
+
+
+def migrate_provision_jobs(cursor):
+    # Bot yaratish navbati: bot to'xtasa tugallanmagan ishlar qayta ishga tushganda davom ettiriladi
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS provision_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            bot_id INTEGER,
+            bot_token TEXT,
+            price REAL,
+            chat_id INTEGER,
+            message_id INTEGER,
+            user_bot_dir TEXT,
+            status TEXT DEFAULT 'queued',
+            error TEXT,
+            user_bot_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    migrate_indexes(cursor)
+
+
+def migrate_template_store(cursor):
+    # Ombordagi shablon (template_store/templates/<hash>.json). NULL bo'lsa birinchi xaridda to'ldiriladi
+    add_missing_columns(cursor, 'bots', ['template_hash TEXT'])
+
+
+def migrate_bot_launch(cursor):
+    # Shablon yuklanganda aniqlangan ishga tushirish buyrug'i: JSON argv va bot papkasiga nisbatan cwd
+    add_missing_columns(cursor, 'bots', ['run_argv TEXT', 'run_cwd TEXT'])
+
+
+def migrate_user_bot_paths(cursor):
+    # Bot papkasi va log fayli yozuvda saqlanadi: tugmalar user_bots/ papkasini skanerlamaydi
+    add_missing_columns(cursor, 'user_bots', ['instance_dir TEXT', 'log_path TEXT'])
+    # Navbat orqali yaratilgan botlarning papkasi provision_jobs da bor
+    cursor.execute('''
+        UPDATE user_bots SET instance_dir = (
+            SELECT user_bot_dir FROM provision_jobs WHERE provision_jobs.user_bot_id = user_bots.id
+        ) WHERE instance_dir IS NULL
+    ''')
+    # Qolganlari uchun user_bots/bot_<user>_<bot>_<vaqt> papkalari bir marta skanerlanadi.
+    # Bitta shablondan bir nechta bot bo'lsa yozuvlar va papkalar yaratilish tartibida juftlanadi
+    dirs = {}
+    with contextlib.suppress(FileNotFoundError):
+        for name in os.listdir(USER_BOTS_DIR):
+            match = re.fullmatch(r'bot_(\d+)_(\d+)_(\d+)', name)
+            if match:
+                key = (int(match.group(1)), int(match.group(2)))
+                dirs.setdefault(key, []).append((int(match.group(3)), os.path.abspath(os.path.join(USER_BOTS_DIR, name))))
+    cursor.execute('''
+        SELECT id, user_id, bot_id FROM user_bots WHERE instance_dir IS NULL ORDER BY created_at, id
+    ''')
+    pending = {}
+    for user_bot_id, user_id, bot_id in cursor.fetchall():
+        pending.setdefault((user_id, bot_id), []).append(user_bot_id)
+    claimed = {row[0] for row in cursor.execute('SELECT instance_dir FROM user_bots WHERE instance_dir IS NOT NULL')}
+    for key, user_bot_ids in pending.items():
+        free = [path for _, path in sorted(dirs.get(key, [])) if path not in claimed]
+        # Papkalar kam bo'lsa eng oxirgilari eng oxirgi yozuvlarga beriladi (eski papkalar o'chirilgan bo'lishi mumkin)
+        for user_bot_id, path in zip(reversed(user_bot_ids), reversed(free)):
+            cursor.execute('UPDATE user_bots SET instance_dir = ? WHERE id = ?', (path, user_bot_id))
+    cursor.execute(
+        "UPDATE user_bots SET log_path = instance_dir || ? WHERE instance_dir IS NOT NULL AND log_path IS NULL",
+        (os.sep + BOT_LOG_FILE,)
+    )
 
-        # Foydalanuvchi botlari
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_bots (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                bot_token TEXT,
-                bot_id INTEGER,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                payment_date TIMESTAMP,
-                days_left INTEGER DEFAULT 30,
-                FOREIGN KEY (bot_id) REFERENCES bots(bot_id)
-            )
-        ''')
-        
-        # Oylik to'lov ustunlarini qo'shish
-        for col in ['payment_date TIMESTAMP', 'days_left INTEGER DEFAULT 30']:
-            try:
-                cursor.execute(f'ALTER TABLE user_bots ADD COLUMN {col}')
-            except sqlite3.OperationalError:
-                pass
 
-        # To'lovlar
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount REAL,
-                screenshot_path TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Banned foydalanuvchilar
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS banned_users (
-                user_id INTEGER PRIMARY KEY,
-                banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                reason TEXT
-            )
-        ''')
+def migrate_reachable_index(cursor):
+    # Broadcast qabul qiluvchilar sonini (is_reachable = 1) skansiz hisoblash uchun
+    migrate_indexes(cursor)
 
-        # Sozlamalar
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
 
-        # Default referral summasi
-        cursor.execute('''
-            INSERT OR IGNORE INTO settings (key, value) VALUES ('referral_amount', ?)
-        ''', (str(DEFAULT_REFERRAL_AMOUNT),))
+# Tartib muhim: N-element qo'llangandan keyin PRAGMA user_version = N+1 bo'ladi.
+# Mavjud qadamlarni o'zgartirmang, faqat oxiriga yangisini qo'shing
+MIGRATIONS = [
+    migrate_initial_schema,
+    migrate_indexes,
+    migrate_channel_members,
+    migrate_broadcasts,
+    migrate_user_reachability,
+    migrate_users_fts,
+    migrate_referral_stats,
+    migrate_ledger,
+    migrate_user_bot_processes,
+    migrate_provision_jobs,
+    migrate_template_store,
+    migrate_bot_launch,
+    migrate_user_bot_paths,
+    migrate_reachable_index,
+]
+
+
+def reader(method):
+    """Faqat o'qiydigan Database metodini belgilash (read-only ulanishlar pulida bajariladi)"""
+    method.db_reader = True
+    return method
+
+
+def background(method):
+    """Uzoq ishlaydigan, o'z ulanishini ochadigan metodni belgilash (umumiy thread pool da bajariladi)"""
+    method.db_background = True
+    return method
+
+
+class Database:
+    def __init__(self, path=DB_NAME):
+        self.path = path
+        self._local = threading.local()
+        self._readers = []
+        self.group_commit = False
+        self.pending_writes = 0
+        self.conn = self._connect()
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.init_db()
+
+    def _connect(self, readonly=False):
+        if readonly:
+            uri = pathlib.Path(self.path).absolute().as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma, value in DB_PRAGMAS.items():
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        return conn
+
+    def _bind_writer_thread(self):
+        # Yozuvchi oqimdagi o'qishlar commit qilinmagan yozuvlarni ham ko'rishi uchun
+        self._local.conn = self.conn
+
+    def commit(self):
+        """Yozuvni tasdiqlash (group-commit rejimida keyingi guruh commitiga qoldiriladi)"""
+        if self.group_commit:
+            self.pending_writes += 1
+        else:
+            self.conn.commit()
+
+    @contextlib.contextmanager
+    def atomic(self):
+        """Blokdagi yozuvlar bir butun: xatolikda faqat shu blok bekor qilinadi (savepoint).
+
+        Oddiy rollback group-commit dagi boshqa metodlarning kutilayotgan yozuvlarini ham o'chirib yuborardi.
+        """
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN')
+        self.conn.execute('SAVEPOINT atomic')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK TO atomic')
+            self.conn.execute('RELEASE atomic')
+            raise
+        self.conn.execute('RELEASE atomic')
+
+    def flush(self):
+        """Kutilayotgan yozuvlarni bitta commit bilan diskka yozish"""
+        self.pending_writes = 0
+        if self.conn.in_transaction:
+            self.conn.commit()
+
+    def reader_conn(self):
+        """Joriy oqimning read-only ulanishi (birinchi murojaatda ochiladi)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect(readonly=True)
+            self._local.conn = conn
+            self._readers.append(conn)
+        return conn
+
+    def close(self):
+        for conn in self._readers:
+            conn.close()
+        self.conn.close()
+
+    def init_db(self):
+        """Bajarilmagan sxema migratsiyalarini bitta tranzaksiyada qo'llash"""
+        cursor = self.conn.cursor()
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(MIGRATIONS):
+            return
 
-        self.conn.commit()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            # Boshqa jarayon bizdan oldin migratsiya qilgan bo'lishi mumkin
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            for migration in MIGRATIONS[version:]:
+                migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        logger.info(f"DB migratsiya: {version} -> {len(MIGRATIONS)}")
 
     # ==================== FOYDALANUVCHI ====================
+    @reader
     def get_user(self, user_id):
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
         return cursor.fetchone()
 
@@ -202,47 +904,114 @@ class Database:
                 INSERT INTO users (user_id, username, full_name, phone_number, referral_code, referred_by)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (user_id, username, full_name, phone_number, referral_code, referred_by))
-            self.conn.commit()
-            return True
         except sqlite3.IntegrityError:
             return False
+        if referred_by:
+            # Referral hisoblagichi va daraxti foydalanuvchi bilan bitta tranzaksiyada yoziladi
+            cursor.execute('UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id = ?', (referred_by,))
+            cursor.execute('''
+                INSERT OR IGNORE INTO referral_closure (ancestor_id, descendant_id, depth)
+                SELECT ?, ?, 1
+                UNION ALL
+                SELECT ancestor_id, ?, depth + 1 FROM referral_closure WHERE descendant_id = ? AND depth < ?
+            ''', (referred_by, user_id, user_id, referred_by, REFERRAL_MAX_DEPTH))
+        self.commit()
+        return True
+
+    @reader
+    def get_user_context(self, user_id):
+        """Foydalanuvchi qatori, ban holati va balansini bitta so'rovda olish"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute('''
+            SELECT u.user_id, u.username, u.full_name, u.phone_number, u.balance,
+                   u.referral_code, u.referred_by, u.referral_bonus_paid, u.is_reachable,
+                   u.referrals_count, u.referral_earned,
+                   EXISTS(SELECT 1 FROM banned_users b WHERE b.user_id = id)
+            FROM (SELECT ? AS id)
+            LEFT JOIN users u ON u.user_id = id
+        ''', (user_id,))
+        return cursor.fetchone()
+
+    def update_user_fields(self, user_id, fields):
+        """Foydalanuvchi ustunlarini bitta UPDATE bilan yangilash"""
+        for name in fields:
+            if name not in USER_CONTEXT_FIELDS:
+                raise ValueError(f"Noma'lum ustun: {name}")
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        cursor = self.conn.cursor()
+        cursor.execute(f'UPDATE users SET {columns} WHERE user_id = ?', (*fields.values(), user_id))
+        self.commit()
 
     def update_user_name(self, user_id, full_name):
         cursor = self.conn.cursor()
         cursor.execute('UPDATE users SET full_name = ? WHERE user_id = ?', (full_name, user_id))
-        self.conn.commit()
+        self.commit()
 
     def update_user_phone(self, user_id, phone_number):
         cursor = self.conn.cursor()
         cursor.execute('UPDATE users SET phone_number = ? WHERE user_id = ?', (phone_number, user_id))
-        self.conn.commit()
+        self.commit()
 
+    @reader
     def get_user_name(self, user_id):
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT full_name FROM users WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()
         return result[0] if result and result[0] else None
 
+    @reader
     def get_user_phone(self, user_id):
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT phone_number FROM users WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()
         return result[0] if result and result[0] else None
 
-    def update_balance(self, user_id, amount):
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
-        self.conn.commit()
+    # Balans faqat quyidagi metodlar orqali o'zgaradi: har biri bitta shartli UPDATE ... RETURNING
+    # va ledger yozuvi, ikkalasi bitta atomic() blokida. Yangi balansni (yoki None) qaytaradi.
+    def _add_ledger(self, cursor, user_id, amount, balance_after, kind, ref_id):
+        cursor.execute('''
+            INSERT INTO ledger (user_id, amount, balance_after, kind, ref_id) VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, amount, balance_after, kind, ref_id))
 
+    def _credit(self, cursor, user_id, amount, kind, ref_id):
+        cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ? RETURNING balance', (amount, user_id))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        self._add_ledger(cursor, user_id, amount, row[0], kind, ref_id)
+        return float(row[0])
+
+    def credit_balance(self, user_id, amount, kind, ref_id=None):
+        """Balansga qo'shish. Foydalanuvchi topilmasa None"""
+        with self.atomic():
+            balance = self._credit(self.conn.cursor(), user_id, amount, kind, ref_id)
+        self.commit()
+        return balance
+
+    def debit_balance(self, user_id, amount, kind, ref_id=None):
+        """Balansdan yechish. Mablag' yetmasa None (balans o'zgarmaydi)"""
+        with self.atomic():
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ? RETURNING balance
+            ''', (amount, user_id, amount))
+            row = cursor.fetchone()
+            if row is not None:
+                self._add_ledger(cursor, user_id, -amount, row[0], kind, ref_id)
+        self.commit()
+        return float(row[0]) if row else None
+
+    @reader
     def get_balance(self, user_id):
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()
         return float(result[0]) if result and result[0] is not None else 0.0
 
     # ==================== REFERRAL ====================
+    @reader
     def get_referral_amount(self):
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT value FROM settings WHERE key = ?', ('referral_amount',))
         result = cursor.fetchone()
         if result and result[0]:
@@ -257,7 +1026,15 @@ class Database:
         cursor.execute('''
             INSERT OR REPLACE INTO settings (key, value) VALUES ('referral_amount', ?)
         ''', (str(amount),))
-        self.conn.commit()
+        self.commit()
+
+    @reader
+    def get_user_id_by_referral_code(self, referral_code):
+        """Referral kod bo'yicha foydalanuvchi ID sini olish"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (referral_code,))
+        result = cursor.fetchone()
+        return result[0] if result else None
 
     def get_referral_code(self, user_id):
         cursor = self.conn.cursor()
@@ -267,37 +1044,74 @@ class Database:
             return result[0]
         code = f"REF{user_id}"
         cursor.execute('UPDATE users SET referral_code = ? WHERE user_id = ?', (code, user_id))
-        self.conn.commit()
+        self.commit()
         return code
 
+    @reader
     def get_referrals_count(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM users WHERE referred_by = ?', (user_id,))
+        cursor = self.reader_conn().cursor()
+        cursor.execute('SELECT referrals_count FROM users WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()
         return result[0] if result else 0
 
+    @reader
+    def get_referral_levels(self, user_id):
+        """Har bir daraja bo'yicha referallar soni: [(depth, count), ...]"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute('''
+            SELECT depth, COUNT(*) FROM referral_closure WHERE ancestor_id = ? GROUP BY depth ORDER BY depth
+        ''', (user_id,))
+        return cursor.fetchall()
+
+    @reader
+    def get_referral_leaderboard(self, limit):
+        """Eng ko'p referal chaqirgan foydalanuvchilar"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute('''
+            SELECT user_id, full_name, username, referrals_count, referral_earned FROM users
+            WHERE referrals_count > 0 ORDER BY referrals_count DESC LIMIT ?
+        ''', (limit,))
+        return cursor.fetchall()
+
+    @reader
     def is_referral_bonus_paid(self, user_id):
         """Referral bonus berilganini tekshirish"""
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT referral_bonus_paid FROM users WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()
         if result and len(result) > 0:
             return bool(result[0])
         return False
 
-    def mark_referral_bonus_paid(self, user_id):
-        """Referral bonus berilganini belgilash"""
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE users SET referral_bonus_paid = 1 WHERE user_id = ?', (user_id,))
-        self.conn.commit()
-
+    def pay_referral_bonus(self, user_id, referred_by, amount):
+        """Bonusni bir marta berish: belgi, balans, referral_earned va ledger bitta tranzaksiyada.
+
+        Referral bergan foydalanuvchining yangi balansini, bonus avval berilgan bo'lsa None qaytaradi.
+        """
+        with self.atomic():
+            cursor = self.conn.cursor()
+            cursor.execute('UPDATE users SET referral_bonus_paid = 1 WHERE user_id = ? AND referral_bonus_paid = 0', (user_id,))
+            row = None
+            if cursor.rowcount > 0:
+                cursor.execute('''
+                    UPDATE users SET balance = balance + ?, referral_earned = referral_earned + ? WHERE user_id = ?
+                    RETURNING balance
+                ''', (amount, amount, referred_by))
+                row = cursor.fetchone()
+                if row is not None:
+                    self._add_ledger(cursor, referred_by, amount, row[0], 'referral_bonus', user_id)
+        self.commit()
+        return float(row[0]) if row else None
+
+    @reader
     def get_user_bots(self, user_id):
         """Foydalanuvchi yaratgan botlarni olish"""
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('''
             SELECT ub.id, ub.user_id, ub.bot_token, ub.bot_id, ub.status, ub.created_at,
                    ub.payment_date, ub.days_left,
-                   b.bot_name, b.bot_file_path, b.run_command, b.price
+                   b.bot_name, b.bot_file_path, b.run_command, b.price,
+                   ub.instance_dir, ub.log_path, ub.pid
             FROM user_bots ub
             LEFT JOIN bots b ON ub.bot_id = b.bot_id
             WHERE ub.user_id = ?
@@ -305,35 +1119,69 @@ class Database:
         ''', (user_id,))
         return cursor.fetchall()
 
+    @reader
     def get_user_bot(self, user_bot_id):
         """Foydalanuvchi botini ID bo'yicha olish"""
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('''
             SELECT ub.id, ub.user_id, ub.bot_token, ub.bot_id, ub.status, ub.created_at,
                    ub.payment_date, ub.days_left,
-                   b.bot_name, b.bot_file_path, b.run_command, b.price
+                   b.bot_name, b.bot_file_path, b.run_command, b.price,
+                   ub.instance_dir, ub.log_path, ub.pid
             FROM user_bots ub
             LEFT JOIN bots b ON ub.bot_id = b.bot_id
             WHERE ub.id = ?
         ''', (user_bot_id,))
         return cursor.fetchone()
 
+    @reader
+    def get_last_user_bot_log(self, user_id):
+        """Foydalanuvchining oxirgi boti: (id, log_path) yoki None"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute('SELECT id, log_path FROM user_bots WHERE user_id = ? ORDER BY id DESC LIMIT 1', (user_id,))
+        return cursor.fetchone()
+
     def update_user_bot_status(self, user_bot_id, status):
         """Foydalanuvchi bot statusini yangilash"""
         cursor = self.conn.cursor()
         cursor.execute('UPDATE user_bots SET status = ? WHERE id = ?', (status, user_bot_id))
-        self.conn.commit()
+        self.commit()
+
+    def set_user_bot_process(self, user_bot_id, pid):
+        """Bot jarayoni ishga tushdi"""
+        cursor = self.conn.cursor()
+        cursor.execute("UPDATE user_bots SET pid = ?, status = 'active' WHERE id = ?", (pid, user_bot_id))
+        self.commit()
+
+    def record_user_bot_exit(self, user_bot_id, exit_code, status, restarted=False):
+        """Bot jarayoni tugadi: PID tozalanadi, chiqish kodi va holat yoziladi"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            UPDATE user_bots SET pid = NULL, last_exit_code = ?, status = ?, restart_count = restart_count + ?
+            WHERE id = ?
+        ''', (exit_code, status, int(restarted), user_bot_id))
+        self.commit()
+
+    @reader
+    def get_active_user_bots(self):
+        """Ishlashi kerak bo'lgan botlar (supervizor ishga tushganda tekshiriladi)"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute("SELECT id, user_id, bot_id, bot_token, pid, instance_dir FROM user_bots WHERE status = 'active'")
+        return cursor.fetchall()
 
     def delete_user_bot(self, user_bot_id):
         """Foydalanuvchi botini o'chirish"""
         cursor = self.conn.cursor()
         cursor.execute('DELETE FROM user_bots WHERE id = ?', (user_bot_id,))
-        self.conn.commit()
+        self.commit()
 
     # ==================== BOTLAR ====================
+    @reader
     def get_bots(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM bots')
+        cursor = self.reader_conn().cursor()
+        cursor.execute('''
+            SELECT bot_id, bot_name, bot_file_path, run_command, price, added_at, template_hash, run_argv, run_cwd FROM bots
+        ''')
         rows = cursor.fetchall()
         result = []
         for row in rows:
@@ -342,8 +1190,9 @@ class Database:
             result.append(tuple(row_list))
         return result
 
+    @reader
     def get_bot(self, bot_id):
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT * FROM bots WHERE bot_id = ?', (bot_id,))
         row = cursor.fetchone()
         if row:
@@ -352,21 +1201,36 @@ class Database:
             return tuple(row_list)
         return None
 
-    def add_bot(self, bot_name, bot_file_path, run_command, price):
+    def add_bot(self, bot_name, bot_file_path, run_command, price, template_hash=None, run_argv=None, run_cwd=None):
         cursor = self.conn.cursor()
         cursor.execute('''
-            INSERT INTO bots (bot_name, bot_file_path, run_command, price)
-            VALUES (?, ?, ?, ?)
-        ''', (bot_name, bot_file_path, run_command, price))
-        self.conn.commit()
+            INSERT INTO bots (bot_name, bot_file_path, run_command, price, template_hash, run_argv, run_cwd)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (bot_name, bot_file_path, run_command, price, template_hash, run_argv, run_cwd))
+        self.commit()
         return cursor.lastrowid
 
+    def set_bot_launch(self, bot_id, run_argv, run_cwd):
+        cursor = self.conn.cursor()
+        cursor.execute('UPDATE bots SET run_argv = ?, run_cwd = ? WHERE bot_id = ?', (run_argv, run_cwd, bot_id))
+        self.commit()
+
+    def set_bot_template_hash(self, bot_id, template_hash):
+        cursor = self.conn.cursor()
+        cursor.execute('UPDATE bots SET template_hash = ? WHERE bot_id = ?', (template_hash, bot_id))
+        self.commit()
+
+    def delete_bot(self, bot_id):
+        cursor = self.conn.cursor()
+        cursor.execute('DELETE FROM bots WHERE bot_id = ?', (bot_id,))
+        self.commit()
+
     def add_user_bot(self, user_id, bot_token, bot_id):
         cursor = self.conn.cursor()
         cursor.execute('''
             INSERT INTO user_bots (user_id, bot_token, bot_id) VALUES (?, ?, ?)
         ''', (user_id, bot_token, bot_id))
-        self.conn.commit()
+        self.commit()
         return cursor.lastrowid
 
     def add_payment(self, user_id, amount, screenshot_path):
@@ -374,23 +1238,53 @@ class Database:
         cursor.execute('''
             INSERT INTO payments (user_id, amount, screenshot_path) VALUES (?, ?, ?)
         ''', (user_id, amount, screenshot_path))
-        self.conn.commit()
+        self.commit()
         return cursor.lastrowid
 
     # ==================== STATISTIKA ====================
+    @reader
     def get_total_users(self):
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT COUNT(*) FROM users')
         result = cursor.fetchone()
         return result[0] if result else 0
 
-    def get_all_users(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT user_id, username, full_name, phone_number, balance, referral_code, referred_by, created_at FROM users ORDER BY created_at DESC')
-        return cursor.fetchall()
+    @background
+    def export_users(self, path, columns, date_from=None, date_to=None, delimiter=','):
+        """Foydalanuvchilarni gzip CSV/TSV faylga bo'laklab yozish. Yozilgan qatorlar sonini qaytaradi.
+
+        date_from/date_to - 'YYYY-MM-DD' (date_to kuni ham kiradi).
+        """
+        conditions, params = [], []
+        if date_from:
+            conditions.append('created_at >= ?')
+            params.append(date_from)
+        if date_to:
+            conditions.append("created_at < date(?, '+1 day')")
+            params.append(date_to)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        select = ', '.join(USER_EXPORT_COLUMNS[name] for name in columns)
+
+        conn = self._connect(readonly=True)
+        count = 0
+        try:
+            cursor = conn.execute(f'SELECT {select} FROM users {where} ORDER BY created_at, user_id', params)
+            with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f, delimiter=delimiter)
+                writer.writerow(columns)
+                while True:
+                    rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                    if not rows:
+                        break
+                    writer.writerows(rows)
+                    count += len(rows)
+        finally:
+            conn.close()
+        return count
 
+    @reader
     def get_active_users(self, days=30):
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('''
             SELECT COUNT(DISTINCT user_id) FROM user_bots
             WHERE created_at >= datetime('now', ? || ' days')
@@ -398,15 +1292,17 @@ class Database:
         result = cursor.fetchone()
         return result[0] if result else 0
 
+    @reader
     def get_total_bots(self):
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT COUNT(*) FROM user_bots')
         result = cursor.fetchone()
         return result[0] if result else 0
 
     # ==================== OBUNALAR ====================
+    @reader
     def get_mandatory_subscriptions(self):
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT * FROM mandatory_subscriptions')
         return cursor.fetchall()
 
@@ -414,7 +1310,7 @@ class Database:
         cursor = self.conn.cursor()
         try:
             cursor.execute('INSERT INTO mandatory_subscriptions (channel_id, channel_username) VALUES (?, ?)', (channel_id, channel_username))
-            self.conn.commit()
+            self.commit()
             return True
         except sqlite3.IntegrityError:
             return False
@@ -422,31 +1318,81 @@ class Database:
     def remove_mandatory_subscription(self, channel_id):
         cursor = self.conn.cursor()
         cursor.execute('DELETE FROM mandatory_subscriptions WHERE channel_id = ?', (channel_id,))
-        self.conn.commit()
+        cursor.execute('DELETE FROM channel_members WHERE channel_id = ?', (channel_id,))
+        self.commit()
+
+    # ==================== KANAL A'ZOLARI ====================
+    @reader
+    def get_channel_memberships(self, user_id, max_age):
+        """Foydalanuvchining majburiy kanallardagi max_age soniyadan yangi holatlari: {channel_id: status}"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute('''
+            SELECT channel_id, status FROM channel_members WHERE user_id = ? AND updated_at >= datetime('now', ?)
+        ''', (user_id, f'-{int(max_age)} seconds'))
+        return dict(cursor.fetchall())
+
+    def delete_channel_member(self, channel_id, user_id):
+        cursor = self.conn.cursor()
+        cursor.execute('DELETE FROM channel_members WHERE user_id = ? AND channel_id = ?', (user_id, channel_id))
+        self.commit()
+
+    def set_channel_member(self, channel_id, user_id, status):
+        """Kanal a'zoligi holatini yozish"""
+        self.set_channel_members(channel_id, [(user_id, status)])
+
+    def set_channel_members(self, channel_id, members):
+        """Bir nechta a'zolik holatini yozish: members = [(user_id, status), ...]"""
+        cursor = self.conn.cursor()
+        cursor.executemany('''
+            INSERT INTO channel_members (user_id, channel_id, status) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, channel_id) DO UPDATE SET status = excluded.status, updated_at = CURRENT_TIMESTAMP
+        ''', [(user_id, channel_id, status) for user_id, status in members])
+        self.commit()
 
     # ==================== TO'LOVLAR ====================
+    @reader
     def get_pending_payments(self):
         """Kutilayotgan to'lovlarni olish"""
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT * FROM payments WHERE status = ? ORDER BY created_at DESC', ('pending',))
         return cursor.fetchall()
 
+    @reader
     def get_payment(self, payment_id):
         """To'lovni olish"""
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT * FROM payments WHERE id = ?', (payment_id,))
         return cursor.fetchone()
 
-    def update_payment_status(self, payment_id, status):
-        """To'lov holatini yangilash"""
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE payments SET status = ? WHERE id = ?', (status, payment_id))
-        self.conn.commit()
+    def approve_payment(self, payment_id):
+        """Kutilayotgan to'lovni tasdiqlash va balansga qo'shish (bitta tranzaksiya).
+
+        (user_id, amount, yangi balans) yoki to'lov allaqachon ko'rib chiqilgan bo'lsa None.
+        """
+        with self.atomic():
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE payments SET status = 'approved' WHERE id = ? AND status = 'pending' RETURNING user_id, amount
+            ''', (payment_id,))
+            row = cursor.fetchone()
+            if row is not None:
+                balance = self._credit(cursor, row[0], row[1], 'payment', payment_id)
+        self.commit()
+        return (row[0], row[1], balance) if row else None
+
+    def reject_payment(self, payment_id):
+        """Kutilayotgan to'lovni rad etish. To'lov allaqachon ko'rib chiqilgan bo'lsa False"""
+        with self.atomic():
+            cursor = self.conn.cursor()
+            cursor.execute("UPDATE payments SET status = 'rejected' WHERE id = ? AND status = 'pending'", (payment_id,))
+        self.commit()
+        return cursor.rowcount > 0
 
     # ==================== BANNED USERS ====================
+    @reader
     def is_banned(self, user_id):
         """Foydalanuvchi ban qilinganini tekshirish"""
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('SELECT * FROM banned_users WHERE user_id = ?', (user_id,))
         return cursor.fetchone() is not None
 
@@ -455,7 +1401,7 @@ class Database:
         cursor = self.conn.cursor()
         try:
             cursor.execute('INSERT INTO banned_users (user_id, reason) VALUES (?, ?)', (user_id, reason))
-            self.conn.commit()
+            self.commit()
             return True
         except sqlite3.IntegrityError:
             return False
@@ -464,7 +1410,7 @@ class Database:
         """Foydalanuvchini unban qilish"""
         cursor = self.conn.cursor()
         cursor.execute('DELETE FROM banned_users WHERE user_id = ?', (user_id,))
-        self.conn.commit()
+        self.commit()
 
     # ==================== OYLIK TO'LOV ====================
     def update_user_bot_payment(self, user_bot_id, days_left):
@@ -475,11 +1421,12 @@ class Database:
             SET payment_date = CURRENT_TIMESTAMP, days_left = ?
             WHERE id = ?
         ''', (days_left, user_bot_id))
-        self.conn.commit()
+        self.commit()
 
+    @reader
     def get_user_bots_with_expiring_payments(self, days_threshold=5):
         """To'lov muddati tugayotgan botlarni olish"""
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('''
             SELECT ub.*, b.bot_name
             FROM user_bots ub
@@ -489,9 +1436,10 @@ class Database:
         ''', (days_threshold,))
         return cursor.fetchall()
 
+    @reader
     def get_all_user_bots_for_payment_check(self):
         """Oylik to'lov tekshiruvi uchun barcha botlarni olish"""
-        cursor = self.conn.cursor()
+        cursor = self.reader_conn().cursor()
         cursor.execute('''
             SELECT ub.*, b.bot_name
             FROM user_bots ub
@@ -504,7 +1452,7 @@ class Database:
         """Barcha botlar uchun qolgan kunlarni kamaytirish"""
         cursor = self.conn.cursor()
         cursor.execute('UPDATE user_bots SET days_left = days_left - 1 WHERE days_left > 0 AND status = "active"')
-        self.conn.commit()
+        self.commit()
 
     def disable_expired_bots(self):
         """Muddati o'tgan botlarni o'chirish"""
@@ -514,121 +1462,813 @@ class Database:
             SET status = 'expired', days_left = 0
             WHERE days_left <= 0 AND status = 'active'
         ''')
-        self.conn.commit()
+        self.commit()
         return cursor.rowcount
 
+    # ==================== ADMIN: FOYDALANUVCHILAR ====================
+    @reader
+    def get_users_page(self, cursor_user_id, limit, older=True):
+        """(created_at, user_id) bo'yicha keyset sahifa: cursor_user_id dan eskiroq (older) yoki yangiroq.
+
+        Natija har doim yangidan eskiga tartiblangan.
+        """
+        cursor = self.reader_conn().cursor()
+        columns = 'user_id, full_name, username, balance, created_at'
+        if cursor_user_id is None:
+            cursor.execute(f'SELECT {columns} FROM users ORDER BY created_at DESC, user_id DESC LIMIT ?', (limit,))
+            return cursor.fetchall()
+        if older:
+            cursor.execute(f'''
+                SELECT {columns} FROM users
+                WHERE (created_at, user_id) < (SELECT created_at, user_id FROM users WHERE user_id = ?)
+                ORDER BY created_at DESC, user_id DESC LIMIT ?
+            ''', (cursor_user_id, limit))
+            return cursor.fetchall()
+        cursor.execute(f'''
+            SELECT {columns} FROM users
+            WHERE (created_at, user_id) > (SELECT created_at, user_id FROM users WHERE user_id = ?)
+            ORDER BY created_at, user_id LIMIT ?
+        ''', (cursor_user_id, limit))
+        return cursor.fetchall()[::-1]
+
+    @reader
+    def search_users(self, query, limit):
+        """Ism, username va telefon bo'yicha prefiks qidiruv (FTS5)"""
+        cursor = self.reader_conn().cursor()
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return []
+        try:
+            cursor.execute('''
+                SELECT u.user_id, u.full_name, u.username, u.balance, u.created_at
+                FROM users_fts f JOIN users u ON u.user_id = f.rowid
+                WHERE users_fts MATCH ? ORDER BY f.rank LIMIT ?
+            ''', (' '.join(f'"{term}"*' for term in terms), limit))
+        except sqlite3.OperationalError:
+            pattern = f'%{terms[0]}%'
+            cursor.execute('''
+                SELECT user_id, full_name, username, balance, created_at FROM users
+                WHERE full_name LIKE ? OR username LIKE ? OR phone_number LIKE ? LIMIT ?
+            ''', (pattern, pattern, pattern, limit))
+        return cursor.fetchall()
 
-# Database instance (oxirida)
-db = Database()
+    @reader
+    def get_user_card(self, user_id):
+        """Admin uchun foydalanuvchi kartasi: asosiy ustunlar, referallar soni va ban holati"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute('''
+            SELECT u.user_id, u.username, u.full_name, u.phone_number, u.balance, u.created_at, u.is_reachable,
+                   u.referrals_count,
+                   EXISTS(SELECT 1 FROM banned_users b WHERE b.user_id = u.user_id)
+            FROM users u WHERE u.user_id = ?
+        ''', (user_id,))
+        return cursor.fetchone()
 
+    # ==================== YETKAZIB BO'LISH ====================
+    @reader
+    def is_user_reachable(self, user_id):
+        cursor = self.reader_conn().cursor()
+        cursor.execute('SELECT is_reachable FROM users WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
+        return result is None or result[0] != 0
 
-async def check_subscription(user_id):
-    """Majburiy obunalarni tekshirish"""
-    subscriptions = db.get_mandatory_subscriptions()
-    if not subscriptions:
-        return True
+    def set_users_unreachable(self, user_ids):
+        """Botni bloklagan yoki chati topilmagan foydalanuvchilarni belgilash"""
+        cursor = self.conn.cursor()
+        cursor.executemany('UPDATE users SET is_reachable = 0 WHERE user_id = ?', [(user_id,) for user_id in user_ids])
+        self.commit()
 
-    for sub in subscriptions:
-        channel_id = sub[0]
-        try:
-            member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-            if member.status not in ['member', 'administrator', 'creator']:
-                return False
-        except Exception as e:
-            logger.error(f"Error checking subscription: {e}")
-            return False
-    return True
+    # ==================== BROADCAST ====================
+    def create_broadcast(self, admin_chat_id, progress_message_id, text, total):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            INSERT INTO broadcasts (admin_chat_id, progress_message_id, text, total) VALUES (?, ?, ?, ?)
+        ''', (admin_chat_id, progress_message_id, text, total))
+        self.commit()
+        return cursor.lastrowid
 
+    def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed):
+        """Yuborilgan bo'lakdan keyingi holatni saqlash"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ? WHERE id = ?
+        ''', (last_user_id, sent, failed, broadcast_id))
+        self.commit()
 
-async def require_subscription(message_or_callback):
-    """Majburiy obuna tekshiruvini qaytarish - agar obuna bo'lmagan bo'lsa False"""
-    if isinstance(message_or_callback, types.Message):
-        user_id = message_or_callback.from_user.id
-        is_subscribed = await check_subscription(user_id)
-        if not is_subscribed:
-            subscriptions = db.get_mandatory_subscriptions()
-            keyboard_buttons = []
-            for sub in subscriptions:
-                channel_username = sub[1] or sub[0]
-                keyboard_buttons.append([InlineKeyboardButton(
-                    f"📢 {channel_username} ga obuna bo'lish",
-                    url=f"https://t.me/{channel_username.replace('@', '')}"
-                )])
-            keyboard_buttons.append([InlineKeyboardButton("✅ Obuna bo'ldim", callback_data="check_subscription")])
-            keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-            await message_or_callback.answer(
-                "❌ Botdan foydalanish uchun quyidagi kanallarga obuna bo'ling:",
-                reply_markup=keyboard
-            )
-            return False
-        return True
-    elif isinstance(message_or_callback, types.CallbackQuery):
-        user_id = message_or_callback.from_user.id
-        is_subscribed = await check_subscription(user_id)
-        if not is_subscribed:
-            subscriptions = db.get_mandatory_subscriptions()
-            keyboard_buttons = []
-            for sub in subscriptions:
-                channel_username = sub[1] or sub[0]
-                keyboard_buttons.append([InlineKeyboardButton(
-                    f"📢 {channel_username} ga obuna bo'lish",
-                    url=f"https://t.me/{channel_username.replace('@', '')}"
-                )])
-            keyboard_buttons.append([InlineKeyboardButton("✅ Obuna bo'ldim", callback_data="check_subscription")])
-            keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-            await message_or_callback.message.answer(
-                "❌ Botdan foydalanish uchun quyidagi kanallarga obuna bo'ling:",
-                reply_markup=keyboard
-            )
-            await message_or_callback.answer("Iltimos, avval obuna bo'ling!", show_alert=True)
-            return False
-        return True
-    return True
+    def finish_broadcast(self, broadcast_id, status='done'):
+        """Broadcastni yakunlash: 'done' yoki 'failed' (resume_broadcasts qayta olmaydi)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (status, broadcast_id))
+        self.commit()
+
+    @reader
+    def get_running_broadcasts(self):
+        """Tugallanmagan broadcastlar (bot qayta ishga tushganda davom ettiriladi)"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute('''
+            SELECT id, admin_chat_id, progress_message_id, text, last_user_id, sent, failed, total
+            FROM broadcasts WHERE status = 'running'
+        ''')
+        return cursor.fetchall()
 
+    @reader
+    def count_broadcast_recipients(self):
+        """get_broadcast_recipients qaytaradigan foydalanuvchilar soni (progress dagi 'Jami')"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute('SELECT COUNT(*) FROM users WHERE is_reachable = 1')
+        return cursor.fetchone()[0]
+
+    @reader
+    def get_broadcast_recipients(self, after_user_id, limit):
+        """after_user_id dan keyingi foydalanuvchilar (keyset sahifalash)"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute('''
+            SELECT user_id FROM users WHERE user_id > ? AND is_reachable = 1 ORDER BY user_id LIMIT ?
+        ''', (after_user_id, limit))
+        return [row[0] for row in cursor.fetchall()]
 
-async def show_main_menu(message: types.Message):
-    """Asosiy menu ko'rsatish"""
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
-    keyboard.add(
-        types.KeyboardButton("👥 Referral chaqirish"),
-        types.KeyboardButton("💼 Asosiy kabinet"),
-        types.KeyboardButton("🤖 Bot yaratish"),
-        types.KeyboardButton("🤖 Mening botlarim")
-    )
 
-    text = "🤖 Maker Bot ga xush kelibsiz!\n\n"
-    text += "Quyidagi funksiyalardan foydalaning:"
+    # ==================== BOT YARATISH NAVBATI ====================
+    def create_provision_job(self, user_id, bot_id, bot_token, price, chat_id, message_id, user_bot_dir):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            INSERT INTO provision_jobs (user_id, bot_id, bot_token, price, chat_id, message_id, user_bot_dir)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, bot_id, bot_token, price, chat_id, message_id, user_bot_dir))
+        self.commit()
+        return cursor.lastrowid
 
-    await message.answer(text, reply_markup=keyboard)
+    def set_provision_job_status(self, job_id, status):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            UPDATE provision_jobs SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (status, job_id))
+        self.commit()
 
+    def attach_provision_job_bot(self, job_id, user_id, bot_token, bot_id, instance_dir, log_path):
+        """user_bots yozuvi va ishning 'launching' holati bitta tranzaksiyada: qayta ishga tushganda bot ikki marta yaratilmaydi"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            INSERT INTO user_bots (user_id, bot_token, bot_id, instance_dir, log_path) VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, bot_token, bot_id, instance_dir, log_path))
+        user_bot_id = cursor.lastrowid
+        cursor.execute('''
+            UPDATE provision_jobs SET status = 'launching', user_bot_id = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (user_bot_id, job_id))
+        self.commit()
+        return user_bot_id
+
+    def fail_provision_job(self, job_id, error):
+        """Ishni 'failed' qilish, yaratilgan user_bots yozuvini o'chirish va pulni qaytarish - bitta tranzaksiyada
+        (faqat bir marta). Yangi balans yoki None (hech narsa qaytarilmagan)"""
+        with self.atomic():
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE provision_jobs SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status IN ('queued', 'extracting', 'patching', 'launching')
+                RETURNING user_id, price, bot_id, user_bot_id
+            ''', (error, job_id))
+            row = cursor.fetchone()
+            balance = None
+            if row:
+                if row[3] is not None:
+                    # Qaytarilgan bot reconcile da qayta ko'tarilmasligi kerak
+                    cursor.execute('DELETE FROM user_bots WHERE id = ?', (row[3],))
+                balance = self._credit(cursor, row[0], row[1], 'refund', row[2])
+        self.commit()
+        return balance
+
+    @reader
+    def get_provision_job(self, job_id):
+        cursor = self.reader_conn().cursor()
+        cursor.execute('''
+            SELECT id, user_id, bot_id, bot_token, price, chat_id, message_id, user_bot_dir, status, user_bot_id
+            FROM provision_jobs WHERE id = ?
+        ''', (job_id,))
+        return cursor.fetchone()
 
-@dp.message_handler(commands=['start'])
-async def start_handler(message: types.Message, state: FSMContext):
-    """Start command handler"""
+    @reader
+    def get_active_provision_jobs(self):
+        """Tugallanmagan ishlar (bot qayta ishga tushganda davom ettiriladi)"""
+        cursor = self.reader_conn().cursor()
+        cursor.execute('''
+            SELECT id, user_id, bot_id, bot_token, price, chat_id, message_id, user_bot_dir, status, user_bot_id
+            FROM provision_jobs WHERE status IN ('queued', 'extracting', 'patching', 'launching') ORDER BY id
+        ''')
+        return cursor.fetchall()
+
+    @reader
+    def count_active_provision_jobs(self):
+        cursor = self.reader_conn().cursor()
+        cursor.execute('''
+            SELECT COUNT(*) FROM provision_jobs WHERE status IN ('queued', 'extracting', 'patching', 'launching')
+        ''')
+        return cursor.fetchone()[0]
+
+
+class AsyncDatabase:
+    """Database metodlarini alohida DB oqimida bajaruvchi asinxron o'ram.
+
+    Har bir metod korutina sifatida chaqiriladi (`await db.get_user(user_id)`).
+    Yozuvlar bitta DB oqimida navbat bilan bajariladi, shuning uchun sekin
+    commit/fsync event loop ni (va boshqa foydalanuvchilarni) to'xtatib qo'ymaydi.
+    `@reader` bilan belgilangan metodlar alohida read-only ulanishlar pulida
+    parallel ishlaydi va yozuvlar ortida navbat kutmaydi (WAL rejimi).
+
+    Group-commit rejimida yozuv metodlari bajarilgach darhol qaytadi, commit esa
+    bir necha yozuv uchun bitta bo'ladi. Javob berishdan oldin yozuv diskda
+    bo'lishi kerak bo'lsa `await db.committed()` chaqiriladi. Commit qilinmagan
+    yozuvlar bor paytda o'qishlar yozuvchi oqimga yo'naltiriladi, shuning uchun
+    handler o'zi yozgan ma'lumotni darhol ko'radi.
+    """
+
+    def __init__(self, database, group_commit=DB_GROUP_COMMIT):
+        self.sync = database
+        self.sync.group_commit = group_commit
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db',
+                                            initializer=database._bind_writer_thread)
+        self._read_executor = ThreadPoolExecutor(max_workers=DB_READ_POOL_SIZE, thread_name_prefix='db-read')
+        self._pending = 0           # hali hech qaysi commitga biriktirilmagan yozuvlar
+        self._in_flight = 0         # bajarilayotgan commit lardagi yozuvlar
+        self._waiters = []          # keyingi group commit ni kutayotgan futurelar
+        self._flush_handle = None
+
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+        if name.startswith('_') or not callable(method):
+            raise AttributeError(name)
+
+        is_reader = getattr(method, 'db_reader', False)
+        is_background = getattr(method, 'db_background', False)
+
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            call = functools.partial(method, *args, **kwargs)
+            if is_background:
+                return await loop.run_in_executor(None, call)
+            if is_reader:
+                executor = self._executor if self._pending or self._in_flight else self._read_executor
+                return await loop.run_in_executor(executor, call)
+            if not self.sync.group_commit:
+                return await loop.run_in_executor(self._executor, call)
+
+            self._pending += 1
+            try:
+                return await loop.run_in_executor(self._executor, call)
+            finally:
+                self._schedule_flush()
+
+        setattr(self, name, wrapper)
+        return wrapper
+
+    def _schedule_flush(self):
+        loop = asyncio.get_running_loop()
+        if self._pending >= DB_GROUP_COMMIT_MAX_BATCH:
+            loop.create_task(self._flush())
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(DB_GROUP_COMMIT_DELAY, lambda: loop.create_task(self._flush()))
+
+    async def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        waiters, self._waiters = self._waiters, []
+        # Shu paytgacha yuborilgan yozuvlar flush dan oldin bajariladi (yozuvchi oqim FIFO)
+        count, self._pending = self._pending, 0
+        if not count and not waiters:
+            return
+        self._in_flight += count
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self.sync.flush)
+        except Exception as e:
+            logger.error(f"Group commit xatosi: {e}")
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+        else:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+        finally:
+            self._in_flight -= count
+
+    async def committed(self):
+        """Shu paytgacha yuborilgan barcha yozuvlar diskka commit qilinishini kutish"""
+        if not self.sync.group_commit or not (self._pending or self._in_flight):
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._schedule_flush()
+        await waiter
+
+    async def close(self):
+        """Kutilayotgan yozuvlarni commit qilish, DB oqimlarini to'xtatish va ulanishlarni yopish"""
+        await self._flush()
+        self._executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        self.sync.close()
+
+
+# UserContext orqali yoziladigan users ustunlari
+USER_CONTEXT_FIELDS = {'username', 'full_name', 'phone_number', 'is_reachable'}
+
+
+# check_query_plans() uchun Database metodlari argumentlarining namunaviy qiymatlari
+QUERY_PLAN_SAMPLE_ARGS = {
+    'user_id': 1, 'user_bot_id': 1, 'bot_id': 1, 'payment_id': 1, 'referred_by': 2,
+    'username': 'user', 'full_name': 'User', 'phone_number': '+998900000000',
+    'referral_code': 'REF1', 'amount': 1, 'status': 'active', 'reason': 'check',
+    'channel_id': '-1001', 'channel_username': '@channel', 'bot_token': '1:token',
+    'bot_name': 'bot', 'bot_file_path': 'bot.py', 'run_command': 'python bot.py', 'price': 1,
+    'screenshot_path': 'payment.jpg', 'days_left': 30, 'days': 30, 'days_threshold': 5,
+    'fields': {'full_name': 'User'}, 'members': [(1, 'member')],
+    'broadcast_id': 1, 'admin_chat_id': 1, 'progress_message_id': 1, 'text': 'text', 'total': 1,
+    'last_user_id': 1, 'sent': 1, 'failed': 1, 'after_user_id': 0, 'limit': 100, 'user_ids': [1],
+    'cursor_user_id': 1, 'query': 'user', 'kind': 'payment', 'ref_id': 1, 'pid': 1, 'exit_code': 1,
+    'job_id': 1, 'chat_id': 1, 'message_id': 1, 'user_bot_dir': 'user_bots/bot', 'error': 'error',
+    'template_hash': 'hash', 'run_argv': '["python", "main.py"]', 'run_cwd': '.',
+    'instance_dir': 'user_bots/bot', 'max_age': 60, 'log_path': 'user_bots/bot/log.txt',
+}
+# export_users va statistika hisoblagichlari (get_total_*) butun jadvalni ataylab o'qiydi
+QUERY_PLAN_SKIP_METHODS = {
+    'init_db', 'reader_conn', 'commit', 'flush', 'close', 'export_users', 'get_total_users', 'get_total_bots',
+}
+
+
+def explain_full_scans(conn, sql):
+    """So'rov rejasidagi indekssiz to'liq jadval skanlarini qaytarish"""
+    scans = []
+    for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall():
+        detail = row[-1]
+        match = re.match(r'SCAN (?:\w+\.)?(\w+)', detail)
+        # "SCAN ... USING (COVERING) INDEX" ham butun indeksni o'qiydi; faqat SEARCH qatorlari indeksli
+        if not match or detail == 'SCAN CONSTANT ROW':
+            continue
+        # Virtual jadval (FTS5) cheklov bilan so'ralsa (idxStr bo'sh emas) o'z indeksidan foydalanadi
+        if re.search(r'VIRTUAL TABLE INDEX \d+:\S', detail):
+            continue
+        if match.group(1) not in FULL_SCAN_ALLOWED_TABLES:
+            scans.append(detail)
+    return scans
+
+
+def check_query_plans(path=None):
+    """Har bir Database so'rovini EXPLAIN QUERY PLAN orqali tekshirish.
+
+    Vaqtinchalik bazada barcha Database metodlari namunaviy argumentlar bilan chaqiriladi,
+    bajarilgan so'rovlar yig'iladi va indekssiz to'liq skan bo'lsa 1 qaytariladi.
+    """
+    import inspect
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = Database(path or os.path.join(tmp, 'plan_check.db'))
+        statements = []
+        database.conn.set_trace_callback(statements.append)
+        database.reader_conn().set_trace_callback(statements.append)
+
+        for name, method in inspect.getmembers(database, inspect.ismethod):
+            if name.startswith('_') or name in QUERY_PLAN_SKIP_METHODS:
+                continue
+            params = [p for p in inspect.signature(method).parameters.values() if p.default is inspect.Parameter.empty]
+            method(*[QUERY_PLAN_SAMPLE_ARGS[p.name] for p in params])
+
+        database.conn.set_trace_callback(None)
+        database.reader_conn().set_trace_callback(None)
+
+        failures = []
+        for sql in dict.fromkeys(statements):
+            if sql.lstrip().split(None, 1)[0].upper() not in ('SELECT', 'UPDATE', 'DELETE', 'WITH'):
+                continue
+            for detail in explain_full_scans(database.conn, sql):
+                failures.append((detail, ' '.join(sql.split())))
+        database.close()
+
+    for detail, sql in failures:
+        logger.error(f"To'liq jadval skani: {detail} <- {sql}")
+    if not failures:
+        logger.info("Query plan tekshiruvi: barcha so'rovlar indeksdan foydalanadi")
+    return 1 if failures else 0
+
+
+# Tekshiruv o'z vaqtinchalik bazasida ishlaydi: jonli maker_bot.db ochilmaydi va migratsiya qilinmaydi
+if __name__ == '__main__' and '--check-query-plans' in sys.argv:
+    sys.exit(check_query_plans())
+
+# Database instance (oxirida)
+db = AsyncDatabase(Database())
+
+
+class UserContext:
+    """Bitta update davomidagi foydalanuvchi ma'lumotlari.
+
+    UserContextMiddleware har bir update uchun bir marta yuklaydi va handlerga
+    `user_ctx` argumenti sifatida beradi. `update()` orqali qilingan
+    o'zgarishlar update oxirida bitta UPDATE bilan yoziladi.
+    """
+
+    def __init__(self, user_id, row):
+        self.user_id = user_id
+        self.exists = row[0] is not None
+        self.username = row[1]
+        self.full_name = row[2]
+        self.phone_number = row[3]
+        self.balance = float(row[4]) if row[4] is not None else 0.0
+        self.referral_code = row[5]
+        self.referred_by = row[6]
+        self.referral_bonus_paid = bool(row[7])
+        self.is_reachable = row[8] != 0
+        self.referrals_count = row[9] or 0
+        self.referral_earned = row[10] or 0.0
+        self.banned = bool(row[11])
+        self.changes = {}
+
+    def update(self, **fields):
+        """Ustunlarni o'zgartirish (update oxirida saqlanadi)"""
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.changes.update(fields)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Foydalanuvchi kontekstini bitta so'rov bilan yuklash va o'zgarishlarni oxirida saqlash"""
+
+    async def load(self, user, data):
+        if user is not None and 'user_ctx' not in data:
+            user_ctx = data['user_ctx'] = UserContext(user.id, await db.get_user_context(user.id))
+            # Foydalanuvchi yozdi - demak unga yana xabar yuborish mumkin
+            if user_ctx.exists and not user_ctx.is_reachable:
+                user_ctx.update(is_reachable=1)
+
+    async def save(self, data):
+        user_ctx = data.get('user_ctx')
+        if user_ctx and user_ctx.exists and user_ctx.changes:
+            changes, user_ctx.changes = user_ctx.changes, {}
+            await db.update_user_fields(user_ctx.user_id, changes)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        await self.load(message.from_user, data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        await self.save(data)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        await self.load(callback_query.from_user, data)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        await self.save(data)
+
+
+dp.middleware.setup(UserContextMiddleware())
+
+
+# Foydalanuvchiga endi yetkazib bo'lmasligini bildiruvchi xatolar
+UNREACHABLE_ERRORS = (BotBlocked, BotKicked, UserDeactivated, CantInitiateConversation, ChatNotFound)
+
+
+async def notify_user(user_id, text, **kwargs):
+    """Foydalanuvchiga xabar yuborish. Yetkazib bo'lmaydigan foydalanuvchilar o'tkazib yuboriladi"""
+    if not await db.is_user_reachable(user_id):
+        return None
+    try:
+        with outbound_lane(PRIORITY_NOTIFICATION):
+            return await bot.send_message(chat_id=user_id, text=text, **kwargs)
+    except UNREACHABLE_ERRORS as e:
+        logger.warning(f"{user_id} ga xabar yuborib bo'lmadi, yetkazib bo'lmaydigan deb belgilandi: {e}")
+        await db.set_users_unreachable([user_id])
+    except TelegramAPIError as e:
+        logger.error(f"{user_id} ga xabar yuborishda xatolik: {e}")
+    return None
+
+
+class VersionedCache:
+    """Jarayon ichidagi kesh: qiymat birinchi so'rovda yuklanadi va invalidate() gacha saqlanadi.
+
+    Har bir kalitning versiyasi bor: yuklash davomida invalidate() chaqirilsa,
+    eskirgan natija keshga yozilmaydi.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._versions = defaultdict(int)
+
+    async def get(self, key, loader):
+        if key in self._values:
+            return self._values[key]
+        version = self._versions[key]
+        value = await loader()
+        if self._versions[key] == version:
+            self._values[key] = value
+        return value
+
+    def invalidate(self, key):
+        self._versions[key] += 1
+        self._values.pop(key, None)
+
+
+class BotCatalog:
+    """Botlar katalogi va oldindan tayyorlangan katalog matni hamda tugmalari"""
+
+    def __init__(self, bots):
+        self.bots = bots
+        self.by_id = {bot_data[0]: bot_data for bot_data in bots}
+        self.text = ''
+        self.buttons = []
+        for bot_data in bots:
+            bot_id = bot_data[0]
+            bot_name = bot_data[1]
+            price = bot_data[4]  # endi bu har doim float
+
+            self.text += f"• {bot_name} — {price:,.0f} so'm\n".replace(',', ' ')  # chiroyli format
+            self.buttons.append([InlineKeyboardButton(
+                f"🤖 {bot_name} — {price:,.0f} so'm".replace(',', ' '),
+                callback_data=f"select_bot_{bot_id}"
+            )])
+
+
+# Sozlamalar, botlar katalogi va bot identifikatori keshi.
+# Yozuvchilar (set_referral_amount, add_bot, bot o'chirish) tegishli kalitni invalidate qiladi
+app_cache = VersionedCache()
+
+
+async def get_referral_amount():
+    return await app_cache.get('referral_amount', db.get_referral_amount)
+
+
+async def get_bot_catalog():
+    async def load():
+        return BotCatalog(await db.get_bots())
+    return await app_cache.get('bot_catalog', load)
+
+
+async def get_bot_identity():
+    return await app_cache.get('bot_me', bot.get_me)
+
+
+class TTLCache:
+    """Yozuvlari muddat (TTL) bilan eskiradigan, hajmi cheklangan LRU kesh"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, predicate):
+        """predicate(key) True bo'lgan yozuvlarni o'chirish"""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Majburiy obuna uchun a'zo hisoblanadigan holatlar
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+# (user_id, channel_id) -> a'zomi yoki yo'q
+subscription_cache = TTLCache(SUBSCRIPTION_CACHE_SIZE)
+
+# Bir vaqtda bajariladigan get_chat_member so'rovlari chegarasi
+subscription_check_limiter = asyncio.Semaphore(SUBSCRIPTION_CHECK_CONCURRENCY)
+
+
+async def fetch_channel_membership(channel_id, user_id):
+    """Bitta kanal uchun a'zolikni Bot API orqali tekshirish.
+
+    True/False - aniq natija (keshlanadi). None - natija noma'lum: kanal
+    topilmadi, bot admin emas yoki so'rov SUBSCRIPTION_CHECK_TIMEOUT dan oshdi.
+    """
+    try:
+        async with subscription_check_limiter:
+            member = await asyncio.wait_for(
+                bot.get_chat_member(chat_id=channel_id, user_id=user_id),
+                timeout=SUBSCRIPTION_CHECK_TIMEOUT
+            )
+    except asyncio.TimeoutError:
+        logger.warning(f"Obuna tekshiruvi vaqti tugadi: channel={channel_id}, user={user_id}")
+        return None
+    except (BadRequest, Unauthorized) as e:
+        # Kanal sozlamasi xato (bot admin emas, kanal o'chirilgan) - foydalanuvchi aybdor emas
+        logger.error(f"Kanal a'zoligini tekshirib bo'lmadi ({channel_id}): {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Error checking subscription: {e}")
+        return None
+
+    is_member = member.status in MEMBER_STATUSES
+    subscription_cache.set((user_id, channel_id), is_member,
+                           SUBSCRIPTION_CACHE_TTL if is_member else SUBSCRIPTION_CACHE_NEGATIVE_TTL)
+    if is_member:
+        await db.set_channel_member(channel_id, user_id, member.status)
+    else:
+        # Salbiy natija faqat qisqa keshda turadi: jadvalga yozilsa SUBSCRIPTION_CACHE_NEGATIVE_TTL bekor bo'lardi
+        await db.delete_channel_member(channel_id, user_id)
+    return is_member
+
+
+@dp.chat_member_handler()
+async def channel_member_update_handler(update: types.ChatMemberUpdated):
+    """Majburiy kanallardagi a'zolik o'zgarishlarini channel_members jadvaliga yozish"""
+    channel_id = str(update.chat.id)
+    subscriptions = await db.get_mandatory_subscriptions()
+    if channel_id not in {sub[0] for sub in subscriptions}:
+        return
+
+    member = update.new_chat_member
+    await db.set_channel_member(channel_id, member.user.id, member.status)
+    subscription_cache.invalidate(lambda key: key == (member.user.id, channel_id))
+
+
+async def backfill_channel_members(channel_id):
+    """Kanal a'zolarini Telethon orqali bir martalik yuklash.
+
+    TELEGRAM_API_ID va TELEGRAM_API_HASH berilmagan bo'lsa o'tkazib yuboriladi:
+    jadvalda yo'q foydalanuvchilar birinchi tekshiruvda Bot API orqali aniqlanadi.
+    """
+    if TelegramClient is None or not TELEGRAM_API_ID or not TELEGRAM_API_HASH:
+        logger.info(f"Kanal a'zolari backfill qilinmadi ({channel_id}): Telethon sozlanmagan")
+        return
+
+    client = TelegramClient(MemorySession(), TELEGRAM_API_ID, TELEGRAM_API_HASH)
+    total = 0
+    try:
+        await client.start(bot_token=BOT_TOKEN)
+        batch = []
+        async for user in client.iter_participants(int(channel_id)):
+            batch.append((user.id, 'member'))
+            if len(batch) >= 1000:
+                await db.set_channel_members(channel_id, batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            await db.set_channel_members(channel_id, batch)
+            total += len(batch)
+        logger.info(f"Kanal a'zolari backfill qilindi ({channel_id}): {total} ta")
+    except Exception as e:
+        logger.error(f"Kanal a'zolarini backfill qilishda xatolik ({channel_id}): {e}")
+    finally:
+        await client.disconnect()
+
+
+async def check_subscription(user_id, use_negative_cache=True):
+    """Majburiy obunalarni tekshirish.
+
+    Ijobiy natijalar SUBSCRIPTION_CACHE_TTL, salbiylari SUBSCRIPTION_CACHE_NEGATIVE_TTL
+    soniya keshlanadi. "Obuna bo'ldim" bosilganda use_negative_cache=False beriladi.
+
+    Avval channel_members jadvali tekshiriladi: u chat_member update lari bilan
+    yangilanib boradi, shuning uchun odatda Bot API ga murojaat kerak bo'lmaydi.
+    CHANNEL_MEMBER_MAX_AGE dan eski yozuvlar hisobga olinmaydi (API da qayta tekshiriladi).
+    use_negative_cache=False bo'lsa jadvaldagi salbiy holat ham API da qayta tekshiriladi.
+
+    Jadvalda ham, keshda ham yo'q kanallar parallel tekshiriladi (SUBSCRIPTION_CHECK_CONCURRENCY bilan
+    cheklangan) va birinchi "a'zo emas" javobida qolganlari bekor qilinadi.
+    Natija noma'lum bo'lgan kanallar (timeout, API xatosi) keshlanmaydi va
+    SUBSCRIPTION_UNKNOWN_POLICY bo'yicha hal qilinadi: "deny" - obuna bo'lmagan
+    deb hisoblanadi, "allow" - o'tkazib yuboriladi.
+    """
+    subscriptions = await db.get_mandatory_subscriptions()
+    if not subscriptions:
+        return True
+
+    memberships = await db.get_channel_memberships(user_id, CHANNEL_MEMBER_MAX_AGE)
+    pending = []
+    for sub in subscriptions:
+        channel_id = sub[0]
+        status = memberships.get(channel_id)
+        if status in MEMBER_STATUSES:
+            continue
+        if status is not None and use_negative_cache:
+            return False
+        cached = subscription_cache.get((user_id, channel_id))
+        if cached is True:
+            continue
+        if cached is False and use_negative_cache:
+            return False
+        pending.append(channel_id)
+
+    if not pending:
+        return True
+
+    tasks = [asyncio.create_task(fetch_channel_membership(channel_id, user_id)) for channel_id in pending]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            is_member = await next_result
+            if is_member is False:
+                return False
+            if is_member is None and SUBSCRIPTION_UNKNOWN_POLICY != 'allow':
+                return False
+    finally:
+        for task in tasks:
+            task.cancel()
+    return True
+
+
+async def require_subscription(message_or_callback):
+    """Majburiy obuna tekshiruvini qaytarish - agar obuna bo'lmagan bo'lsa False"""
+    if isinstance(message_or_callback, types.Message):
+        user_id = message_or_callback.from_user.id
+        is_subscribed = await check_subscription(user_id)
+        if not is_subscribed:
+            subscriptions = await db.get_mandatory_subscriptions()
+            keyboard_buttons = []
+            for sub in subscriptions:
+                channel_username = sub[1] or sub[0]
+                keyboard_buttons.append([InlineKeyboardButton(
+                    f"📢 {channel_username} ga obuna bo'lish",
+                    url=f"https://t.me/{channel_username.replace('@', '')}"
+                )])
+            keyboard_buttons.append([InlineKeyboardButton("✅ Obuna bo'ldim", callback_data="check_subscription")])
+            keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+            await message_or_callback.answer(
+                "❌ Botdan foydalanish uchun quyidagi kanallarga obuna bo'ling:",
+                reply_markup=keyboard
+            )
+            return False
+        return True
+    elif isinstance(message_or_callback, types.CallbackQuery):
+        user_id = message_or_callback.from_user.id
+        is_subscribed = await check_subscription(user_id)
+        if not is_subscribed:
+            subscriptions = await db.get_mandatory_subscriptions()
+            keyboard_buttons = []
+            for sub in subscriptions:
+                channel_username = sub[1] or sub[0]
+                keyboard_buttons.append([InlineKeyboardButton(
+                    f"📢 {channel_username} ga obuna bo'lish",
+                    url=f"https://t.me/{channel_username.replace('@', '')}"
+                )])
+            keyboard_buttons.append([InlineKeyboardButton("✅ Obuna bo'ldim", callback_data="check_subscription")])
+            keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+            await message_or_callback.message.answer(
+                "❌ Botdan foydalanish uchun quyidagi kanallarga obuna bo'ling:",
+                reply_markup=keyboard
+            )
+            await message_or_callback.answer("Iltimos, avval obuna bo'ling!", show_alert=True)
+            return False
+        return True
+    return True
+
+
+async def show_main_menu(message: types.Message):
+    """Asosiy menu ko'rsatish"""
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
+    keyboard.add(
+        types.KeyboardButton("👥 Referral chaqirish"),
+        types.KeyboardButton("💼 Asosiy kabinet"),
+        types.KeyboardButton("🤖 Bot yaratish"),
+        types.KeyboardButton("🤖 Mening botlarim")
+    )
+
+    text = "🤖 Maker Bot ga xush kelibsiz!\n\n"
+    text += "Quyidagi funksiyalardan foydalaning:"
+
+    await message.answer(text, reply_markup=keyboard)
+
+
+@dp.message_handler(commands=['start'])
+async def start_handler(message: types.Message, state: FSMContext, user_ctx: UserContext):
+    """Start command handler"""
     user_id = message.from_user.id
     username = message.from_user.username or ""
     
     # Banned tekshiruvi
-    if db.is_banned(user_id):
+    if user_ctx.banned:
         await message.answer("❌ Siz botdan foydalanish huquqidan mahrum qilingansiz!")
         return
 
     # Foydalanuvchini yaratish
-    user = db.get_user(user_id)
-    if not user:
+    if not user_ctx.exists:
         # Referral kodini tekshirish
         referred_by = None
         args = message.text.split()[1:] if len(message.text.split()) > 1 else []
         if args:
             referral_code = args[0]
-            cursor = db.conn.cursor()
-            cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (referral_code,))
-            ref_user = cursor.fetchone()
-            if ref_user:
-                referred_by = ref_user[0]
+            referred_by = await db.get_user_id_by_referral_code(referral_code)
 
         # Foydalanuvchini yaratish (telefon raqamisiz)
-        db.create_user(user_id, username, referred_by=referred_by)
+        await db.create_user(user_id, username, referred_by=referred_by)
+        user_ctx.exists = True
+        user_ctx.username = username
+        user_ctx.referred_by = referred_by
 
         # Telefon raqamini so'rash
         await RegistrationStates.waiting_name.set()
@@ -642,8 +2282,7 @@ async def start_handler(message: types.Message, state: FSMContext):
         return
 
     # Agar foydalanuvchi mavjud bo'lsa, telefon raqamini tekshirish
-    user_phone = db.get_user_phone(user_id)
-    if not user_phone:
+    if not user_ctx.phone_number:
         # Telefon raqami kiritilmagan, telefon raqamini so'rash
         await RegistrationStates.waiting_name.set()
 
@@ -655,16 +2294,46 @@ async def start_handler(message: types.Message, state: FSMContext):
         return
 
     # Ism mavjud, majburiy obunani tekshirish
-    await check_subscription_and_continue(message, state, user_id)
+    await check_subscription_and_continue(message, state, user_ctx)
+
+
+async def pay_referral_bonus(user_ctx: UserContext, from_user: types.User):
+    """Referral bonusni berish (faqat birinchi marta obuna bo'lganda)"""
+    user_id = user_ctx.user_id
+    referred_by = user_ctx.referred_by
+    if not referred_by or user_ctx.referral_bonus_paid:
+        return
 
+    referral_amount = await get_referral_amount()
 
-async def check_subscription_and_continue(message: types.Message, state: FSMContext, user_id: int):
+    # Balansga qo'shish va bonus berilganini belgilash
+    new_balance = await db.pay_referral_bonus(user_id, referred_by, referral_amount)
+    user_ctx.referral_bonus_paid = True
+    if new_balance is None:
+        return
+    old_balance = new_balance - referral_amount
+
+    logger.info(f"Referral bonus berildi: user_id={user_id}, referred_by={referred_by}, amount={referral_amount}, old_balance={old_balance}, new_balance={new_balance}")
+
+    # Referral bergan foydalanuvchiga xabar
+    user_name = user_ctx.full_name or from_user.username or "Foydalanuvchi"
+    username_display = f"@{from_user.username}" if from_user.username else user_name
+    await notify_user(
+        referred_by,
+        f"🎉 Yangi referal!\n\n"
+        f"👤 {username_display} botga qo'shildi va obuna bo'ldi\n"
+        f"💰 Balansingizga {referral_amount} so'm qo'shildi\n"
+        f"💵 Joriy balans: {new_balance} so'm"
+    )
+
+
+async def check_subscription_and_continue(message: types.Message, state: FSMContext, user_ctx: UserContext):
     """Majburiy obunani tekshirish va davom etish"""
     # Majburiy obunani tekshirish
-    is_subscribed = await check_subscription(user_id)
+    is_subscribed = await check_subscription(user_ctx.user_id)
 
     if not is_subscribed:
-        subscriptions = db.get_mandatory_subscriptions()
+        subscriptions = await db.get_mandatory_subscriptions()
         keyboard_buttons = []
         for sub in subscriptions:
             channel_username = sub[1] or sub[0]
@@ -682,72 +2351,31 @@ async def check_subscription_and_continue(message: types.Message, state: FSMCont
         return
 
     # Obuna bo'lgan, referral bonusni berish (faqat birinchi marta obuna bo'lganda)
-    user = db.get_user(user_id)
-    if user:
-        # referred_by ni to'g'ri indexdan olish
-        # users jadvali: user_id(0), username(1), full_name(2), phone_number(3), balance(4), referral_code(5), referred_by(6), created_at(7), referral_bonus_paid(8)
-        referred_by = None
-        if len(user) > 6:
-            referred_by = user[6]
-        
-        # Referral bonusni faqat birinchi marta obuna bo'lganda berish
-        if referred_by and not db.is_referral_bonus_paid(user_id):
-            referral_amount = db.get_referral_amount()
-            
-            # Balansga qo'shish
-            old_balance = db.get_balance(referred_by)
-            db.update_balance(referred_by, referral_amount)
-            new_balance = db.get_balance(referred_by)
-            
-            # Referral bonus berilganini belgilash
-            db.mark_referral_bonus_paid(user_id)
-            
-            logger.info(f"Referral bonus berildi: user_id={user_id}, referred_by={referred_by}, amount={referral_amount}, old_balance={old_balance}, new_balance={new_balance}")
-
-            # Referral bergan foydalanuvchiga xabar
-            try:
-                user_name = db.get_user_name(user_id) or message.from_user.username or "Foydalanuvchi"
-                username_display = f"@{message.from_user.username}" if message.from_user.username else user_name
-                await bot.send_message(
-                    chat_id=referred_by,
-                    text=f"🎉 Yangi referal!\n\n"
-                         f"👤 {username_display} botga qo'shildi va obuna bo'ldi\n"
-                         f"💰 Balansingizga {referral_amount} so'm qo'shildi\n"
-                         f"💵 Joriy balans: {new_balance} so'm"
-                )
-            except Exception as e:
-                # Chat topilmasa yoki foydalanuvchi botni bloklagan bo'lsa, xatoni log qilamiz
-                error_msg = str(e)
-                if "Chat not found" in error_msg or "chat not found" in error_msg.lower():
-                    logger.warning(
-                        f"Referral xabarini yuborib bo'lmadi: Foydalanuvchi {referred_by} botni bloklagan yoki chat topilmadi")
-                else:
-                    logger.error(f"Error sending referral message: {e}")
+    if user_ctx.exists:
+        await pay_referral_bonus(user_ctx, message.from_user)
 
     # Asosiy menu
     await show_main_menu(message)
 
 
 @dp.message_handler(state=RegistrationStates.waiting_name, content_types=['contact'])
-async def process_phone_contact(message: types.Message, state: FSMContext):
+async def process_phone_contact(message: types.Message, state: FSMContext, user_ctx: UserContext):
     """Telefon raqamini contact orqali qabul qilish"""
-    user_id = message.from_user.id
-
     if message.contact:
         phone_number = message.contact.phone_number
         # + belgisini qo'shish agar yo'q bo'lsa
         if not phone_number.startswith('+'):
             phone_number = '+' + phone_number
 
-        # Telefon raqamini saqlash
-        db.update_user_phone(user_id, phone_number)
+        # Telefon raqamini saqlash (update oxirida middleware yozadi)
+        user_ctx.update(phone_number=phone_number)
 
         # Ismni ham saqlash (agar contact da mavjud bo'lsa)
         if message.contact.first_name:
             full_name = message.contact.first_name
             if message.contact.last_name:
                 full_name += ' ' + message.contact.last_name
-            db.update_user_name(user_id, full_name)
+            user_ctx.update(full_name=full_name)
 
         # Keyboard ni olib tashlash
         remove_keyboard = types.ReplyKeyboardRemove()
@@ -755,7 +2383,7 @@ async def process_phone_contact(message: types.Message, state: FSMContext):
 
         # Majburiy obunani tekshirish
         await state.finish()
-        await check_subscription_and_continue(message, state, user_id)
+        await check_subscription_and_continue(message, state, user_ctx)
     else:
         # Contact yuborilmagan
         keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
@@ -774,6 +2402,7 @@ async def admin_handler(message: types.Message):
         [InlineKeyboardButton("➖ Majburiy obunani olib tashlash", callback_data="admin_remove_sub")],
         [InlineKeyboardButton("🤖 Bot qo'shish", callback_data="admin_add_bot")],
         [InlineKeyboardButton("👥 Foydalanuvchilar", callback_data="admin_users")],
+        [InlineKeyboardButton("🔎 Foydalanuvchilarni ko'rish", callback_data="admin_browse_users")],
         [InlineKeyboardButton("📊 Aktiv foydalanuvchilar", callback_data="admin_active_users")],
         [InlineKeyboardButton("👤 Umumiy foydalanuvchilar", callback_data="admin_total_users")],
         [InlineKeyboardButton("🤖 Botlar", callback_data="admin_bots")],
@@ -784,54 +2413,16 @@ async def admin_handler(message: types.Message):
 
 
 @dp.callback_query_handler(lambda c: c.data == "check_subscription")
-async def check_subscription_callback(callback_query: types.CallbackQuery, state: FSMContext):
+async def check_subscription_callback(callback_query: types.CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Obuna tekshirish callback"""
     await callback_query.answer()
     user_id = callback_query.from_user.id
 
-    is_subscribed = await check_subscription(user_id)
+    is_subscribed = await check_subscription(user_id, use_negative_cache=False)
     if is_subscribed:
         # Obuna bo'lgan, referral bonusni berish (faqat birinchi marta obuna bo'lganda)
-        user = db.get_user(user_id)
-        if user:
-            # referred_by ni to'g'ri indexdan olish
-            referred_by = None
-            if len(user) > 6:
-                referred_by = user[6]
-            
-            # Referral bonusni faqat birinchi marta obuna bo'lganda berish
-            if referred_by and not db.is_referral_bonus_paid(user_id):
-                referral_amount = db.get_referral_amount()
-                
-                # Balansga qo'shish
-                old_balance = db.get_balance(referred_by)
-                db.update_balance(referred_by, referral_amount)
-                new_balance = db.get_balance(referred_by)
-                
-                # Referral bonus berilganini belgilash
-                db.mark_referral_bonus_paid(user_id)
-                
-                logger.info(f"Referral bonus berildi (callback): user_id={user_id}, referred_by={referred_by}, amount={referral_amount}, old_balance={old_balance}, new_balance={new_balance}")
-
-                # Referral bergan foydalanuvchiga xabar
-                try:
-                    user_name = db.get_user_name(user_id) or callback_query.from_user.username or "Foydalanuvchi"
-                    username_display = f"@{callback_query.from_user.username}" if callback_query.from_user.username else user_name
-                    await bot.send_message(
-                        chat_id=referred_by,
-                        text=f"🎉 Yangi referal!\n\n"
-                             f"👤 {username_display} botga qo'shildi va obuna bo'ldi\n"
-                             f"💰 Balansingizga {referral_amount} so'm qo'shildi\n"
-                             f"💵 Joriy balans: {new_balance} so'm"
-                    )
-                except Exception as e:
-                    # Chat topilmasa yoki foydalanuvchi botni bloklagan bo'lsa, xatoni log qilamiz
-                    error_msg = str(e)
-                    if "Chat not found" in error_msg or "chat not found" in error_msg.lower():
-                        logger.warning(
-                            f"Referral xabarini yuborib bo'lmadi: Foydalanuvchi {referred_by} botni bloklagan yoki chat topilmadi")
-                    else:
-                        logger.error(f"Error sending referral message: {e}")
+        if user_ctx.exists:
+            await pay_referral_bonus(user_ctx, callback_query.from_user)
 
         await show_main_menu(callback_query.message)
     else:
@@ -860,21 +2451,24 @@ async def main_menu_callback(callback_query: types.CallbackQuery):
 
 
 @dp.message_handler(lambda message: message.text == "👥 Referral chaqirish")
-async def referral_handler(message: types.Message):
+async def referral_handler(message: types.Message, user_ctx: UserContext):
     """Referral handler"""
     if not await require_subscription(message):
         return
     
     user_id = message.from_user.id
 
-    referral_code = db.get_referral_code(user_id)
-    referrals_count = db.get_referrals_count(user_id)
-    referral_amount = db.get_referral_amount()
-    bot_username = (await bot.get_me()).username
+    referral_code = user_ctx.referral_code or await db.get_referral_code(user_id)
+    referral_amount = await get_referral_amount()
+    bot_username = (await get_bot_identity()).username
 
     text = f"👥 Referral tizimi\n\n"
     text += f"📝 Sizning referral kodingiz: `{referral_code}`\n"
-    text += f"👤 Jami chaqirganlar: {referrals_count}\n"
+    text += f"👤 Jami chaqirganlar: {user_ctx.referrals_count}\n"
+    text += f"💵 Referallardan ishlangan: {user_ctx.referral_earned} so'm\n"
+    if user_ctx.referrals_count:
+        levels = await db.get_referral_levels(user_id)
+        text += "🌳 Darajalar: " + ", ".join(f"{depth}-daraja: {count}" for depth, count in levels) + "\n"
     text += f"💰 Har bir referral uchun: {referral_amount} so'm\n"
     text += f"🔗 Referral havola:\n"
     text += f"`https://t.me/{bot_username}?start={referral_code}`\n\n"
@@ -887,19 +2481,16 @@ async def referral_handler(message: types.Message):
 
 
 @dp.message_handler(lambda message: message.text == "💼 Asosiy kabinet")
-async def cabinet_handler(message: types.Message):
+async def cabinet_handler(message: types.Message, user_ctx: UserContext):
     """Kabinet handler"""
     if not await require_subscription(message):
         return
     
-    user_id = message.from_user.id
-
-    balance = db.get_balance(user_id)
-    referrals_count = db.get_referrals_count(user_id)
+    balance = user_ctx.balance
 
     text = f"💼 Asosiy kabinet\n\n"
     text += f"💰 Balans: {balance} so'm\n"
-    text += f"👥 Referrallar: {referrals_count}\n"
+    text += f"👥 Referrallar: {user_ctx.referrals_count}\n"
 
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
     keyboard.add(
@@ -916,8 +2507,6 @@ async def topup_balance_handler(message: types.Message, state: FSMContext):
     if not await require_subscription(message):
         return
     
-    user_id = message.from_user.id
-    
     text = f"💳 Balans to'ldirish\n\n"
     text += f"Karta raqami: `{PAYMENT_CARD}`\n"
     text += f"To'lov summasini kiriting (so'm):\n\n"
@@ -974,7 +2563,8 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
     await file.download(destination_file=screenshot_path)
 
     # To'lovni bazaga qo'shish
-    payment_id = db.add_payment(user_id, amount, screenshot_path)
+    payment_id = await db.add_payment(user_id, amount, screenshot_path)
+    await db.committed()
 
     # Adminga xabar yuborish inline tugmalar bilan
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -982,27 +2572,29 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
         [InlineKeyboardButton("❌ Rad etish", callback_data=f"reject_payment_{payment_id}")]
     ])
     
-    try:
-        await bot.send_photo(
-            chat_id=ADMIN_ID,
-            photo=photo.file_id,
-            caption=f"💳 Yangi to'lov so'rovi\n\n"
-                    f"👤 Foydalanuvchi ID: {user_id}\n"
-                    f"👤 Username: @{message.from_user.username or 'N/A'}\n"
-                    f"💰 Summa: {amount} so'm",
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        logger.error(f"To'lov xabarini yuborishda xatolik: {e}")
-        # Agar rasm yuborib bo'lmasa, faqat matn yuborish
-        await bot.send_message(
-            chat_id=ADMIN_ID,
-            text=f"💳 Yangi to'lov so'rovi\n\n"
-                 f"👤 Foydalanuvchi ID: {user_id}\n"
-                 f"👤 Username: @{message.from_user.username or 'N/A'}\n"
-                 f"💰 Summa: {amount} so'm",
-            reply_markup=keyboard
-        )
+    # Adminga bildirishnoma: foydalanuvchilarga javoblardan keyin navbatga qo'yiladi
+    with outbound_lane(PRIORITY_NOTIFICATION):
+        try:
+            await bot.send_photo(
+                chat_id=ADMIN_ID,
+                photo=photo.file_id,
+                caption=f"💳 Yangi to'lov so'rovi\n\n"
+                        f"👤 Foydalanuvchi ID: {user_id}\n"
+                        f"👤 Username: @{message.from_user.username or 'N/A'}\n"
+                        f"💰 Summa: {amount} so'm",
+                reply_markup=keyboard
+            )
+        except Exception as e:
+            logger.error(f"To'lov xabarini yuborishda xatolik: {e}")
+            # Agar rasm yuborib bo'lmasa, faqat matn yuborish
+            await bot.send_message(
+                chat_id=ADMIN_ID,
+                text=f"💳 Yangi to'lov so'rovi\n\n"
+                     f"👤 Foydalanuvchi ID: {user_id}\n"
+                     f"👤 Username: @{message.from_user.username or 'N/A'}\n"
+                     f"💰 Summa: {amount} so'm",
+                reply_markup=keyboard
+            )
 
     await state.finish()
     await message.answer(
@@ -1011,14 +2603,13 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
 
 
 @dp.message_handler(lambda message: message.text == "🤖 Bot yaratish")
-async def create_bot_handler(message: types.Message):
+async def create_bot_handler(message: types.Message, user_ctx: UserContext):
     """Bot yaratish handler"""
     if not await require_subscription(message):
         return
     
-    user_id = message.from_user.id
-    bots = db.get_bots()
-    if not bots:
+    catalog = await get_bot_catalog()
+    if not catalog.bots:
         keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
         keyboard.add(types.KeyboardButton("🔙 Asosiy menu"))
         await message.answer(
@@ -1027,21 +2618,10 @@ async def create_bot_handler(message: types.Message):
         )
         return
 
-    balance = db.get_balance(user_id)
+    balance = user_ctx.balance
     text = f"🤖 Bot yaratish\n\n💰 Sizning balansingiz: {balance} so'm\n\nQuyidagi botlardan birini tanlang:\n\n"
-    keyboard_buttons = []
-    for bot_data in bots:
-        bot_id = bot_data[0]
-        bot_name = bot_data[1]
-        price = bot_data[4]  # endi bu har doim float
-
-        text += f"• {bot_name} — {price:,.0f} so'm\n".replace(',', ' ')  # chiroyli format
-        keyboard_buttons.append([InlineKeyboardButton(
-            f"🤖 {bot_name} — {price:,.0f} so'm".replace(',', ' '),
-            callback_data=f"select_bot_{bot_id}"
-        )])
-
-    keyboard_buttons.append([InlineKeyboardButton("🔙 Asosiy menu", callback_data="main_menu")])
+    text += catalog.text
+    keyboard_buttons = catalog.buttons + [[InlineKeyboardButton("🔙 Asosiy menu", callback_data="main_menu")]]
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
     await message.answer(text, reply_markup=keyboard)
 
@@ -1053,7 +2633,7 @@ async def my_bots_handler(message: types.Message):
         return
     
     user_id = message.from_user.id
-    user_bots = db.get_user_bots(user_id)
+    user_bots = await db.get_user_bots(user_id)
     
     if not user_bots:
         keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
@@ -1068,7 +2648,7 @@ async def my_bots_handler(message: types.Message):
     keyboard_buttons = []
     
     for bot_data in user_bots:
-        # bot_data: id, user_id, bot_token, bot_id, status, created_at, payment_date, days_left, bot_name, bot_file_path, run_command, price
+        # bot_data: id, user_id, bot_token, bot_id, status, created_at, payment_date, days_left, bot_name, bot_file_path, run_command, price, instance_dir, log_path, pid
         bot_id = bot_data[0]
         bot_name = bot_data[8] or "Noma'lum bot"
         status = bot_data[4] or "active"
@@ -1097,21 +2677,32 @@ async def my_bot_detail_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     bot_id = int(callback_query.data.split("_")[2])
     
-    bot_data = db.get_user_bot(bot_id)
+    bot_data = await db.get_user_bot(bot_id)
     if not bot_data or bot_data[1] != user_id:  # bot_data[1] = user_id
         await callback_query.answer("Bot topilmadi!", show_alert=True)
         return
     
-    # bot_data: id, user_id, bot_token, bot_id, status, created_at, payment_date, days_left, bot_name, bot_file_path, run_command, price
+    # bot_data: id, user_id, bot_token, bot_id, status, created_at, payment_date, days_left, bot_name, bot_file_path, run_command, price, instance_dir, log_path, pid
     bot_name = bot_data[8] or "Noma'lum bot"
     status = bot_data[4] or "active"
     status_emoji = "🟢" if status == "active" else "🔴"
     status_text = "Ishlamoqda" if status == "active" else "To'xtatilgan"
+    if status == "crashed":
+        status_emoji, status_text = "⚠️", "Xatolik bilan to'xtagan"
     created_at = bot_data[5] or "N/A"
     
     text = f"🤖 {bot_name}\n\n"
     text += f"📊 Holat: {status_emoji} {status_text}\n"
-    text += f"📅 Yaratilgan: {created_at}\n\n"
+    text += f"📅 Yaratilgan: {created_at}\n"
+    usage = supervisor.usage.get(bot_id)
+    if usage:
+        memory_limit = f" / {BOT_MEMORY_LIMIT_MB} MB" if BOT_MEMORY_LIMIT_MB else " MB"
+        text += f"💾 Xotira: {usage.rss_mb:.1f}{memory_limit}\n"
+        text += f"⚙️ CPU: {usage.cpu_percent:.1f}% (jami {usage.cpu_seconds:.0f} s)\n"
+        text += f"📂 Ochiq fayllar: {usage.fds}\n"
+    elif shared_runtime.hosts(bot_id):
+        text += "🧩 Umumiy runtime da ishlamoqda\n"
+    text += "\n"
     text += "Quyidagi amallardan birini tanlang:"
     
     keyboard_buttons = []
@@ -1132,7 +2723,7 @@ async def my_bots_list_callback(callback_query: types.CallbackQuery):
     
     await callback_query.answer()
     user_id = callback_query.from_user.id
-    user_bots = db.get_user_bots(user_id)
+    user_bots = await db.get_user_bots(user_id)
     
     if not user_bots:
         keyboard = InlineKeyboardMarkup(inline_keyboard=[[
@@ -1176,7 +2767,7 @@ async def start_bot_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     bot_id = int(callback_query.data.split("_")[2])
     
-    bot_data = db.get_user_bot(bot_id)
+    bot_data = await db.get_user_bot(bot_id)
     if not bot_data or bot_data[1] != user_id:
         await callback_query.answer("Bot topilmadi!", show_alert=True)
         return
@@ -1188,56 +2779,17 @@ async def start_bot_callback(callback_query: types.CallbackQuery):
     bot_token = bot_data[2]
     
     try:
-        import zipfile, shutil, time, sys, os, re
-        from datetime import datetime
-        
-        # Bot papkasini topish
-        user_bot_dir = None
-        for root, dirs, files in os.walk("user_bots"):
-            for dir_name in dirs:
-                if f"bot_{user_id}_{bot_data[3]}_" in dir_name:  # bot_data[3] = bot_id
-                    user_bot_dir = os.path.join(root, dir_name)
-                    break
-            if user_bot_dir:
-                break
-        
+        user_bot_dir = bot_data[12]  # bot_data[12] = instance_dir
         if not user_bot_dir or not os.path.exists(user_bot_dir):
             await callback_query.answer("Bot papkasi topilmadi!", show_alert=True)
             return
         
-        # main.py topish
-        main_py = None
-        for root, _, files in os.walk(user_bot_dir):
-            for file in files:
-                if file.lower() in ['main.py', 'bot.py', 'start.py', 'index.py', 'app.py']:
-                    main_py = os.path.join(root, file)
-                    break
-            if main_py:
-                break
-        
-        if not main_py or not os.path.exists(main_py):
+        # Botni kuzatuv ostida ishga tushirish (status va PID supervizor tomonidan yoziladi)
+        launch = await get_bot_launch(bot_data[3])
+        if not await launch_user_bot(bot_id, user_id, bot_data[2], user_bot_dir, launch):  # bot_data[2] = bot_token
             await callback_query.answer("Bot fayli topilmadi!", show_alert=True)
             return
         
-        # Log fayl
-        log_file = os.path.join(user_bot_dir, "log.txt")
-        
-        # Botni ishga tushirish
-        env = os.environ.copy()
-        env["MAKER_USER_ID"] = str(user_id)
-        
-        subprocess.Popen(
-            [sys.executable, main_py],
-            cwd=user_bot_dir,
-            env=env,
-            stdout=open(log_file, "a", encoding="utf-8"),
-            stderr=open(log_file, "a", encoding="utf-8"),
-            creationflags=subprocess.CREATE_NEW_CONSOLE if os.name == "nt" else 0
-        )
-        
-        # Statusni yangilash
-        db.update_user_bot_status(bot_id, "active")
-        
         await callback_query.answer("Bot ishga tushirildi!", show_alert=True)
         
         # Qayta botlar ro'yxatini ko'rsatish
@@ -1258,25 +2810,18 @@ async def delete_my_bot_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     bot_id = int(callback_query.data.split("_")[3])
     
-    bot_data = db.get_user_bot(bot_id)
+    bot_data = await db.get_user_bot(bot_id)
     if not bot_data or bot_data[1] != user_id:
         await callback_query.answer("Bot topilmadi!", show_alert=True)
         return
     
-    # Botni o'chirish
-    db.delete_user_bot(bot_id)
+    # Botni to'xtatish va o'chirish
+    await stop_user_bot(bot_id)
+    await db.delete_user_bot(bot_id)
     
     # Bot papkasini o'chirish (ixtiyoriy)
-    try:
-        import shutil
-        for root, dirs, files in os.walk("user_bots"):
-            for dir_name in dirs:
-                if f"bot_{user_id}_{bot_data[3]}_" in dir_name:
-                    bot_dir = os.path.join(root, dir_name)
-                    shutil.rmtree(bot_dir, ignore_errors=True)
-                    break
-    except:
-        pass
+    if bot_data[12]:  # bot_data[12] = instance_dir
+        shutil.rmtree(bot_data[12], ignore_errors=True)
     
     await callback_query.answer("Bot o'chirildi!", show_alert=True)
     
@@ -1285,22 +2830,21 @@ async def delete_my_bot_callback(callback_query: types.CallbackQuery):
 
 
 @dp.callback_query_handler(lambda c: c.data.startswith("select_bot_"))
-async def select_bot_callback(callback_query: types.CallbackQuery, state: FSMContext):
+async def select_bot_callback(callback_query: types.CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Bot tanlash callback"""
     if not await require_subscription(callback_query):
         return
     
     await callback_query.answer()
-    user_id = callback_query.from_user.id
 
     bot_id = int(callback_query.data.split("_")[2])
-    bot_data = db.get_bot(bot_id)
+    bot_data = (await get_bot_catalog()).by_id.get(bot_id)
     if not bot_data:
         await callback_query.answer("Bot topilmadi!", show_alert=True)
         return
 
     bot_id_db, bot_name, _, run_command, price = bot_data[0], bot_data[1], bot_data[2], bot_data[3], bot_data[4]
-    balance = db.get_balance(user_id)
+    balance = user_ctx.balance
 
     if balance < price:
         await callback_query.answer(
@@ -1324,16 +2868,15 @@ async def select_bot_callback(callback_query: types.CallbackQuery, state: FSMCon
 
 
 @dp.callback_query_handler(lambda c: c.data == "create_bot")
-async def create_bot_callback(callback_query: types.CallbackQuery):
+async def create_bot_callback(callback_query: types.CallbackQuery, user_ctx: UserContext):
     """Bot yaratish menyusiga qaytish"""
     if not await require_subscription(callback_query):
         return
     
     await callback_query.answer()
-    user_id = callback_query.from_user.id
-    bots = db.get_bots()
+    catalog = await get_bot_catalog()
     
-    if not bots:
+    if not catalog.bots:
         keyboard = InlineKeyboardMarkup(inline_keyboard=[[
             InlineKeyboardButton("🔙 Asosiy menu", callback_data="main_menu")
         ]])
@@ -1343,27 +2886,16 @@ async def create_bot_callback(callback_query: types.CallbackQuery):
         )
         return
     
-    balance = db.get_balance(user_id)
+    balance = user_ctx.balance
     text = f"🤖 Bot yaratish\n\n💰 Sizning balansingiz: {balance} so'm\n\nQuyidagi botlardan birini tanlang:\n\n"
-    keyboard_buttons = []
-    for bot_data in bots:
-        bot_id = bot_data[0]
-        bot_name = bot_data[1]
-        price = bot_data[4]
-        
-        text += f"• {bot_name} — {price:,.0f} so'm\n".replace(',', ' ')
-        keyboard_buttons.append([InlineKeyboardButton(
-            f"🤖 {bot_name} — {price:,.0f} so'm".replace(',', ' '),
-            callback_data=f"select_bot_{bot_id}"
-        )])
-    
-    keyboard_buttons.append([InlineKeyboardButton("🔙 Asosiy menu", callback_data="main_menu")])
+    text += catalog.text
+    keyboard_buttons = catalog.buttons + [[InlineKeyboardButton("🔙 Asosiy menu", callback_data="main_menu")]]
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
     await callback_query.message.edit_text(text, reply_markup=keyboard)
 
 
 @dp.message_handler(state=BotCreationStates.waiting_token)
-async def process_bot_token(message: types.Message, state: FSMContext):
+async def process_bot_token(message: types.Message, state: FSMContext, user_ctx: UserContext):
     user_id = message.from_user.id
     
     # Majburiy obunani tekshirish
@@ -1379,143 +2911,52 @@ async def process_bot_token(message: types.Message, state: FSMContext):
         await state.finish()
         return
 
-    bot_data = db.get_bot(bot_id)
+    bot_data = (await get_bot_catalog()).by_id.get(bot_id)
     if not bot_data:
         await message.answer("Bot topilmadi!")
         await state.finish()
         return
 
-    bot_name = bot_data[1]
-    bot_file_path = bot_data[2]
     price = float(bot_data[4])
-    token = message.text.strip()
+    token = (message.text or "").strip()
 
-    if db.get_balance(user_id) < price:
-        await message.answer("Balansingiz yetarli emas!")
+    # Token bot fayllariga yoziladi: faqat Telegram token formati qabul qilinadi
+    if not BOT_TOKEN_FORMAT.fullmatch(token):
+        await message.answer("❌ Token noto'g'ri! Masalan: 123456789:ABCdefGHIjklMNOpqrSTUvwxYZ\n\nTokenni @BotFather dan oling va qayta yuboring:")
+        return
+
+    # Xarid ko'payib ketganda hostni himoya qilish: navbat to'la bo'lsa pul yechilmaydi
+    if await db.count_active_provision_jobs() >= PROVISION_MAX_PENDING:
+        await message.answer("Hozir bot yaratish navbati to'la. Birozdan keyin qayta urinib ko'ring.")
         await state.finish()
         return
 
-    db.update_balance(user_id, -price)
+    # Tekshirish va yechish bitta shartli UPDATE da
+    new_balance = await db.debit_balance(user_id, price, 'purchase', bot_id)
+    if new_balance is None:
+        await message.answer("Balansingiz yetarli emas!")
+        await state.finish()
+        return
+    await db.committed()
+    user_ctx.balance = new_balance
+    await state.finish()
 
     try:
-        import zipfile, shutil, time, sys, os, re
-        from datetime import datetime
+        progress = await message.answer(PROVISION_STATE_TEXTS['queued'])
+        user_bot_dir = os.path.abspath(os.path.join(USER_BOTS_DIR, f"bot_{user_id}_{bot_id}_{time.time_ns()}"))
+        job_id = await db.create_provision_job(
+            user_id, bot_id, token, price, message.chat.id, progress.message_id, user_bot_dir
+        )
+        await db.committed()
+    except Exception as e:
+        logger.error(f"BOT YARATISH XATOSI (user {user_id}): {e}")
+        user_ctx.balance = await db.credit_balance(user_id, price, 'refund', bot_id)
+        await db.committed()
+        await message.answer(f"Xatolik yuz berdi! {price:,.0f} so'm balansingizga qaytarildi.")
+        return
 
-        timestamp = int(time.time())
-        user_bot_dir = f"user_bots/bot_{user_id}_{bot_id}_{timestamp}"
-        os.makedirs(user_bot_dir, exist_ok=True)
-
-        # ZIP extract
-        if bot_file_path.lower().endswith('.zip'):
-            with zipfile.ZipFile(bot_file_path, 'r') as z:
-                z.extractall(user_bot_dir)
-        else:
-            shutil.copy2(bot_file_path, user_bot_dir)
-
-        # Token almashtirish
-        for root, _, files in os.walk(user_bot_dir):
-            for file in files:
-                if file.endswith('.py'):
-                    path = os.path.join(root, file)
-                    try:
-                        async with aiofiles.open(path, 'r', encoding='utf-8') as f:
-                            content = await f.read()
-                        content = content.replace("YOUR_BOT_TOKEN", token)
-                        content = re.sub(r'(BOT_TOKEN|API_TOKEN|token|API_KEY)\s*[:=]\s*[\'"].*?[\'"]', f'\\1 = "{token}"', content, flags=re.IGNORECASE)
-                        
-                        # SQLite bazasi uchun noto'g'ri yo'llarni to'g'irlash (../tests/ kabi)
-                        content = content.replace("'../tests/", "'")
-                        content = content.replace('"../tests/', '"')
-                        content = content.replace("'tests/", "'")
-                        content = content.replace('"tests/', '"')
-                        
-                        # ADMIN_ID -> ADMIN_IDS[0] (NameError oldini olish uchun)
-                        # Faqat mustaqil so'z bo'lsa almashtiramiz (regex yordamida)
-                        content = re.sub(r'\bADMIN_ID\b', 'ADMIN_IDS[0]', content)
-                        
-                        async with aiofiles.open(path, 'w', encoding='utf-8') as f:
-                            await f.write(content)
-                    except Exception as e:
-                        logger.warning(f"Token xato {path}: {e}")
-
-        # main.py topish
-        main_py = None
-        for root, _, files in os.walk(user_bot_dir):
-            for file in files:
-                if file.lower() in ['main.py', 'bot.py', 'start.py', 'index.py', 'app.py']:
-                    main_py = os.path.join(root, file)
-                    break
-            if main_py:
-                break
-        if not main_py:
-            for root, _, files in os.walk(user_bot_dir):
-                for file in files:
-                    if file.endswith('.py'):
-                        main_py = os.path.join(root, file)
-                        break
-                if main_py:
-                    break
-
-        if not main_py or not os.path.exists(main_py):
-            await message.answer("Bot faylida .py topilmadi!")
-            await state.finish()
-            return
-
-        # Yo'lni 100% to'g'rilash — ikki marta qo'shilmaydi!
-        main_py = os.path.abspath(main_py)
-        user_bot_dir_abs = os.path.abspath(user_bot_dir)
-
-        if user_bot_dir_abs.replace('\\', '/') in main_py.replace('\\', '/'):
-            parts = main_py.replace('\\', '/').split(user_bot_dir_abs.replace('\\', '/'))
-            main_py = user_bot_dir_abs + parts[-1].replace('/', os.sep)
-
-        # Oxirgi tekshiruv
-        if not os.path.isfile(main_py):
-            await message.answer("main.py topilmadi — yo‘l buzildi!")
-            await state.finish()
-            return
-
-        # Log
-        log_file = os.path.join(user_bot_dir, "log.txt")
-        with open(log_file, "w", encoding="utf-8") as f:
-            f.write(f"Bot ishga tushirildi: {datetime.now()}\n")
-            f.write(f"Python: {sys.executable}\n")
-            f.write(f"To'g'rilangan yo'l: {main_py}\n")
-            f.write(f"Token: {token[:10]}...{token[-4:]}\n\n")
-
-        # ==== YANGI QO‘SHILGAN QISM — FOYDALANUVCHINI AVTO ADMIN QILISH ====
-        env = os.environ.copy()
-        env["MAKER_USER_ID"] = str(user_id)   # <--- Bu yerga foydalanuvchi ID si yoziladi
-        # ====================================================================
-
-        # Ishga tushirish (env bilan — endi bot ichida os.getenv("MAKER_USER_ID") ishlaydi)
-        subprocess.Popen(
-            [sys.executable, main_py],
-            cwd=user_bot_dir,
-            env=env,  # <--- YANGI: muhit o‘zgaruvchilari uzatilmoqda
-            stdout=open(log_file, "a", encoding="utf-8"),
-            stderr=open(log_file, "a", encoding="utf-8"),
-            creationflags=subprocess.CREATE_NEW_CONSOLE if os.name == "nt" else 0
-        )
-
-        db.add_user_bot(user_id, token, bot_id)
-
-        await message.answer(
-            f"Bot muvaffaqiyatli yaratildi va ISHGA TUSHDI!\n\n"
-            f"Bot: {bot_name}\n"
-            f"To'landi: {price:,.0f} so'm\n"
-            f"Qoldiq: {db.get_balance(user_id):,.0f} so'm\n"
-            f"Papka: <code>{user_bot_dir}</code>\n"
-            f"Log: <code>{log_file}</code>\n\n"
-            f"Agar ishlamasa — log.txt ni oching!",
-            parse_mode="HTML"
-        )
-        await state.finish()
-
-    except Exception as e:
-        logger.error(f"BOT YARATISH XATOSI (user {user_id}): {e}")
-        await message.answer(f"Xatolik:\n<code>{str(e)[:500]}</code>", parse_mode="HTML")
-        await state.finish()
+    # Ochish, token yozish va ishga tushirish fonda: holat shu xabarda yangilanadi
+    start_provision_job(await db.get_provision_job(job_id))
 
 
 @dp.message_handler(commands=['logs'])
@@ -1523,25 +2964,18 @@ async def cmd_view_logs(message: types.Message):
     """Foydalanuvchi o'zining bot loglarini ko'rishi uchun"""
     user_id = message.from_user.id
     
-    # Foydalanuvchining botini topish
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT bot_id FROM user_bots WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,))
-    res = cursor.fetchone()
-    conn.close()
+    # Foydalanuvchining oxirgi boti
+    res = await db.get_last_user_bot_log(user_id)
     
     if not res:
         await message.answer("Sizda hali bot yo'q!")
         return
         
-    # Oxirgi bot papkasini topish
-    import glob
-    bot_dirs = sorted(glob.glob(f"user_bots/bot_{user_id}_*"), reverse=True)
-    if not bot_dirs:
+    log_file = res[1]
+    if not log_file:
         await message.answer("Bot loglari topilmadi!")
         return
         
-    log_file = os.path.join(bot_dirs[0], "log.txt")
     if os.path.exists(log_file):
         try:
             with open(log_file, "r", encoding="utf-8") as f:
@@ -1587,7 +3021,8 @@ async def process_admin_channel(message: types.Message, state: FSMContext):
         chat = await bot.get_chat(channel_username)
         channel_id = str(chat.id)
 
-        if db.add_mandatory_subscription(channel_id, channel_username):
+        if await db.add_mandatory_subscription(channel_id, channel_username):
+            asyncio.create_task(backfill_channel_members(channel_id))
             await message.answer(f"✅ Kanal qo'shildi: {channel_username}")
         else:
             await message.answer("❌ Kanal allaqachon qo'shilgan!")
@@ -1607,7 +3042,7 @@ async def admin_remove_sub_callback(callback_query: types.CallbackQuery):
 
     await callback_query.answer()
 
-    subscriptions = db.get_mandatory_subscriptions()
+    subscriptions = await db.get_mandatory_subscriptions()
     if not subscriptions:
         keyboard = InlineKeyboardMarkup(inline_keyboard=[[
             InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")
@@ -1641,7 +3076,8 @@ async def admin_remove_sub_confirm_callback(callback_query: types.CallbackQuery)
     await callback_query.answer("Kanal olib tashlandi!", show_alert=True)
 
     channel_id = callback_query.data.replace("admin_remove_sub_", "")
-    db.remove_mandatory_subscription(channel_id)
+    await db.remove_mandatory_subscription(channel_id)
+    subscription_cache.invalidate(lambda key: key[1] == channel_id)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")
@@ -1671,6 +3107,14 @@ async def admin_add_bot_callback(callback_query: types.CallbackQuery, state: FSM
     )
 
 
+async def discard_template_upload(bot_file_path):
+    """Qabul qilinmagan faylni o'chirish (katalogdagi bot shu nomdagi faylni ishlatmasa)"""
+    if any(bot_data[2] == bot_file_path for bot_data in (await get_bot_catalog()).bots):
+        return
+    with contextlib.suppress(OSError):
+        os.remove(bot_file_path)
+
+
 @dp.message_handler(state=AdminStates.waiting_bot_file, content_types=['document'])
 async def process_admin_bot_file(message: types.Message, state: FSMContext):
     """Admin: Bot faylini qabul qilish"""
@@ -1687,10 +3131,31 @@ async def process_admin_bot_file(message: types.Message, state: FSMContext):
         os.makedirs("bot_templates", exist_ok=True)
         await file.download(destination_file=bot_file_path)
 
-        await state.update_data(bot_file_path=bot_file_path, file_name=file_name)
+        # Shablonni omborga bir marta ochish: har bir xaridda qayta ochilmaydi
+        # Shifrlangan arxiv RuntimeError, noma'lum siqish usuli NotImplementedError beradi
+        try:
+            template_hash = await run_in_provision_pool(ingest_template, bot_file_path)
+        except (zipfile.BadZipFile, OSError, RuntimeError, NotImplementedError) as e:
+            logger.error(f"Shablonni omborga qo'shib bo'lmadi ({bot_file_path}): {e}")
+            await discard_template_upload(bot_file_path)
+            await message.answer(
+                f"❌ Faylni ochib bo'lmadi: {e}\n\n"
+                "ZIP arxiv buzilmagan va parolsiz ekanini tekshirib, qayta yuboring."
+            )
+            return
+
+        # Reja foydalanuvchi pul to'lashidan oldin tekshiriladi
+        errors, warnings = template_problems(load_template_manifest(template_hash))
+        if errors:
+            await discard_template_upload(bot_file_path)
+            await message.answer("❌ Shablonda xatolik bor, qabul qilinmadi:\n\n" + "\n".join(errors[:10]))
+            return
+
+        await state.update_data(bot_file_path=bot_file_path, file_name=file_name, template_hash=template_hash)
         await AdminStates.waiting_bot_name.set()
 
-        await message.answer("✅ Bot fayli qabul qilindi!\n\nBot nomini kiriting:")
+        notes = "".join(f"⚠️ {warning}\n\n" for warning in warnings)
+        await message.answer(f"✅ Bot fayli qabul qilindi!\n\n{notes}Bot nomini kiriting:")
     else:
         await message.answer("❌ Iltimos, fayl yuboring!")
 
@@ -1748,19 +3213,96 @@ async def process_admin_run_command(message: types.Message, state: FSMContext):
     bot_name = data.get('bot_name')
     bot_file_path = data.get('bot_file_path')
     price = data.get('price')
+    template_hash = data.get('template_hash')
 
-    db.add_bot(bot_name, bot_file_path, run_command, price)
+    # Kirish fayli va papka shu yerda bir marta aniqlanadi: har ishga tushirishda papka qidirilmaydi
+    run_argv = run_cwd = None
+    manifest = load_template_manifest(template_hash) if template_hash else None
+    notes = ""
+    if manifest is not None:
+        try:
+            argv, run_cwd = resolve_launch(run_command, manifest)
+        except ValueError as e:
+            await message.answer(f"❌ {e}\n\nRun command ni qayta kiriting:")
+            return
+        run_argv = json.dumps(argv)
+        if argv[0] not in PYTHON_ALIASES and not shutil.which(argv[0]):
+            notes = f"\n\n⚠️ Serverda {argv[0]} topilmadi"
+
+    await db.add_bot(bot_name, bot_file_path, run_command, price, template_hash, run_argv, run_cwd)
+    app_cache.invalidate('bot_catalog')
 
     await message.answer(
         f"✅ Bot qo'shildi!\n\n"
         f"🤖 Nomi: {bot_name}\n"
         f"💰 Narxi: {price} so'm\n"
         f"▶️ Run command: {run_command}"
+        + (f"\n📂 Papka: {run_cwd}" if run_cwd and run_cwd != '.' else "")
+        + notes
     )
 
     await state.finish()
 
 
+async def send_users_export(chat_id, columns, date_from=None, date_to=None, fmt='csv'):
+    """Foydalanuvchilar eksportini (.csv.gz / .tsv.gz) tayyorlash va yuborish"""
+    filename = f"users_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}.gz"
+    os.makedirs("temp", exist_ok=True)
+    filepath = f"temp/{filename}"
+    delimiter = '\t' if fmt == 'tsv' else ','
+    try:
+        count = await db.export_users(filepath, columns, date_from, date_to, delimiter)
+        period = f"\n📅 {date_from or '...'} — {date_to or '...'}" if date_from or date_to else ""
+        await bot.send_document(
+            chat_id=chat_id,
+            document=types.InputFile(filepath),
+            caption=f"👥 Foydalanuvchilar ro'yxati\n\nJami: {count} ta foydalanuvchi{period}"
+        )
+    finally:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+    return count
+
+
+@dp.message_handler(commands=['export_users'])
+async def export_users_handler(message: types.Message):
+    """Admin: /export_users [csv|tsv] [cols=id,name,...] [from=YYYY-MM-DD] [to=YYYY-MM-DD]"""
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    fmt = 'csv'
+    columns = USER_EXPORT_DEFAULT_COLUMNS
+    dates = {'from': None, 'to': None}
+    try:
+        for arg in message.get_args().split():
+            key, _, value = arg.partition('=')
+            if not value and key in ('csv', 'tsv'):
+                fmt = key
+            elif key == 'cols':
+                columns = [name for name in value.split(',') if name]
+                unknown = [name for name in columns if name not in USER_EXPORT_COLUMNS]
+                if unknown or not columns:
+                    raise ValueError(f"Noma'lum ustun: {', '.join(unknown)}")
+            elif key in dates:
+                dates[key] = datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+            else:
+                raise ValueError(f"Noma'lum parametr: {arg}")
+    except ValueError as e:
+        await message.answer(
+            f"❌ {e}\n\n"
+            f"Format: /export_users [csv|tsv] [cols=id,name] [from=2024-01-01] [to=2024-12-31]\n"
+            f"Ustunlar: {', '.join(USER_EXPORT_COLUMNS)}"
+        )
+        return
+
+    await message.answer("⏳ Eksport tayyorlanmoqda...")
+    try:
+        await send_users_export(message.chat.id, columns, dates['from'], dates['to'], fmt)
+    except Exception as e:
+        logger.error(f"Error sending users file: {e}")
+        await message.answer(f"❌ Xatolik yuz berdi: {str(e)}")
+
+
 @dp.callback_query_handler(lambda c: c.data == "admin_users")
 async def admin_users_callback(callback_query: types.CallbackQuery):
     """Admin: Foydalanuvchilar"""
@@ -1770,74 +3312,180 @@ async def admin_users_callback(callback_query: types.CallbackQuery):
 
     await callback_query.answer()
 
-    # Foydalanuvchilar ro'yxatini olish
-    users = db.get_all_users()
-
-    # .txt fayl yaratish
-    users_text = "FOYDALANUVCHILAR RO'YXATI\n"
-    users_text += "=" * 70 + "\n\n"
-    users_text += f"{'№':<5} {'ID':<12} {'Ism':<20} {'Username':<20} {'Telefon':<15} {'Balans':<10} {'Sana':<20}\n"
-    users_text += "-" * 120 + "\n"
-
-    for idx, user in enumerate(users, 1):
-        user_id = user[0]
-        username = user[1] or "N/A"
-        full_name = user[2] or "N/A"
-        phone_number = user[3] or "N/A"
-        balance = user[4] or 0
-        created_at = user[7] or "N/A"
-
-        # Sana formatini qisqartirish
-        if created_at != "N/A":
-            try:
-                dt = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S")
-                created_at = dt.strftime("%d.%m.%Y %H:%M")
-            except:
-                pass
-
-        users_text += f"{idx:<5} {user_id:<12} {full_name[:18]:<20} {username[:18]:<20} {phone_number[:13]:<15} {balance:<10.2f} {created_at:<20}\n"
-
-    users_text += "\n" + "=" * 70 + "\n"
-    users_text += f"Jami foydalanuvchilar: {len(users)}"
-
-    # Faylni saqlash
-    filename = f"users_list_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-    os.makedirs("temp", exist_ok=True)
-    filepath = f"temp/{filename}"
-
-    async with aiofiles.open(filepath, 'w', encoding='utf-8') as f:
-        await f.write(users_text)
-
-    # Faylni yuborish
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")
+    ]])
+    await callback_query.message.edit_text("⏳ Foydalanuvchilar ro'yxati tayyorlanmoqda...")
     try:
-        document = types.InputFile(filepath)
-        await bot.send_document(
-            chat_id=callback_query.from_user.id,
-            document=document,
-            caption=f"👥 Foydalanuvchilar ro'yxati\n\nJami: {len(users)} ta foydalanuvchi"
-        )
-
-        # Faylni o'chirish
-        os.remove(filepath)
-
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")
-        ]])
+        count = await send_users_export(callback_query.from_user.id, USER_EXPORT_DEFAULT_COLUMNS)
         await callback_query.message.edit_text(
-            f"✅ Foydalanuvchilar ro'yxati yuborildi!\n\nJami: {len(users)} ta foydalanuvchi",
+            f"✅ Foydalanuvchilar ro'yxati yuborildi!\n\nJami: {count} ta foydalanuvchi\n\n"
+            f"Ustunlar va sana bo'yicha eksport: /export_users",
             reply_markup=keyboard
         )
     except Exception as e:
         logger.error(f"Error sending users file: {e}")
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")
-        ]])
         await callback_query.message.edit_text(
             f"❌ Xatolik yuz berdi: {str(e)}",
             reply_markup=keyboard
         )
 
 
+def admin_users_keyboard(users, navigation=()):
+    """Foydalanuvchilar ro'yxati tugmalari: har biri kartaga olib boradi"""
+    buttons = []
+    for user_id, full_name, username, balance, created_at in users:
+        label = full_name or (f"@{username}" if username else str(user_id))
+        buttons.append([InlineKeyboardButton(f"👤 {label} · {user_id} · {balance:.0f} so'm", callback_data=f"admin_ucard_{user_id}")])
+    if navigation:
+        buttons.append(list(navigation))
+    buttons.append([InlineKeyboardButton("🔎 Qidirish", callback_data="admin_usearch")])
+    buttons.append([InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@dp.callback_query_handler(lambda c: c.data == "admin_browse_users" or c.data.startswith("admin_upage_"))
+async def admin_browse_users_callback(callback_query: types.CallbackQuery):
+    """Admin: foydalanuvchilarni sahifalab ko'rish (yangidan eskiga)"""
+    if callback_query.from_user.id != ADMIN_ID:
+        await callback_query.answer("Siz admin emassiz!", show_alert=True)
+        return
+
+    await callback_query.answer()
+    # admin_upage_o_<user_id> - eskiroqlar, admin_upage_n_<user_id> - yangiroqlar
+    cursor_user_id, older = None, True
+    if callback_query.data.startswith("admin_upage_"):
+        direction, cursor_user_id = callback_query.data.split("_")[2:]
+        cursor_user_id, older = int(cursor_user_id), direction == "o"
+
+    # Keyingi sahifa borligini bilish uchun bitta ortiqcha qator olinadi
+    users = await db.get_users_page(cursor_user_id, ADMIN_USERS_PAGE_SIZE + 1, older)
+    has_more = len(users) > ADMIN_USERS_PAGE_SIZE
+    if has_more:
+        users = users[:ADMIN_USERS_PAGE_SIZE] if older else users[1:]
+
+    has_newer = cursor_user_id is not None and (older or has_more)
+    has_older = has_more if older else cursor_user_id is not None
+    navigation = []
+    if users and has_newer:
+        navigation.append(InlineKeyboardButton("◀️ Yangiroq", callback_data=f"admin_upage_n_{users[0][0]}"))
+    if users and has_older:
+        navigation.append(InlineKeyboardButton("Eskiroq ▶️", callback_data=f"admin_upage_o_{users[-1][0]}"))
+
+    text = "👥 Foydalanuvchilar (yangidan eskiga)" if users else "❌ Foydalanuvchilar topilmadi"
+    await callback_query.message.edit_text(text, reply_markup=admin_users_keyboard(users, navigation))
+
+
+@dp.callback_query_handler(lambda c: c.data == "admin_usearch")
+async def admin_user_search_callback(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != ADMIN_ID:
+        await callback_query.answer("Siz admin emassiz!", show_alert=True)
+        return
+
+    await callback_query.answer()
+    await AdminStates.waiting_user_search.set()
+    await callback_query.message.answer("🔎 Ism, username, telefon yoki ID ni kiriting:")
+
+
+async def show_user_search_results(message: types.Message, query):
+    users = await db.search_users(query, ADMIN_USERS_PAGE_SIZE)
+    if query.isdigit():
+        card = await db.get_user_card(int(query))
+        if card and all(user[0] != card[0] for user in users):
+            users.insert(0, (card[0], card[2], card[1], card[4], card[5]))
+    text = f"🔎 \"{query}\" bo'yicha natijalar:" if users else f"❌ \"{query}\" bo'yicha hech narsa topilmadi"
+    await message.answer(text, reply_markup=admin_users_keyboard(users))
+
+
+@dp.message_handler(commands=['find'])
+async def find_user_handler(message: types.Message):
+    """Admin: /find <ism | @username | telefon | ID>"""
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    query = message.get_args().strip()
+    if not query:
+        await message.answer("❌ Noto'g'ri format! Masalan: /find Ali yoki /find 99890")
+        return
+    await show_user_search_results(message, query)
+
+
+@dp.message_handler(state=AdminStates.waiting_user_search)
+async def process_admin_user_search(message: types.Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    await state.finish()
+    await show_user_search_results(message, (message.text or "").strip())
+
+
+async def show_admin_user_card(message: types.Message, user_id):
+    card = await db.get_user_card(user_id)
+    if not card:
+        await message.edit_text("❌ Foydalanuvchi topilmadi")
+        return
+
+    user_id, username, full_name, phone_number, balance, created_at, is_reachable, referrals, banned = card
+    text = (
+        f"👤 {full_name or 'N/A'}\n\n"
+        f"🆔 ID: {user_id}\n"
+        f"👤 Username: @{username or 'N/A'}\n"
+        f"📱 Telefon: {phone_number or 'N/A'}\n"
+        f"💰 Balans: {balance} so'm\n"
+        f"👥 Referrallar: {referrals}\n"
+        f"📅 Ro'yxatdan o'tgan: {created_at}\n"
+        f"📨 Xabar yetkaziladi: {'ha' if is_reachable else 'yo‘q'}\n"
+        f"🚫 Ban: {'ha' if banned else 'yo‘q'}"
+    )
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton("💳 Balans to'ldirish", callback_data=f"admin_utopup_{user_id}")],
+        [InlineKeyboardButton("✅ Bandan chiqarish" if banned else "🚫 Ban qilish", callback_data=f"admin_uban_{user_id}")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="admin_browse_users")]
+    ])
+    await message.edit_text(text, reply_markup=keyboard)
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith("admin_ucard_"))
+async def admin_user_card_callback(callback_query: types.CallbackQuery):
+    """Admin: foydalanuvchi kartasi"""
+    if callback_query.from_user.id != ADMIN_ID:
+        await callback_query.answer("Siz admin emassiz!", show_alert=True)
+        return
+
+    await callback_query.answer()
+    await show_admin_user_card(callback_query.message, int(callback_query.data.split("_")[2]))
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith("admin_uban_"))
+async def admin_user_ban_callback(callback_query: types.CallbackQuery):
+    """Admin: kartadan ban qilish / bandan chiqarish"""
+    if callback_query.from_user.id != ADMIN_ID:
+        await callback_query.answer("Siz admin emassiz!", show_alert=True)
+        return
+
+    user_id = int(callback_query.data.split("_")[2])
+    if await db.is_banned(user_id):
+        await db.unban_user(user_id)
+        await callback_query.answer("✅ Foydalanuvchi bandan chiqarildi")
+    else:
+        await db.ban_user(user_id, "Admin panel")
+        await callback_query.answer("✅ Foydalanuvchi ban qilindi")
+    await show_admin_user_card(callback_query.message, user_id)
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith("admin_utopup_"))
+async def admin_user_topup_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    """Admin: kartadan balans to'ldirish (summa process_admin_topup_amount da qabul qilinadi)"""
+    if callback_query.from_user.id != ADMIN_ID:
+        await callback_query.answer("Siz admin emassiz!", show_alert=True)
+        return
+
+    await callback_query.answer()
+    await state.update_data(target_user_id=int(callback_query.data.split("_")[2]))
+    await AdminStates.waiting_topup_amount.set()
+    await callback_query.message.answer("To'ldirish summasini kiriting (so'm):")
+
+
 @dp.callback_query_handler(lambda c: c.data == "admin_active_users")
 async def admin_active_users_callback(callback_query: types.CallbackQuery):
     """Admin: Aktiv foydalanuvchilar"""
@@ -1846,7 +3494,7 @@ async def admin_active_users_callback(callback_query: types.CallbackQuery):
         return
 
     await callback_query.answer()
-    active = db.get_active_users()
+    active = await db.get_active_users()
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")
@@ -1865,7 +3513,7 @@ async def admin_total_users_callback(callback_query: types.CallbackQuery):
         return
 
     await callback_query.answer()
-    total = db.get_total_users()
+    total = await db.get_total_users()
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")
@@ -1884,7 +3532,7 @@ async def admin_bots_callback(callback_query: types.CallbackQuery):
         return
 
     await callback_query.answer()
-    total = db.get_total_bots()
+    total = await db.get_total_bots()
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")
@@ -1926,7 +3574,7 @@ async def admin_change_referral_callback(callback_query: types.CallbackQuery, st
         return
 
     await callback_query.answer()
-    current_amount = db.get_referral_amount()
+    current_amount = await get_referral_amount()
     await AdminStates.waiting_referral_amount.set()
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[
@@ -1946,7 +3594,8 @@ async def process_admin_referral_amount(message: types.Message, state: FSMContex
 
     try:
         amount = float(message.text.strip())
-        db.set_referral_amount(amount)
+        await db.set_referral_amount(amount)
+        app_cache.invalidate('referral_amount')
 
         await message.answer(f"✅ Referral summa o'zgartirildi: {amount} so'm")
 
@@ -1961,7 +3610,7 @@ async def admin_delete_bot_list(callback_query: types.CallbackQuery):
         await callback_query.answer("Siz admin emassiz!", show_alert=True)
         return
     await callback_query.answer()
-    bots = db.get_bots()
+    bots = (await get_bot_catalog()).bots
     if not bots:
         keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton("Orqaga", callback_data="admin_panel")]])
         await callback_query.message.edit_text("Hozircha botlar yo'q.", reply_markup=keyboard)
@@ -1986,15 +3635,14 @@ async def admin_delete_bot_confirm(callback_query: types.CallbackQuery):
         return
 
     bot_id = int(callback_query.data.split("_")[2])
-    bot = db.get_bot(bot_id)
+    bot = await db.get_bot(bot_id)
     if not bot:
         await callback_query.answer("Bot topilmadi!", show_alert=True)
         return
 
     # Bazadan o'chirish
-    cursor = db.conn.cursor()
-    cursor.execute('DELETE FROM bots WHERE bot_id = ?', (bot_id,))
-    db.conn.commit()
+    await db.delete_bot(bot_id)
+    app_cache.invalidate('bot_catalog')
 
     # Faylni o'chirish
     try:
@@ -2023,6 +3671,7 @@ async def admin_panel_callback(callback_query: types.CallbackQuery):
         [InlineKeyboardButton("🗑 Bot o'chirish", callback_data="admin_delete_bot")],
         [InlineKeyboardButton("💳 To'lovlarni ko'rish", callback_data="admin_payments")],
         [InlineKeyboardButton("👥 Foydalanuvchilar", callback_data="admin_users")],
+        [InlineKeyboardButton("🔎 Foydalanuvchilarni ko'rish", callback_data="admin_browse_users")],
         [InlineKeyboardButton("📊 Aktiv foydalanuvchilar", callback_data="admin_active_users")],
         [InlineKeyboardButton("👤 Umumiy foydalanuvchilar", callback_data="admin_total_users")],
         [InlineKeyboardButton("🤖 Botlar", callback_data="admin_bots")],
@@ -2041,7 +3690,7 @@ async def admin_payments_callback(callback_query: types.CallbackQuery):
         return
     
     await callback_query.answer()
-    payments = db.get_pending_payments()
+    payments = await db.get_pending_payments()
     
     if not payments:
         keyboard = InlineKeyboardMarkup(inline_keyboard=[[
@@ -2057,7 +3706,7 @@ async def admin_payments_callback(callback_query: types.CallbackQuery):
     payment = payments[0]
     payment_id, user_id, amount, screenshot_path, status, created_at = payment[0], payment[1], payment[2], payment[3], payment[4], payment[5]
     
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     username = user[1] if user else "N/A"
     
     text = f"💳 To'lov #{payment_id}\n\n"
@@ -2096,20 +3745,15 @@ async def approve_payment_callback(callback_query: types.CallbackQuery):
         await callback_query.answer("Siz admin emassiz!", show_alert=True)
         return
     
-    await callback_query.answer()
     payment_id = int(callback_query.data.split("_")[2])
-    payment = db.get_payment(payment_id)
-    
-    if not payment:
-        await callback_query.answer("To'lov topilmadi!", show_alert=True)
+
+    # To'lovni tasdiqlash: faqat 'pending' holatidagi to'lov, ikki marta bosilsa ham bir marta qo'shiladi
+    result = await db.approve_payment(payment_id)
+    if not result:
+        await callback_query.answer("To'lov topilmadi yoki allaqachon ko'rib chiqilgan!", show_alert=True)
         return
-    
-    user_id = payment[1]
-    amount = payment[2]
-    
-    # To'lovni tasdiqlash
-    db.update_payment_status(payment_id, "approved")
-    db.update_balance(user_id, amount)
+    await db.committed()
+    user_id, amount, new_balance = result
     
     # Xabarni yangilash
     try:
@@ -2117,19 +3761,16 @@ async def approve_payment_callback(callback_query: types.CallbackQuery):
             caption=f"✅ To'lov tasdiqlandi!\n\n"
                     f"👤 Foydalanuvchi ID: {user_id}\n"
                     f"💰 Summa: {amount} so'm\n"
-                    f"💵 Yangi balans: {db.get_balance(user_id)} so'm"
+                    f"💵 Yangi balans: {new_balance} so'm"
         )
     except:
         pass
     
     # Foydalanuvchiga xabar
-    try:
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"✅ To'lovingiz tasdiqlandi!\n\n💰 Summa: {amount} so'm\n💵 Joriy balans: {db.get_balance(user_id)} so'm"
-        )
-    except:
-        pass
+    await notify_user(
+        user_id,
+        f"✅ To'lovingiz tasdiqlandi!\n\n💰 Summa: {amount} so'm\n💵 Joriy balans: {new_balance} so'm"
+    )
     
     await callback_query.answer("To'lov tasdiqlandi!", show_alert=True)
 
@@ -2143,10 +3784,10 @@ async def reject_payment_callback(callback_query: types.CallbackQuery, state: FS
     
     await callback_query.answer()
     payment_id = int(callback_query.data.split("_")[2])
-    payment = db.get_payment(payment_id)
+    payment = await db.get_payment(payment_id)
     
-    if not payment:
-        await callback_query.answer("To'lov topilmadi!", show_alert=True)
+    if not payment or payment[4] != 'pending':
+        await callback_query.answer("To'lov topilmadi yoki allaqachon ko'rib chiqilgan!", show_alert=True)
         return
     
     # State ga payment_id ni saqlash
@@ -2189,20 +3830,20 @@ async def process_reject_reason(message: types.Message, state: FSMContext):
     amount = data.get('amount')
     reason = message.text.strip()
     
-    # To'lovni rad etish
-    db.update_payment_status(payment_id, "rejected")
+    # To'lovni rad etish (faqat 'pending' holatidagi)
+    if not await db.reject_payment(payment_id):
+        await message.answer("❌ To'lov allaqachon ko'rib chiqilgan.")
+        await state.finish()
+        return
     
     # Foydalanuvchiga xabar
-    try:
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"❌ To'lovingiz rad etildi.\n\n"
-                 f"💰 Summa: {amount} so'm\n"
-                 f"📝 Sabab: {reason}\n\n"
-                 f"Iltimos, qayta urinib ko'ring yoki admin bilan bog'laning."
-        )
-    except:
-        pass
+    await notify_user(
+        user_id,
+        f"❌ To'lovingiz rad etildi.\n\n"
+        f"💰 Summa: {amount} so'm\n"
+        f"📝 Sabab: {reason}\n\n"
+        f"Iltimos, qayta urinib ko'ring yoki admin bilan bog'laning."
+    )
     
     await message.answer(f"✅ To'lov rad etildi va foydalanuvchiga xabar yuborildi.")
     await state.finish()
@@ -2219,26 +3860,1108 @@ async def process_admin_topup_amount(message: types.Message, state: FSMContext):
         data = await state.get_data()
         target_user_id = data.get('target_user_id')
         
-        db.update_balance(target_user_id, amount)
+        new_balance = await db.credit_balance(target_user_id, amount, 'admin_topup')
+        if new_balance is None:
+            await message.answer(f"❌ Foydalanuvchi {target_user_id} topilmadi!")
+            await state.finish()
+            return
+        await db.committed()
         await message.answer(
             f"✅ Balans to'ldirildi!\n\n"
             f"👤 Foydalanuvchi ID: {target_user_id}\n"
             f"💰 Summa: {amount} so'm\n"
-            f"💵 Yangi balans: {db.get_balance(target_user_id)} so'm"
+            f"💵 Yangi balans: {new_balance} so'm"
+        )
+        await notify_user(
+            target_user_id,
+            f"✅ Sizning balansingiz {amount} so'm ga to'ldirildi!\n\n💵 Joriy balans: {new_balance} so'm"
         )
-        try:
-            await bot.send_message(
-                chat_id=target_user_id,
-                text=f"✅ Sizning balansingiz {amount} so'm ga to'ldirildi!\n\n💵 Joriy balans: {db.get_balance(target_user_id)} so'm"
-            )
-        except:
-            pass
         
         await state.finish()
     except ValueError:
         await message.answer("❌ Noto'g'ri raqam! Iltimos, raqam kiriting.")
 
 
+# ==================== BOT SUPERVIZOR ====================
+BOT_ENTRY_FILES = ['main.py', 'bot.py', 'start.py', 'index.py', 'app.py']
+# Bot jarayoniga uzatilmaydigan maker muhit o'zgaruvchilari (BOT_TOKEN bot tokeni bilan almashtiriladi)
+MAKER_SECRET_ENV = ('BOT_TOKEN', 'TELEGRAM_API_ID', 'TELEGRAM_API_HASH')
+
+
+def find_bot_entry(user_bot_dir):
+    """Botning ishga tushiriladigan .py fayli"""
+    for root, _, files in os.walk(user_bot_dir):
+        for file in files:
+            if file.lower() in BOT_ENTRY_FILES:
+                return os.path.abspath(os.path.join(root, file))
+    return None
+
+
+def process_alive(pid, user_bot_dir):
+    """PID tirikmi va shu bot papkasida (yoki uning ichida) ishlayaptimi (PID qayta ishlatilgan bo'lishi mumkin)"""
+    try:
+        os.kill(pid, 0)
+    except (ProcessLookupError, PermissionError):
+        return False
+    try:
+        cwd = os.path.realpath(f"/proc/{pid}/cwd")
+    except OSError:
+        return False
+    root = os.path.realpath(user_bot_dir)
+    return cwd == root or cwd.startswith(root + os.sep)
+
+
+def write_cgroup_file(path, value):
+    # "r+": cgroupfs da fayl yaratib bo'lmaydi, yo'q fayl aniq FileNotFoundError beradi
+    with open(path, "r+") as f:
+        f.write(str(value))
+
+
+def setup_bot_cgroup(user_bot_id, pid):
+    """cgroup v2: bot uchun alohida guruh (xotira, CPU, PID cheklovlari). Muvaffaqiyatsiz bo'lsa None"""
+    if not BOT_CGROUP_ROOT:
+        return None
+    path = os.path.join(BOT_CGROUP_ROOT, f"bot_{user_bot_id}")
+
+    def write_optional(name, value):
+        # Swap hisobi yoki cpu/pids kontrolleri yoqilmagan hostda fayl bo'lmaydi: cheklovsiz davom etamiz
+        try:
+            write_cgroup_file(os.path.join(path, name), value)
+        except FileNotFoundError:
+            logger.info(f"Bot {user_bot_id}: cgroup da {name} yo'q, o'tkazib yuborildi")
+
+    try:
+        os.makedirs(path, exist_ok=True)
+        if BOT_MEMORY_LIMIT_MB:
+            # memory.max majburiy: cgroup bo'lsa apply_bot_rlimits xotirani rlimit bilan cheklamaydi
+            write_cgroup_file(os.path.join(path, "memory.max"), BOT_MEMORY_LIMIT_MB * 1024 * 1024)
+            write_optional("memory.swap.max", 0)
+        if BOT_CPU_QUOTA_PERCENT:
+            write_optional("cpu.max", f"{BOT_CPU_QUOTA_PERCENT * 1000} 100000")
+        if BOT_MAX_PIDS:
+            write_optional("pids.max", BOT_MAX_PIDS)
+        write_cgroup_file(os.path.join(path, "cgroup.procs"), pid)
+        return path
+    except OSError as e:
+        logger.warning(f"Bot {user_bot_id}: cgroup sozlanmadi ({e}), faqat rlimit ishlatiladi")
+        remove_bot_cgroup(path)
+        return None
+
+
+def remove_bot_cgroup(path):
+    if path:
+        with contextlib.suppress(OSError):
+            os.rmdir(path)
+
+
+def enable_cgroup_controllers():
+    """BOT_CGROUP_ROOT ichidagi guruhlar uchun memory/cpu/pids kontrollerlarini yoqish"""
+    if not BOT_CGROUP_ROOT:
+        return
+    try:
+        os.makedirs(BOT_CGROUP_ROOT, exist_ok=True)
+        write_cgroup_file(os.path.join(BOT_CGROUP_ROOT, "cgroup.subtree_control"), "+memory +cpu +pids")
+    except OSError as e:
+        logger.warning(f"cgroup kontrollerlari yoqilmadi ({BOT_CGROUP_ROOT}): {e}")
+
+
+def apply_bot_rlimits(pid, cgroup):
+    """Ishga tushgan jarayonga rlimit qo'yish (Linux prlimit). cgroup bo'lsa xotira va CPU ni u cheklaydi"""
+    if resource is None or not hasattr(resource, "prlimit"):
+        return
+    limits = []
+    if BOT_MAX_OPEN_FILES:
+        limits.append((resource.RLIMIT_NOFILE, BOT_MAX_OPEN_FILES))
+    if BOT_MEMORY_LIMIT_MB and not cgroup:
+        # RLIMIT_DATA (heap + anonim mmap) RSS ga eng yaqin rlimit
+        limits.append((resource.RLIMIT_DATA, BOT_MEMORY_LIMIT_MB * 1024 * 1024))
+    for kind, limit in limits:
+        try:
+            resource.prlimit(pid, kind, (limit, limit))
+        except (OSError, ValueError) as e:
+            logger.warning(f"PID {pid}: rlimit qo'yilmadi: {e}")
+    if BOT_NICE and not cgroup:
+        with contextlib.suppress(OSError):
+            os.setpriority(os.PRIO_PROCESS, pid, BOT_NICE)
+
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def read_process_usage(pid):
+    """/proc/<pid> dan (RSS MB, CPU soniya, ochiq fd soni). Jarayon yo'q bo'lsa None"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # comm qavs ichida va bo'sh joy bo'lishi mumkin: oxirgi ')' dan keyin bo'lamiz
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime + stime
+        rss_kb = 0
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss_kb = int(line.split()[1])
+                    break
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except (OSError, IndexError, ValueError):
+        return None
+    return rss_kb / 1024, cpu_seconds, fds
+
+
+class BotUsage:
+    """Bot jarayonining oxirgi o'lchovi"""
+    __slots__ = ('rss_mb', 'cpu_seconds', 'cpu_percent', 'fds', 'sampled_at')
+
+    def __init__(self, rss_mb, cpu_seconds, cpu_percent, fds, sampled_at):
+        self.rss_mb = rss_mb
+        self.cpu_seconds = cpu_seconds
+        self.cpu_percent = cpu_percent
+        self.fds = fds
+        self.sampled_at = sampled_at
+
+
+class BotSupervisor:
+    """Foydalanuvchi botlari jarayonlarini kuzatish.
+
+    Har bir bot uchun alohida task jarayonni ishga tushiradi, PID ni user_bots ga
+    yozadi va chiqishini kutadi. Crash bo'lsa eksponensial backoff bilan qayta
+    ishga tushiradi; qisqa vaqtda juda ko'p crash bo'lsa botni 'crashed' holatiga
+    o'tkazib egasiga xabar beradi. 0 kod bilan chiqqan bot 'stopped' bo'ladi.
+    """
+
+    def __init__(self):
+        self._tasks = {}        # user_bot_id -> kuzatuvchi task
+        self._procs = {}        # user_bot_id -> ishlayotgan jarayon
+        self._stopping = set()
+        self.usage = {}         # user_bot_id -> BotUsage
+        self._sampler = None
+
+    def is_running(self, user_bot_id):
+        return user_bot_id in self._tasks
+
+    def start(self, user_bot_id, user_id, argv, user_bot_dir, cwd, token=None):
+        """Botni kuzatuv ostida ishga tushirish (allaqachon ishlayotgan bo'lsa hech narsa qilmaydi).
+
+        argv - tayyor buyruq, cwd - jarayon papkasi (bot papkasi yoki uning ichidagi papka).
+        """
+        if user_bot_id not in self._tasks:
+            self._stopping.discard(user_bot_id)
+            self._tasks[user_bot_id] = asyncio.create_task(
+                self._supervise(user_bot_id, user_id, argv, user_bot_dir, cwd, token)
+            )
+        if self._sampler is None:
+            self._sampler = asyncio.create_task(self._sample_usage())
+
+    async def _spawn(self, user_id, argv, user_bot_dir, cwd, token):
+        env = os.environ.copy()
+        env["MAKER_USER_ID"] = str(user_id)
+        # Maker ning o'z sirlari botga o'tmasin; shablon tokenni os.getenv("BOT_TOKEN") dan o'qishi mumkin
+        for name in MAKER_SECRET_ENV:
+            env.pop(name, None)
+        if token:
+            env["BOT_TOKEN"] = token
+        kwargs = {'creationflags': subprocess.CREATE_NEW_CONSOLE} if os.name == "nt" else {'start_new_session': True}
+        with open(os.path.join(user_bot_dir, BOT_LOG_FILE), "a", encoding="utf-8") as log:
+            return await asyncio.create_subprocess_exec(
+                *argv, cwd=cwd, env=env, stdout=log, stderr=log, **kwargs
+            )
+
+    async def _supervise(self, user_bot_id, user_id, argv, user_bot_dir, cwd, token):
+        crashes = deque()
+        backoff = BOT_RESTART_BACKOFF_BASE
+        try:
+            while True:
+                proc = await self._spawn(user_id, argv, user_bot_dir, cwd, token)
+                cgroup = setup_bot_cgroup(user_bot_id, proc.pid)
+                apply_bot_rlimits(proc.pid, cgroup)
+                self._procs[user_bot_id] = proc
+                await db.set_user_bot_process(user_bot_id, proc.pid)
+                started = time.monotonic()
+                try:
+                    exit_code = await proc.wait()
+                finally:
+                    self._procs.pop(user_bot_id, None)
+                    self.usage.pop(user_bot_id, None)
+                    remove_bot_cgroup(cgroup)
+
+                if user_bot_id in self._stopping:
+                    return
+                if exit_code == 0:
+                    logger.info(f"Bot {user_bot_id} o'zi to'xtadi")
+                    await db.record_user_bot_exit(user_bot_id, exit_code, 'stopped')
+                    return
+
+                now = time.monotonic()
+                if now - started >= BOT_STABLE_AFTER:
+                    backoff = BOT_RESTART_BACKOFF_BASE
+                    crashes.clear()
+                crashes.append(now)
+                while crashes and now - crashes[0] > BOT_CRASH_LOOP_WINDOW:
+                    crashes.popleft()
+
+                if len(crashes) >= BOT_CRASH_LOOP_LIMIT:
+                    logger.error(f"Bot {user_bot_id} crash-loop: {len(crashes)} marta, oxirgi kod {exit_code}")
+                    await db.record_user_bot_exit(user_bot_id, exit_code, 'crashed')
+                    await notify_user(
+                        user_id,
+                        "⚠️ Botingiz qayta-qayta xatolik bilan to'xtadi va o'chirib qo'yildi.\n\n"
+                        "Sababini /logs orqali ko'ring, so'ng \"🤖 Mening botlarim\" dan qayta ishga tushiring."
+                    )
+                    return
+
+                logger.warning(f"Bot {user_bot_id} {exit_code} kod bilan to'xtadi, {backoff:.0f}s dan keyin qayta ishga tushadi")
+                await db.record_user_bot_exit(user_bot_id, exit_code, 'active', restarted=True)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, BOT_RESTART_BACKOFF_MAX)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Bot {user_bot_id} supervizor xatosi: {e}")
+            await db.record_user_bot_exit(user_bot_id, None, 'crashed')
+        finally:
+            self._tasks.pop(user_bot_id, None)
+            self._procs.pop(user_bot_id, None)
+
+    async def _sample_usage(self):
+        """Ishlayotgan botlarning RSS, CPU va fd sonini davriy o'lchash"""
+        while True:
+            now = time.monotonic()
+            for user_bot_id, proc in list(self._procs.items()):
+                sample = read_process_usage(proc.pid)
+                if sample is None:
+                    continue
+                rss_mb, cpu_seconds, fds = sample
+                previous = self.usage.get(user_bot_id)
+                cpu_percent = 0.0
+                if previous and now > previous.sampled_at:
+                    cpu_percent = max(0.0, (cpu_seconds - previous.cpu_seconds) / (now - previous.sampled_at) * 100)
+                self.usage[user_bot_id] = BotUsage(rss_mb, cpu_seconds, cpu_percent, fds, now)
+            await asyncio.sleep(BOT_USAGE_SAMPLE_INTERVAL)
+
+    def top_usage(self, limit):
+        """Eng ko'p xotira ishlatayotgan botlar: [(user_bot_id, BotUsage), ...]"""
+        return sorted(self.usage.items(), key=lambda item: item[1].rss_mb, reverse=True)[:limit]
+
+    async def _terminate(self, proc):
+        if proc.returncode is not None:
+            return
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), BOT_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+    async def stop(self, user_bot_id, status='stopped'):
+        """Botni to'xtatish (SIGTERM, BOT_STOP_TIMEOUT dan keyin SIGKILL) va holatini yozish"""
+        task = self._tasks.get(user_bot_id)
+        if task is None:
+            return
+        self._stopping.add(user_bot_id)
+        proc = self._procs.get(user_bot_id)
+        if proc is not None:
+            await self._terminate(proc)
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        # Hali boshlanmagan task bekor qilinsa uning finally bloki ishlamaydi
+        self._tasks.pop(user_bot_id, None)
+        exit_code = proc.returncode if proc is not None else None
+        await db.record_user_bot_exit(user_bot_id, exit_code, status)
+
+    @staticmethod
+    async def _terminate_orphan(pid, user_bot_dir):
+        """Oldingi maker jarayonini to'xtatib, chiqishini kutish: bitta token bilan ikki getUpdates bo'lmasin"""
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, sig)
+            deadline = time.monotonic() + BOT_STOP_TIMEOUT
+            while time.monotonic() < deadline:
+                if not process_alive(pid, user_bot_dir):
+                    return
+                await asyncio.sleep(0.1)
+        logger.error(f"Jarayon {pid} SIGKILL dan keyin ham tirik")
+
+    async def reconcile(self):
+        """Maker qayta ishga tushganda: 'active' botlarni haqiqiy jarayonlar bilan solishtirish.
+
+        Oldingi maker dan qolgan jarayon (bola jarayon emas, uni kutib bo'lmaydi)
+        to'xtatiladi va bot kuzatuv ostida qayta ishga tushiriladi.
+        """
+        for user_bot_id, user_id, bot_id, bot_token, pid, user_bot_dir in await db.get_active_user_bots():
+            if pid and user_bot_dir and process_alive(pid, user_bot_dir):
+                logger.info(f"Bot {user_bot_id}: eski jarayon {pid} to'xtatilmoqda")
+                await self._terminate_orphan(pid, user_bot_dir)
+            launched = user_bot_dir and await launch_user_bot(
+                user_bot_id, user_id, bot_token, user_bot_dir, await get_bot_launch(bot_id)
+            )
+            if not launched:
+                logger.warning(f"Bot {user_bot_id}: papka yoki kirish fayli topilmadi, 'stopped' qilindi")
+                await db.record_user_bot_exit(user_bot_id, None, 'stopped')
+
+    async def shutdown(self):
+        """Barcha botlarni to'xtatish. Holat 'active' qoladi - keyingi ishga tushishda qayta ko'tariladi"""
+        self._stopping.update(self._tasks)
+        if self._sampler is not None:
+            self._sampler.cancel()
+        await asyncio.gather(*(self._terminate(proc) for proc in list(self._procs.values())), return_exceptions=True)
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+supervisor = BotSupervisor()
+
+
+# ==================== UMUMIY RUNTIME ====================
+SHARED_RUNTIME_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shared_runtime.py")
+
+
+def write_private_json(path, data):
+    """Atomar yozish, faqat egasi o'qiy oladi (manifestda tokenlar bor)"""
+    tmp_path = f"{path}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class SharedRuntime:
+    """Mos shablonlarni (papkasida maker_tenant.py bor) umumiy worker jarayonlarda ishlatish.
+
+    Har bir bot uchun alohida interpreter (~40-60 MB) o'rniga bitta worker
+    (shared_runtime.py) o'nlab tenantning Bot/Dispatcher larini bitta event loop
+    da ishlatadi. Tenantlar manifest fayl orqali beriladi; worker tenant holatini
+    status faylga yozadi, crash-loop ga tushgan tenant 'crashed' qilinadi.
+    Worker jarayonlarining o'zi to'xtasa backoff bilan qayta ishga tushiriladi.
+    """
+
+    def __init__(self):
+        self.tenants = {}       # user_bot_id -> manifest yozuvi
+        self._workers = {}      # worker raqami -> jarayon
+        self._tasks = {}        # worker raqami -> kuzatuvchi task
+        self._watcher = None
+        self._stopping = False
+
+    @staticmethod
+    def is_compatible(user_bot_dir):
+        """Faqat bitta fayldan iborat tenant: maker_tenant.py dan boshqa .py fayl bo'lmasligi kerak.
+
+        Qo'shni modullar worker da tenantga xos nom bilan yuklanmaydi - ular sys.modules orqali
+        tenantlar o'rtasida bo'linib qolardi, shuning uchun bunday shablon alohida jarayonda ishlaydi.
+        """
+        if not SHARED_RUNTIME_ENABLED or not os.path.isfile(os.path.join(user_bot_dir, SHARED_RUNTIME_ENTRY)):
+            return False
+        for root, _, files in os.walk(user_bot_dir):
+            for file in files:
+                if file.endswith('.py') and os.path.join(root, file) != os.path.join(user_bot_dir, SHARED_RUNTIME_ENTRY):
+                    return False
+        return True
+
+    def hosts(self, user_bot_id):
+        return user_bot_id in self.tenants
+
+    @staticmethod
+    def worker_index(user_bot_id):
+        return user_bot_id % SHARED_RUNTIME_WORKERS
+
+    @staticmethod
+    def _path(kind, index):
+        return os.path.abspath(os.path.join(SHARED_RUNTIME_DIR, f"{kind}_{index}.json"))
+
+    def _write_manifest(self, index):
+        os.makedirs(SHARED_RUNTIME_DIR, exist_ok=True)
+        manifest = {
+            str(user_bot_id): spec for user_bot_id, spec in self.tenants.items()
+            if self.worker_index(user_bot_id) == index
+        }
+        write_private_json(self._path("manifest", index), manifest)
+
+    async def add(self, user_bot_id, user_id, token, user_bot_dir):
+        # nonce o'zgarsa worker tenantni qaytadan ishga tushiradi (masalan crashed botni qayta yoqish)
+        self.tenants[user_bot_id] = {
+            "token": token, "dir": os.path.abspath(user_bot_dir), "owner_id": user_id, "nonce": time.time_ns(),
+        }
+        index = self.worker_index(user_bot_id)
+        self._write_manifest(index)
+        self._stopping = False
+        if index not in self._tasks:
+            self._tasks[index] = asyncio.create_task(self._supervise_worker(index))
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch_status())
+        worker = self._workers.get(index)
+        await db.set_user_bot_process(user_bot_id, worker.pid if worker else None)
+
+    async def remove(self, user_bot_id, status='stopped'):
+        if self.tenants.pop(user_bot_id, None) is None:
+            return
+        self._write_manifest(self.worker_index(user_bot_id))
+        await db.record_user_bot_exit(user_bot_id, None, status)
+
+    async def _supervise_worker(self, index):
+        backoff = BOT_RESTART_BACKOFF_BASE
+        os.makedirs(SHARED_RUNTIME_DIR, exist_ok=True)
+        try:
+            while not self._stopping:
+                kwargs = {'creationflags': subprocess.CREATE_NEW_CONSOLE} if os.name == "nt" else {'start_new_session': True}
+                with open(os.path.join(SHARED_RUNTIME_DIR, f"worker_{index}.log"), "a", encoding="utf-8") as log:
+                    proc = await asyncio.create_subprocess_exec(
+                        sys.executable, SHARED_RUNTIME_SCRIPT, self._path("manifest", index), self._path("status", index),
+                        cwd=SHARED_RUNTIME_DIR, stdout=log, stderr=log, **kwargs
+                    )
+                self._workers[index] = proc
+                for user_bot_id in [t for t in self.tenants if self.worker_index(t) == index]:
+                    await db.set_user_bot_process(user_bot_id, proc.pid)
+                started = time.monotonic()
+                try:
+                    exit_code = await proc.wait()
+                finally:
+                    self._workers.pop(index, None)
+                if self._stopping:
+                    return
+                if time.monotonic() - started >= BOT_STABLE_AFTER:
+                    backoff = BOT_RESTART_BACKOFF_BASE
+                logger.error(f"Umumiy runtime worker {index} {exit_code} kod bilan to'xtadi, {backoff:.0f}s dan keyin qayta ishga tushadi")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, BOT_RESTART_BACKOFF_MAX)
+        finally:
+            self._tasks.pop(index, None)
+
+    async def _watch_status(self):
+        """Worker status fayllaridan crash bo'lgan tenantlarni topish"""
+        while True:
+            await asyncio.sleep(SHARED_RUNTIME_POLL_INTERVAL)
+            for index in range(SHARED_RUNTIME_WORKERS):
+                try:
+                    with open(self._path("status", index), encoding="utf-8") as f:
+                        status = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                for key, tenant_status in status.items():
+                    user_bot_id = int(key)
+                    spec = self.tenants.get(user_bot_id)
+                    # Eski nonce - tenant allaqachon qayta qo'shilgan, bu holat unga tegishli emas
+                    if spec is None or tenant_status.get("nonce") != spec["nonce"] or tenant_status.get("state") != "crashed":
+                        continue
+                    logger.error(f"Bot {user_bot_id} umumiy runtime da crash-loop: {tenant_status.get('error')}")
+                    await self.remove(user_bot_id, status='crashed')
+                    await notify_user(
+                        spec["owner_id"],
+                        "⚠️ Botingiz qayta-qayta xatolik bilan to'xtadi va o'chirib qo'yildi.\n\n"
+                        "Sababini /logs orqali ko'ring, so'ng \"🤖 Mening botlarim\" dan qayta ishga tushiring."
+                    )
+
+    async def shutdown(self):
+        """Worker larni to'xtatish. Tenantlar holati 'active' qoladi"""
+        self._stopping = True
+        if self._watcher is not None:
+            self._watcher.cancel()
+        await asyncio.gather(*(supervisor._terminate(proc) for proc in list(self._workers.values())), return_exceptions=True)
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+shared_runtime = SharedRuntime()
+
+
+def build_argv(argv):
+    """Saqlangan buyruqni ishga tushirishga tayyorlash: python maker ning interpretatori bilan almashtiriladi"""
+    if argv[0] in PYTHON_ALIASES:
+        return [sys.executable, *argv[1:]]
+    return list(argv)
+
+
+async def get_bot_launch(bot_id):
+    """Katalogdagi (argv, cwd) yoki shablon yuklanganda aniqlanmagan bo'lsa None"""
+    bot_data = (await get_bot_catalog()).by_id.get(bot_id)
+    if not bot_data or not bot_data[7]:
+        return None
+    return json.loads(bot_data[7]), bot_data[8] or '.'
+
+
+async def launch_user_bot(user_bot_id, user_id, token, user_bot_dir, launch=None):
+    """Botni umumiy runtime da (mos bo'lsa) yoki alohida jarayonda ishga tushirish. Fayl topilmasa False.
+
+    launch - bots jadvalidagi (argv, cwd); None bo'lsa eski shablon: kirish fayli papkadan qidiriladi.
+    """
+    if shared_runtime.is_compatible(user_bot_dir):
+        await shared_runtime.add(user_bot_id, user_id, token, user_bot_dir)
+        return True
+    user_bot_dir = os.path.abspath(user_bot_dir)
+    if launch is None:
+        entry = find_bot_entry(user_bot_dir)
+        if not entry:
+            return False
+        launch = (['python', entry], '.')
+    argv, cwd = launch
+    cwd = os.path.join(user_bot_dir, cwd)
+    if not os.path.isdir(cwd):
+        return False
+    supervisor.start(user_bot_id, user_id, build_argv(argv), user_bot_dir, cwd, token)
+    return True
+
+
+async def stop_user_bot(user_bot_id):
+    """Botni qayerda ishlayotgan bo'lsa o'sha yerda to'xtatish"""
+    if shared_runtime.hosts(user_bot_id):
+        await shared_runtime.remove(user_bot_id)
+    else:
+        await supervisor.stop(user_bot_id)
+
+
+# ==================== BOT YARATISH NAVBATI ====================
+# Ochish va token yozish worker oqimlarda bajariladi: katta shablon event loop ni to'xtatmaydi
+PROVISION_ACTIVE_STATES = ('queued', 'extracting', 'patching', 'launching')
+PROVISION_STATE_TEXTS = {
+    'queued': "🕓 Navbatda, bot tez orada yaratiladi...",
+    'extracting': "📦 1/3 Bot fayllari ochilmoqda...",
+    'patching': "🔧 2/3 Token yozilmoqda...",
+    'launching': "🚀 3/3 Bot ishga tushirilmoqda...",
+}
+TOKEN_ASSIGNMENT_PATTERN = re.compile(r'(BOT_TOKEN|API_TOKEN|token|API_KEY)\s*[:=]\s*[\'"].*?[\'"]', re.IGNORECASE)
+# Token o'rnini belgilash uchun vaqtinchalik belgi: ombordagi faylda saqlanmaydi, o'rniga offset yoziladi
+TOKEN_PLACEHOLDER = "\x00MAKER_BOT_TOKEN\x00"
+# Shablon tokenni muhitdan o'qisa yozish joyi shart emas: os.getenv("BOT_TOKEN") / os.environ["BOT_TOKEN"]
+TOKEN_ENV_PATTERN = re.compile(r'(getenv|environ)\W+[\'"]BOT_TOKEN[\'"]')
+BOT_TOKEN_FORMAT = re.compile(r'[0-9]+:[A-Za-z0-9_-]+')
+TEMPLATE_MANIFEST_VERSION = 2
+PYTHON_ALIASES = {'python', 'python3', 'py'}
+
+
+class ProvisionError(Exception):
+    """Bot yaratib bo'lmadi: xabar foydalanuvchiga ko'rsatiladi"""
+
+
+FICLONE = 0x40049409  # Linux ioctl: btrfs/xfs da faylni bloklarni ko'chirmasdan nusxalash (reflink)
+
+
+def store_object_path(digest):
+    return os.path.join(TEMPLATE_STORE_DIR, 'objects', digest[:2], digest[2:])
+
+
+def template_manifest_path(template_hash):
+    return os.path.join(TEMPLATE_STORE_DIR, 'templates', f'{template_hash}.json')
+
+
+def store_object(stream):
+    """Oqimni omborga yozish. sha256 qaytariladi; bunday fayl bo'lsa qayta yozilmaydi"""
+    objects_dir = os.path.join(TEMPLATE_STORE_DIR, 'objects')
+    os.makedirs(objects_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=objects_dir)
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for chunk in iter(lambda: stream.read(1 << 20), b''):
+                digest.update(chunk)
+                tmp.write(chunk)
+        path = store_object_path(digest.hexdigest())
+        if os.path.exists(path):
+            os.unlink(tmp_path)
+        else:
+            # Ombordagi fayl hardlink orqali botlar o'rtasida bo'linadi: joyida o'zgartirib bo'lmasin
+            os.chmod(tmp_path, 0o444)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+        raise
+    return digest.hexdigest()
+
+
+def template_relpath(name):
+    """Arxivdagi nomni xavfsiz nisbiy yo'lga aylantirish (papkadan chiqib ketadigan yo'llar o'tkazib yuboriladi)"""
+    relpath = os.path.normpath(name.replace('\\', '/')).lstrip('/')
+    if not relpath or relpath == '.' or relpath == '..' or relpath.startswith('..' + os.sep):
+        return None
+    return relpath
+
+
+def prepare_template_source(content):
+    """Tokenga bog'liq bo'lmagan tuzatishlarni bir marta qo'llash va token joylarini topish.
+
+    (token joylari olib tashlangan baytlar, token qo'yiladigan bayt offsetlari)
+    """
+    content = content.replace("YOUR_BOT_TOKEN", TOKEN_PLACEHOLDER)
+    content = TOKEN_ASSIGNMENT_PATTERN.sub(f'\\1 = "{TOKEN_PLACEHOLDER}"', content)
+
+    # SQLite bazasi uchun noto'g'ri yo'llarni to'g'irlash (../tests/ kabi)
+    content = content.replace("'../tests/", "'")
+    content = content.replace('"../tests/', '"')
+    content = content.replace("'tests/", "'")
+    content = content.replace('"tests/', '"')
+
+    # ADMIN_ID -> ADMIN_IDS[0] (NameError oldini olish uchun)
+    # Faqat mustaqil so'z bo'lsa almashtiramiz (regex yordamida)
+    content = re.sub(r'\bADMIN_ID\b', 'ADMIN_IDS[0]', content)
+
+    parts = content.encode('utf-8').split(TOKEN_PLACEHOLDER.encode('utf-8'))
+    offsets, position = [], 0
+    for part in parts[:-1]:
+        position += len(part)
+        offsets.append(position)
+    return b''.join(parts), offsets
+
+
+def choose_template_entry(py_files):
+    """Ishga tushiriladigan fayl: eng yuqori papkadagi main.py, bot.py, ...; bo'lmasa birinchi .py"""
+    candidates = sorted(
+        (relpath.count(os.sep), BOT_ENTRY_FILES.index(os.path.basename(relpath).lower()), relpath)
+        for relpath in py_files if os.path.basename(relpath).lower() in BOT_ENTRY_FILES
+    )
+    if candidates:
+        return candidates[0][2]
+    return min(py_files, default=None)
+
+
+def ingest_template(bot_file_path):
+    """Shablonni omborga bir marta ochish va token yozish rejasini tuzish (worker oqimda).
+
+    .py fayllar tokenga bog'liq bo'lmagan tuzatishlar bilan saqlanadi, token
+    joylari esa bayt offsetlari sifatida manifestga yoziladi. Sintaksis xatolari
+    ham shu yerda aniqlanadi - foydalanuvchi pul to'lashidan oldin. Shablon hash i qaytariladi.
+    """
+    files, errors = [], []
+    reads_env = False
+
+    def add_file(relpath, stream):
+        nonlocal reads_env
+        if not relpath.endswith('.py'):
+            files.append([relpath, store_object(stream), []])
+            return
+        raw = stream.read()
+        try:
+            source = raw.decode('utf-8')
+        except UnicodeDecodeError:
+            errors.append(f"{relpath}: UTF-8 emas")
+            files.append([relpath, store_object(io.BytesIO(raw)), []])
+            return
+        reads_env = reads_env or bool(TOKEN_ENV_PATTERN.search(source))
+        prepared, offsets = prepare_template_source(source)
+        try:
+            compile(prepared, relpath, 'exec')
+        except (SyntaxError, ValueError) as e:
+            errors.append(f"{relpath}:{getattr(e, 'lineno', '?')}: {getattr(e, 'msg', e)}")
+        files.append([relpath, store_object(io.BytesIO(prepared)), offsets])
+
+    if bot_file_path.lower().endswith('.zip'):
+        with zipfile.ZipFile(bot_file_path, 'r') as z:
+            for info in z.infolist():
+                relpath = template_relpath(info.filename)
+                if info.is_dir() or relpath is None:
+                    continue
+                with z.open(info) as src:
+                    add_file(relpath, src)
+    else:
+        with open(bot_file_path, 'rb') as src:
+            add_file(os.path.basename(bot_file_path), src)
+
+    files.sort()
+    manifest = {
+        'version': TEMPLATE_MANIFEST_VERSION,
+        'files': files,
+        'entry': choose_template_entry([f[0] for f in files if f[0].endswith('.py')]),
+        'token_sites': sum(len(f[2]) for f in files),
+        'reads_env': reads_env,
+        'errors': errors,
+    }
+    data = json.dumps(manifest, sort_keys=True, separators=(',', ':'))
+    template_hash = hashlib.sha256(data.encode()).hexdigest()
+    path = template_manifest_path(template_hash)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+    return template_hash
+
+
+def load_template_manifest(template_hash):
+    """Ombordagi shablon rejasi. Yo'q yoki eski formatda bo'lsa None (shablon qaytadan ochiladi)"""
+    try:
+        with open(template_manifest_path(template_hash), encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get('version') != TEMPLATE_MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def template_problems(manifest):
+    """(xatolar, ogohlantirishlar): xato bo'lsa shablon sotilmaydi"""
+    errors = list(manifest['errors'])
+    if not manifest['entry']:
+        errors.append("Shablonda .py fayl topilmadi")
+    warnings = []
+    if not manifest['token_sites'] and not manifest['reads_env']:
+        warnings.append("Token yoziladigan joy topilmadi: shablon tokenni BOT_TOKEN muhit o'zgaruvchisidan o'qishi kerak")
+    return errors, warnings
+
+
+def resolve_launch(run_command, manifest):
+    """Run command ni shablon fayllari bo'yicha (argv, cwd) ga aylantirish (shablon yuklanganda bir marta).
+
+    cwd bot papkasiga nisbatan: skript ichki papkada bo'lsa o'sha papka. Bo'sh buyruq -
+    manifestdagi kirish fayli. Buyruq shablonga mos kelmasa ValueError.
+    """
+    try:
+        argv = shlex.split(run_command or '')
+    except ValueError as e:
+        raise ValueError(f"Buyruqni o'qib bo'lmadi: {e}")
+    files = [relpath for relpath, _, _ in manifest['files']]
+    if not argv:
+        if not manifest['entry']:
+            raise ValueError("Shablonda .py fayl topilmadi")
+        return ['python', os.path.basename(manifest['entry'])], os.path.dirname(manifest['entry']) or '.'
+
+    if argv[0] in PYTHON_ALIASES and '-m' in argv[1:-1]:
+        module = argv[argv.index('-m') + 1].replace('.', os.sep)
+        targets = [f"{module}.py", os.path.join(module, '__main__.py')]
+    else:
+        # Birinchi opsiya bo'lmagan argument fayl bo'lsa (kengaytma yoki / bor) - skript
+        script = next((arg for arg in argv[1:] if not arg.startswith('-')), None)
+        if not script or not (os.path.splitext(script)[1] or '/' in script):
+            return argv, '.'
+        targets = [os.path.normpath(script)]
+
+    for target in targets:
+        if target in files:
+            return argv, '.'
+    # Arxiv ichida ildiz papka bo'lsa (bot/main.py) buyruq o'sha papkadan bajariladi
+    matches = sorted(
+        (relpath.count(os.sep), relpath[:-len(target) - 1]) for relpath in files
+        for target in targets if relpath.endswith(os.sep + target)
+    )
+    if not matches:
+        raise ValueError(f"Shablonda {targets[0]} topilmadi")
+    return argv, matches[0][1]
+
+
+def clone_file(src, dst):
+    """Reflink mumkin bo'lsa (btrfs/xfs) bloklarsiz nusxa, bo'lmasa oddiy nusxa"""
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def prepare_target(user_bot_dir, relpath):
+    dst = os.path.join(user_bot_dir, relpath)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    # Qayta urinishda eski fayl o'chiriladi: hardlink orqali ombordagi faylni buzib qo'ymaslik uchun
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(dst)
+    return dst
+
+
+def materialize_template(template_hash, user_bot_dir):
+    """Token talab qilmaydigan fayllarni ombordan yig'ish (worker oqimda). (hardlink lar, nusxalar)
+
+    Faqat TEMPLATE_SHARED_EXTENSIONS hardlink qilinadi, qolganlari reflink yoki oddiy nusxa.
+    """
+    manifest = load_template_manifest(template_hash)
+    linked = copied = 0
+    for relpath, digest, offsets in manifest['files']:
+        if offsets:
+            continue  # inject_token yozadi
+        src = store_object_path(digest)
+        dst = prepare_target(user_bot_dir, relpath)
+        if os.path.splitext(relpath)[1].lower() in TEMPLATE_SHARED_EXTENSIONS:
+            try:
+                os.link(src, dst)
+                linked += 1
+                continue
+            except OSError:
+                pass  # boshqa fayl tizimi yoki hardlink qo'llab-quvvatlanmaydi
+        clone_file(src, dst)
+        os.chmod(dst, 0o644)
+        copied += 1
+    return linked, copied
+
+
+def inject_token(template_hash, user_bot_dir, token):
+    """Rejadagi offsetlarga tokenni qo'yib, faqat shu fayllarni yozish (worker oqimda). Yozilgan fayllar soni"""
+    manifest = load_template_manifest(template_hash)
+    token_bytes = token.encode('utf-8')
+    written = 0
+    for relpath, digest, offsets in manifest['files']:
+        if not offsets:
+            continue
+        with open(store_object_path(digest), 'rb') as f:
+            content = f.read()
+        with open(prepare_target(user_bot_dir, relpath), 'wb') as f:
+            position = 0
+            for offset in offsets:
+                f.write(content[position:offset])
+                f.write(token_bytes)
+                position = offset
+            f.write(content[position:])
+        written += 1
+    return written
+
+
+_provision_pool = None
+provision_semaphore = asyncio.Semaphore(PROVISION_WORKERS)
+provision_tasks = {}  # job_id -> task
+
+
+def provision_pool():
+    """Worker oqimlar puli. Ish asosan disk I/O (zlib, sha256, fayl yozish GIL ni bo'shatadi).
+
+    Jarayonlar ishlatilmaydi: DB va supervizor oqimlari bor jarayonni fork qilish qulf
+    ushlab qolgan bolani osiltirib qo'yishi mumkin, spawn esa make.py ni qayta import qiladi.
+    """
+    global _provision_pool
+    if _provision_pool is None:
+        _provision_pool = ThreadPoolExecutor(PROVISION_WORKERS, thread_name_prefix='provision')
+    return _provision_pool
+
+
+async def run_in_provision_pool(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(provision_pool(), func, *args)
+
+
+async def edit_provision_message(chat_id, message_id, text, **kwargs):
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs)
+    except MessageNotModified:
+        pass
+    except TelegramAPIError as e:
+        logger.warning(f"Bot yaratish xabarini yangilab bo'lmadi ({chat_id}): {e}")
+
+
+async def run_provision_job(job):
+    job_id, user_id, bot_id, token, price, chat_id, message_id, user_bot_dir, status, user_bot_id = job
+
+    async def set_state(state):
+        await db.set_provision_job_status(job_id, state)
+        await edit_provision_message(chat_id, message_id, PROVISION_STATE_TEXTS[state])
+
+    try:
+        bot_data = (await get_bot_catalog()).by_id.get(bot_id)
+        bot_name = bot_data[1] if bot_data else "Noma'lum bot"
+        if user_bot_id is None:
+            if not bot_data:
+                raise ProvisionError("Bot topilmadi!")
+            async with provision_semaphore:
+                await set_state('extracting')
+                template_hash = bot_data[6]
+                manifest = load_template_manifest(template_hash) if template_hash else None
+                if manifest is None:
+                    # Omborga hali qo'shilmagan (yoki eski formatdagi) shablon: bir marta ochib, keyingi xaridlar uchun saqlaymiz
+                    template_hash = await run_in_provision_pool(ingest_template, bot_data[2])
+                    manifest = load_template_manifest(template_hash)
+                    await db.set_bot_template_hash(bot_id, template_hash)
+                    app_cache.invalidate('bot_catalog')
+                errors, _ = template_problems(manifest)
+                if errors:
+                    logger.error(f"Shablon {bot_id} xatolari: {errors}")
+                    raise ProvisionError("Bot shablonida xatolik bor! Admin bilan bog'laning.")
+                launch = await get_bot_launch(bot_id)
+                if launch is None:
+                    # Buyruq hali aniqlanmagan eski shablon: bir marta aniqlab, katalogga yozamiz.
+                    # Avval run command tekshirilmagan edi - mos kelmasa avvalgidek kirish fayli ishlatiladi
+                    try:
+                        launch = resolve_launch(bot_data[3], manifest)
+                    except ValueError as e:
+                        logger.warning(f"Shablon {bot_id} run command ({e}), kirish fayli ishlatiladi")
+                        launch = resolve_launch('', manifest)
+                    await db.set_bot_launch(bot_id, json.dumps(launch[0]), launch[1])
+                    app_cache.invalidate('bot_catalog')
+                linked, copied = await run_in_provision_pool(materialize_template, template_hash, user_bot_dir)
+
+                await set_state('patching')
+                written = await run_in_provision_pool(inject_token, template_hash, user_bot_dir, token)
+                logger.info(f"Bot yaratish {job_id}: {linked} ta hardlink, {copied} ta nusxa, token {written} ta faylga yozildi")
+                log_file = os.path.join(user_bot_dir, BOT_LOG_FILE)
+                with open(log_file, "w", encoding="utf-8") as f:
+                    f.write(f"Bot ishga tushirildi: {datetime.now()}\n")
+                    f.write(f"Buyruq: {shlex.join(build_argv(launch[0]))}\n")
+                    f.write(f"Papka: {os.path.join(user_bot_dir, launch[1])}\n")
+                    f.write(f"Token: {token[:10]}...{token[-4:]}\n\n")
+
+                await set_state('launching')
+                user_bot_id = await db.attach_provision_job_bot(job_id, user_id, token, bot_id, user_bot_dir, log_file)
+                await db.committed()
+                # Supervizor PID ni yozadi va crash bo'lsa qayta ishga tushiradi.
+                # Bot ichida os.getenv("MAKER_USER_ID") orqali foydalanuvchi ID si olinadi (avto admin)
+                if not await launch_user_bot(user_bot_id, user_id, token, user_bot_dir, launch):
+                    raise ProvisionError("Bot fayli topilmadi! Admin bilan bog'laning.")
+        # user_bot_id bor bo'lsa bot 'launching' da qolgan va supervisor.reconcile() uni allaqachon ko'targan
+
+        await db.set_provision_job_status(job_id, 'running')
+        balance = await db.get_balance(user_id)
+        await edit_provision_message(
+            chat_id, message_id,
+            f"Bot muvaffaqiyatli yaratildi va ISHGA TUSHDI!\n\n"
+            f"Bot: {bot_name}\n"
+            f"To'landi: {price:,.0f} so'm\n"
+            f"Qoldiq: {balance:,.0f} so'm\n"
+            f"Papka: <code>{os.path.relpath(user_bot_dir)}</code>\n\n"
+            f"Agar ishlamasa — /logs orqali log.txt ni ko'ring!",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"BOT YARATISH XATOSI (job {job_id}, user {user_id}): {e}")
+        if user_bot_id is not None:
+            # Bot ishga tushgan bo'lishi mumkin: pul qaytarilishidan oldin to'xtatiladi
+            try:
+                await stop_user_bot(user_bot_id)
+            except Exception as stop_error:
+                logger.error(f"Bot {user_bot_id} ni to'xtatib bo'lmadi: {stop_error}")
+        refunded = await db.fail_provision_job(job_id, str(e)[:500])
+        await db.committed()
+        reason = str(e) if isinstance(e, ProvisionError) else f"Xatolik:\n<code>{str(e)[:500]}</code>"
+        if refunded is not None:
+            reason += f"\n\n{price:,.0f} so'm balansingizga qaytarildi."
+        await edit_provision_message(chat_id, message_id, reason, parse_mode="HTML")
+    finally:
+        provision_tasks.pop(job_id, None)
+
+
+def start_provision_job(job):
+    provision_tasks[job[0]] = asyncio.create_task(run_provision_job(job))
+
+
+async def resume_provision_jobs():
+    """Bot to'xtaganda tugallanmay qolgan bot yaratish ishlarini davom ettirish"""
+    for job in await db.get_active_provision_jobs():
+        logger.info(f"Bot yaratish {job[0]} davom ettirilmoqda ({job[8]})")
+        start_provision_job(job)
+
+
+# ==================== BROADCAST ====================
+# broadcast_id -> yuborayotgan task
+broadcast_tasks = {}
+
+
+async def send_broadcast_message(user_id, text):
+    """Bitta foydalanuvchiga yuborish: True - yuborildi, False - xatolik, None - yetkazib bo'lmaydi"""
+    attempts = 0
+    while True:
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+            return True
+        except UNREACHABLE_ERRORS:
+            return None
+        except NetworkError as e:
+            attempts += 1
+            if attempts >= BROADCAST_MAX_RETRIES:
+                logger.error(f"Broadcast: {user_id} ga yuborilmadi: {e}")
+                return False
+        except TelegramAPIError as e:
+            logger.error(f"Broadcast: {user_id} ga yuborilmadi: {e}")
+            return False
+
+
+def broadcast_progress_text(sent, failed, total, rate, done=False):
+    title = "✅ Xabar yuborildi!" if done else "📨 Xabar yuborilmoqda..."
+    return (
+        f"{title}\n\n"
+        f"✅ Muvaffaqiyatli: {sent}\n"
+        f"❌ Xatolik: {failed}\n"
+        f"📊 Jami: {sent + failed}/{total}\n"
+        f"⚡ Tezlik: {rate:.1f} xabar/soniya"
+    )
+
+
+async def run_broadcast(broadcast_id, admin_chat_id, progress_message_id, text, last_user_id, sent, failed, total):
+    """Qabul qiluvchilarni bo'laklab o'qib yuborish; har bo'lakdan keyin holat DB ga yoziladi"""
+    # Task o'z kontekstida ishlaydi: barcha yuborishlar eng past ustuvorlikdagi navbatga tushadi
+    send_priority.set(PRIORITY_BROADCAST)
+    started = time.monotonic()
+    started_count = sent + failed
+    reported = started
+
+    async def report(done=False):
+        elapsed = time.monotonic() - started
+        rate = (sent + failed - started_count) / elapsed if elapsed > 0 else 0
+        try:
+            await bot.edit_message_text(
+                broadcast_progress_text(sent, failed, total, rate, done),
+                chat_id=admin_chat_id, message_id=progress_message_id
+            )
+        except MessageNotModified:
+            pass
+        except TelegramAPIError as e:
+            logger.warning(f"Broadcast {broadcast_id}: progress xabari yangilanmadi: {e}")
+
+    try:
+        retries = 0
+        while True:
+            try:
+                while True:
+                    recipients = await db.get_broadcast_recipients(last_user_id, BROADCAST_BATCH_SIZE)
+                    if not recipients:
+                        break
+                    results = await asyncio.gather(*(send_broadcast_message(user_id, text) for user_id in recipients))
+                    # Hisoblagichlar saqlashdan oldin oshiriladi: saqlash yiqilsa bo'lak qayta yuborilmaydi
+                    sent += results.count(True)
+                    failed += len(results) - results.count(True)
+                    last_user_id = recipients[-1]
+                    unreachable = [user_id for user_id, result in zip(recipients, results) if result is None]
+                    if unreachable:
+                        await db.set_users_unreachable(unreachable)
+                    await db.save_broadcast_progress(broadcast_id, last_user_id, sent, failed)
+                    retries = 0
+                    if time.monotonic() - reported >= BROADCAST_PROGRESS_INTERVAL:
+                        reported = time.monotonic()
+                        await report()
+                await db.finish_broadcast(broadcast_id)
+                await report(done=True)
+                logger.info(f"Broadcast {broadcast_id} tugadi: {sent} yuborildi, {failed} xatolik")
+                break
+            except Exception as e:
+                retries += 1
+                if retries <= BROADCAST_LOOP_RETRIES:
+                    delay = BROADCAST_RETRY_DELAY * 2 ** (retries - 1)
+                    logger.warning(f"Broadcast {broadcast_id} xato: {e}; {delay:.0f}s dan keyin qayta uriniladi")
+                    await asyncio.sleep(delay)
+                    continue
+                logger.error(f"Broadcast {broadcast_id} to'xtadi: {e}")
+                await fail_broadcast(broadcast_id, admin_chat_id, sent, failed, total, e)
+                break
+    finally:
+        broadcast_tasks.pop(broadcast_id, None)
+
+
+async def fail_broadcast(broadcast_id, admin_chat_id, sent, failed, total, error):
+    """Qayta urinishlar tugadi: holatni 'failed' qilish va adminga xabar berish"""
+    try:
+        await db.finish_broadcast(broadcast_id, status='failed')
+    except Exception as e:
+        # DB ishlamasa holat 'running' qoladi va keyingi ishga tushishda davom ettiriladi
+        logger.error(f"Broadcast {broadcast_id}: holat saqlanmadi: {e}")
+    try:
+        await bot.send_message(
+            admin_chat_id,
+            f"⚠️ Broadcast #{broadcast_id} xato bilan to'xtadi: {error}\n\n"
+            f"✅ Muvaffaqiyatli: {sent}\n"
+            f"❌ Xatolik: {failed}\n"
+            f"📊 Jami: {sent + failed}/{total}"
+        )
+    except TelegramAPIError as e:
+        logger.error(f"Broadcast {broadcast_id}: adminga xabar yuborilmadi: {e}")
+
+
+def start_broadcast(row):
+    broadcast_id = row[0]
+    if broadcast_id not in broadcast_tasks:
+        broadcast_tasks[broadcast_id] = asyncio.create_task(run_broadcast(*row))
+
+
+async def resume_broadcasts():
+    """Bot to'xtaganda tugallanmay qolgan broadcastlarni davom ettirish"""
+    for row in await db.get_running_broadcasts():
+        logger.info(f"Broadcast {row[0]} davom ettirilmoqda (user_id > {row[4]})")
+        start_broadcast(row)
+
+
 # Admin komandalar
 @dp.message_handler(commands=['message_all_user'])
 async def message_all_user_handler(message: types.Message, state: FSMContext):
@@ -2261,27 +4984,14 @@ async def process_admin_broadcast_message(message: types.Message, state: FSMCont
     is_broadcast = data.get('is_broadcast', False)
     
     if is_broadcast:
-        # Broadcast xabar
-        text = message.text
-        users = db.get_all_users()
-        sent = 0
-        failed = 0
-        
-        for user in users:
-            user_id = user[0]
-            try:
-                await bot.send_message(chat_id=user_id, text=text)
-                sent += 1
-            except:
-                failed += 1
-        
-        await message.answer(
-            f"✅ Xabar yuborildi!\n\n"
-            f"✅ Muvaffaqiyatli: {sent}\n"
-            f"❌ Xatolik: {failed}\n"
-            f"📊 Jami: {len(users)}"
-        )
+        # Broadcast xabar: fonda yuboriladi, holati progress xabarida ko'rinadi
         await state.finish()
+        text = message.text
+        total = await db.count_broadcast_recipients()
+        progress = await message.answer(broadcast_progress_text(0, 0, total, 0))
+        broadcast_id = await db.create_broadcast(message.chat.id, progress.message_id, text, total)
+        await db.committed()
+        start_broadcast((broadcast_id, message.chat.id, progress.message_id, text, 0, 0, 0, total))
     else:
         # Balans to'ldirish
         try:
@@ -2293,6 +5003,47 @@ async def process_admin_broadcast_message(message: types.Message, state: FSMCont
             await message.answer("❌ Noto'g'ri ID! Iltimos, raqam kiriting.")
 
 
+@dp.message_handler(commands=['top_referrals'])
+async def top_referrals_handler(message: types.Message):
+    """Admin: eng ko'p referal chaqirganlar"""
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    leaders = await db.get_referral_leaderboard(ADMIN_USERS_PAGE_SIZE)
+    if not leaders:
+        await message.answer("❌ Hozircha referallar yo'q.")
+        return
+
+    text = "🏆 Eng ko'p referal chaqirganlar\n\n"
+    for idx, (user_id, full_name, username, referrals_count, referral_earned) in enumerate(leaders, 1):
+        name = full_name or (f"@{username}" if username else str(user_id))
+        text += f"{idx}. {name} ({user_id}) — {referrals_count} ta, {referral_earned} so'm\n"
+    await message.answer(text)
+
+
+@dp.message_handler(commands=['top_bots'])
+async def top_bots_handler(message: types.Message):
+    """Admin: eng ko'p resurs ishlatayotgan botlar"""
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    top = supervisor.top_usage(ADMIN_USERS_PAGE_SIZE)
+    if not top:
+        await message.answer("❌ Hozircha o'lchangan bot jarayonlari yo'q.")
+        return
+
+    text = "📈 Eng ko'p resurs ishlatayotgan botlar\n\n"
+    for idx, (user_bot_id, usage) in enumerate(top, 1):
+        bot_data = await db.get_user_bot(user_bot_id)
+        name = (bot_data[8] if bot_data else None) or "Noma'lum bot"
+        owner = bot_data[1] if bot_data else "?"
+        text += (
+            f"{idx}. {name} #{user_bot_id} (egasi {owner})\n"
+            f"   💾 {usage.rss_mb:.1f} MB | ⚙️ {usage.cpu_percent:.1f}% | 📂 {usage.fds} fd\n"
+        )
+    await message.answer(text)
+
+
 @dp.message_handler(commands=['ban'])
 async def ban_user_handler(message: types.Message):
     """Admin: Foydalanuvchini ban qilish"""
@@ -2301,7 +5052,7 @@ async def ban_user_handler(message: types.Message):
     
     try:
         user_id = int(message.text.split()[1])
-        db.ban_user(user_id, "Admin buyrug'i")
+        await db.ban_user(user_id, "Admin buyrug'i")
         await message.answer(f"✅ Foydalanuvchi {user_id} ban qilindi!")
     except (IndexError, ValueError):
         await message.answer("❌ Noto'g'ri format! Masalan: /ban 123456789")
@@ -2314,7 +5065,11 @@ async def on_startup(dp):
     async def handle_ping(request):
         return web.Response(text="Alive")
     
+    async def handle_metrics(request):
+        return web.Response(text=outbound_queue.metrics_text())
+
     app.router.add_get('/', handle_ping)
+    app.router.add_get('/metrics', handle_metrics)
     
     runner = web.AppRunner(app)
     await runner.setup()
@@ -2327,6 +5082,25 @@ async def on_startup(dp):
     # Keep-alive background taskini ishga tushirish
     asyncio.create_task(keep_alive_ping())
 
+    await resume_broadcasts()
+
+    # 'active' botlarni qayta ko'tarish (cgroup bo'lsa avval kontrollerlarni yoqamiz)
+    enable_cgroup_controllers()
+    await supervisor.reconcile()
+
+    # Tugallanmagan bot yaratish ishlari ('launching' dagi botlar yuqorida allaqachon ko'tarilgan)
+    await resume_provision_jobs()
+
+
+async def on_shutdown(dp):
+    # Foydalanuvchi botlarini to'xtatish
+    await supervisor.shutdown()
+    await shared_runtime.shutdown()
+    if _provision_pool is not None:
+        _provision_pool.shutdown(wait=False, cancel_futures=True)
+    # Kutilayotgan yozuvlarni commit qilish va DB oqimini yopish
+    await db.close()
+
 async def keep_alive_ping():
     """Bot o'ziga o'zi ping yuborib turishi uchun funksiya"""
     url = os.getenv("RENDER_EXTERNAL_URL")
@@ -2352,4 +5126,7 @@ async def keep_alive_ping():
 
 if __name__ == '__main__':
     logger.info("Bot ishga tushmoqda...")
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    executor.start_polling(
+        dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown,
+        allowed_updates=types.AllowedUpdates.MESSAGE + types.AllowedUpdates.CALLBACK_QUERY + types.AllowedUpdates.CHAT_MEMBER
+    )
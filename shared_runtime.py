@@ -0,0 +1,197 @@
+"""Umumiy runtime: bir nechta shablon botlarni bitta Python jarayonida ishlatish.
+
+make.py tomonidan ishga tushiriladi:
+    python shared_runtime.py <manifest.json> <status.json>
+
+Manifest (make.py yozadi):
+    {"<user_bot_id>": {"token": ..., "dir": ..., "owner_id": ..., "nonce": ...}}
+Status (worker yozadi):
+    {"<user_bot_id>": {"state": "starting|running|crashed", "nonce": ..., "error": ...}}
+
+Mos shablon papkasida maker_tenant.py bo'ladi va quyidagini e'lon qiladi:
+    def setup(dp, owner_id, base_dir):
+        # handlerlarni dp ga ro'yxatdan o'tkazadi (async bo'lishi ham mumkin)
+Har bir tenant o'z Bot/Dispatcher/MemoryStorage iga ega va modul alohida nom
+bilan yuklanadi, shuning uchun global holat tenantlar orasida bo'linmaydi.
+Cheklov: faqat maker_tenant.py ning o'zi alohida nom oladi. Tenant papkasi sys.path
+da yo'q, qo'shni modullar esa sys.modules orqali tenantlar o'rtasida bo'linardi -
+shuning uchun make.py bu yerga faqat bitta fayldan iborat shablonlarni yuboradi.
+Fayllar faqat base_dir ichida saqlanishi kerak (jarayonning cwd umumiy).
+"""
+import asyncio
+import contextlib
+import importlib.util
+import json
+import logging
+import os
+import signal
+import sys
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+TENANT_ENTRY = os.getenv("SHARED_RUNTIME_ENTRY", "maker_tenant.py")
+MANIFEST_POLL_INTERVAL = float(os.getenv("SHARED_RUNTIME_POLL_INTERVAL", 2))
+# Tenant crash bo'lsa make.py dagi bot supervizori bilan bir xil qoidalar
+TENANT_RESTART_BACKOFF_BASE = float(os.getenv("BOT_RESTART_BACKOFF_BASE", 2))
+TENANT_RESTART_BACKOFF_MAX = float(os.getenv("BOT_RESTART_BACKOFF_MAX", 300))
+TENANT_CRASH_LOOP_LIMIT = int(os.getenv("BOT_CRASH_LOOP_LIMIT", 5))
+TENANT_STABLE_AFTER = float(os.getenv("BOT_STABLE_AFTER", 60))
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("shared_runtime")
+
+
+def read_json(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    """Atomar yozish: make.py yarim yozilgan faylni o'qimasligi uchun"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class Tenant:
+    """Bitta foydalanuvchi boti: o'z Bot, Dispatcher va moduli bilan"""
+
+    def __init__(self, tenant_id, spec):
+        self.tenant_id = tenant_id
+        self.spec = spec
+        self.state = "starting"
+        self.error = None
+        self.task = None
+        self.stopping = False
+        self.logger = logging.getLogger(f"tenant_{tenant_id}")
+        self._log_handler = None
+
+    def start(self):
+        log_path = os.path.join(self.spec["dir"], "log.txt")
+        with contextlib.suppress(OSError):
+            self._log_handler = logging.FileHandler(log_path, encoding="utf-8")
+            self._log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+            self.logger.addHandler(self._log_handler)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.stopping = True
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+        if self._log_handler is not None:
+            self.logger.removeHandler(self._log_handler)
+            self._log_handler.close()
+
+    def load_module(self):
+        """maker_tenant.py ni tenantga xos nom bilan yuklash (har restartda yangidan)"""
+        path = os.path.join(self.spec["dir"], TENANT_ENTRY)
+        spec = importlib.util.spec_from_file_location(f"tenant_{self.tenant_id}", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    async def run_once(self):
+        module = self.load_module()
+        bot = Bot(token=self.spec["token"])
+        dp = Dispatcher(bot, storage=MemoryStorage())
+        try:
+            # Noto'g'ri token polling ichida cheksiz log bo'lib qolmasligi uchun oldindan tekshiramiz
+            await bot.get_me()
+            result = module.setup(dp, self.spec["owner_id"], self.spec["dir"])
+            if asyncio.iscoroutine(result):
+                await result
+            self.state = "running"
+            self.logger.info("Bot umumiy runtime da ishga tushdi")
+            await dp.start_polling()
+        finally:
+            dp.stop_polling()
+            await dp.storage.close()
+            await dp.storage.wait_closed()
+            await (await bot.get_session()).close()
+
+    async def run(self):
+        crashes = 0
+        backoff = TENANT_RESTART_BACKOFF_BASE
+        while True:
+            started = time.monotonic()
+            try:
+                await self.run_once()
+                # aiogram start_polling bekor qilishni yutib, oddiy qaytadi
+                if self.stopping:
+                    return
+                # Polling o'z-o'zidan tugadi: bot endi ishlamaydi, xatolik kabi qayta ishga tushiriladi
+                error = "Polling to'xtadi"
+                self.logger.warning(error)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.exception(f"Bot xatolik bilan to'xtadi: {e}")
+                error = str(e)
+            if time.monotonic() - started >= TENANT_STABLE_AFTER:
+                crashes, backoff = 0, TENANT_RESTART_BACKOFF_BASE
+            crashes += 1
+            if crashes >= TENANT_CRASH_LOOP_LIMIT:
+                self.state, self.error = "crashed", error[:500]
+                return
+            self.state = "starting"
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, TENANT_RESTART_BACKOFF_MAX)
+
+
+async def main(manifest_path, status_path):
+    tenants = {}
+    manifest_mtime = None
+    last_status = None
+    parent_pid = os.getppid()
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError, AttributeError):
+            loop.add_signal_handler(sig, stopping.set)
+
+    while not stopping.is_set():
+        # make.py o'lib qolsa (jarayon boshqa ota-onaga o'tadi) tenantlar ikki marta polling qilmasligi kerak
+        if os.getppid() != parent_pid:
+            logger.warning("make.py jarayoni yo'q, to'xtatilmoqda")
+            break
+
+        with contextlib.suppress(OSError):
+            mtime = os.stat(manifest_path).st_mtime_ns
+            if mtime != manifest_mtime:
+                manifest_mtime = mtime
+                manifest = read_json(manifest_path)
+                if manifest is not None:
+                    for tenant_id in [t for t in tenants if tenants[t].spec != manifest.get(t)]:
+                        await tenants.pop(tenant_id).stop()
+                    for tenant_id, spec in manifest.items():
+                        if tenant_id not in tenants:
+                            tenants[tenant_id] = Tenant(tenant_id, spec)
+                            tenants[tenant_id].start()
+
+        status = {
+            tenant_id: {"state": tenant.state, "nonce": tenant.spec.get("nonce"), "error": tenant.error}
+            for tenant_id, tenant in tenants.items()
+        }
+        if status != last_status:
+            write_json(status_path, status)
+            last_status = status
+
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stopping.wait(), MANIFEST_POLL_INTERVAL)
+
+    await asyncio.gather(*(tenant.stop() for tenant in tenants.values()), return_exceptions=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("Foydalanish: python shared_runtime.py <manifest.json> <status.json>")
+    asyncio.run(main(sys.argv[1], sys.argv[2]))